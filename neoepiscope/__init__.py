@@ -44,8 +44,16 @@ import tempfile
 import subprocess
 import warnings
 from . import paths
+from .annotation_index import (
+    AnnotationIndex,
+    IntervalIndex,
+    load_annotation,
+    write_annotation_index,
+)
+from .reference import open_reference, record_reference, recorded_reference
 from .transcript import (
     Transcript,
+    gtf_attribute,
     gtf_to_cds,
     cds_to_feature_length,
     cds_to_tree,
@@ -57,7 +65,14 @@ from .transcript_expression import (
     feature_to_tpm_dict, 
     get_expressed_variants
 )
-from .binding_scores import get_binding_tools, gather_binding_scores
+from .binding_cache import BindingCache
+from .binding_scores import (
+    get_binding_tools,
+    gather_binding_scores,
+    unsupported_alleles,
+    Predictor,
+    register_predictor,
+)
 from .file_processing import (
     adjust_tumor_column,
     combine_vcf,
@@ -93,7 +108,7 @@ def main():
     index_parser = subparsers.add_parser(
         "index",
         help=(
-            "produces pickled dictionaries "
+            "produces an annotation index "
             "linking transcripts to intervals and "
             " CDS lines in a GTF"
         ),
@@ -119,7 +134,7 @@ def main():
         "prep", help=("combines HAPCUT2 output with unphased variants for call mode")
     )
     call_parser = subparsers.add_parser("call", help="calls neoepitopes")
-    # Index parser options (produces pickled dictionaries for transcript data)
+    # Index parser options (produces annotation index for transcript data)
     index_parser.add_argument(
         "-g", "--gtf", type=str, required=True, help="input path to GTF file"
     )
@@ -128,7 +143,23 @@ def main():
         "--dicts",
         type=str,
         required=True,
-        help="output path to pickled CDS dictionary directory",
+        help="output path to annotation index directory",
+    )
+    index_parser.add_argument(
+        "--reference",
+        type=str,
+        required=False,
+        help="path to reference genome to record for use with these "
+        "dictionaries: a UCSC .2bit file, a (bgzipped) FASTA file indexed "
+        "with samtools faidx, or a Bowtie index basename",
+    )
+    index_parser.add_argument(
+        "--threads",
+        type=int,
+        required=False,
+        default=1,
+        help="number of processes to use when parsing GTF and writing "
+        "annotation index; output is identical for any number",
     )
     # Swap parser options (swaps columns in somatic VCF)
     swap_parser.add_argument(
@@ -198,6 +229,13 @@ def main():
         required=False,
         help="path to Bowtie index basename",
     )
+    call_parser.add_argument(
+        "--reference",
+        type=str,
+        required=False,
+        help="path to reference genome as a UCSC .2bit file or a (bgzipped) "
+        "FASTA file indexed with samtools faidx; alternative to --bowtie-index",
+    )
     call_parser.add_argument(
         "-v", "--vcf", type=str, required=False, help="input path to somatic VCF"
     )
@@ -206,7 +244,7 @@ def main():
         "--dicts",
         type=str,
         required=False,
-        help="input path to pickled CDS dictionary directory",
+        help="input path to annotation index directory",
     )
     call_parser.add_argument(
         "-c",
@@ -373,15 +411,73 @@ def main():
         required=False,
         help="minimum TPM to consider a transcript expressed",
     )
+    call_parser.add_argument(
+        "--binding-cache",
+        type=str,
+        required=False,
+        help="path to SQLite database of binding scores, created if absent; "
+        "peptides already scored there are not scored again, and new "
+        "scores are added",
+    )
+    call_parser.add_argument(
+        "--binding-cache-size",
+        type=int,
+        required=False,
+        help="most binding scores to keep in binding cache; least recently "
+        "used scores are dropped beyond this",
+    )
+    call_parser.add_argument(
+        "--threads",
+        type=int,
+        required=False,
+        default=1,
+        help="number of processes to use when enumerating neoepitopes "
+        "across transcripts, and of binding predictions to run at once; "
+        "results are identical for any number",
+    )
+    call_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        required=False,
+        help="most peptides to send to a binding prediction tool in one run; "
+        "chunks are run in parallel when --threads is above 1",
+    )
+    call_parser.add_argument(
+        "--retries",
+        type=int,
+        required=False,
+        default=0,
+        help="number of times to rerun a chunk of peptides whose binding "
+        "prediction fails",
+    )
+    call_parser.add_argument(
+        "--max-cliques",
+        type=int,
+        required=False,
+        help="most combinations of compatible phased variants to apply to a "
+        "transcript per haplotype",
+    )
     args = parser.parse_args()
     if args.subparser_name == "download":
         from .download import NeoepiscopeDownloader
         downloader = NeoepiscopeDownloader()
         downloader.run()
     elif args.subparser_name == "index":
-        cds_dict, tx_data_dict = gtf_to_cds(args.gtf, args.dicts)
-        gene_lengths = cds_to_feature_length(cds_dict, tx_data_dict, args.dicts)
-        tree = cds_to_tree(cds_dict, args.dicts)
+        if args.threads < 1:
+            sys.exit("--threads must be at least 1")
+        cds_dict, tx_data_dict = gtf_to_cds(
+            args.gtf, args.dicts, pickle_it=False, threads=args.threads
+        )
+        gene_lengths = cds_to_feature_length(
+            cds_dict, tx_data_dict, args.dicts, pickle_it=False
+        )
+        write_annotation_index(
+            cds_dict, tx_data_dict, gene_lengths, args.dicts, threads=args.threads
+        )
+        if args.reference is not None:
+            # Fail now rather than at call time if reference is unusable
+            open_reference(args.reference)
+            record_reference(args.reference, args.dicts)
     elif args.subparser_name == "swap":
         adjust_tumor_column(args.input, args.output)
     elif args.subparser_name == "merge":
@@ -390,6 +486,14 @@ def main():
     elif args.subparser_name == "prep":
         prep_hapcut_output(args.output, args.hapcut2_output, args.vcf, args.phased)
     elif args.subparser_name == "call":
+        if args.threads < 1:
+            sys.exit("--threads must be at least 1")
+        if args.chunk_size is not None and args.chunk_size < 1:
+            sys.exit("--chunk-size must be at least 1")
+        if args.retries < 0:
+            sys.exit("--retries must not be negative")
+        if args.max_cliques is not None and args.max_cliques < 1:
+            sys.exit("--max-cliques must be at least 1")
         # Check that output options are compatible
         if args.fasta and args.output == "-":
             sys.exit(
@@ -397,99 +501,55 @@ def main():
                 "please specify an output file using the -o/--output option when "
                 "using the -f/--fasta flag"
             )
-        # Load pickled dictionaries and prepare bowtie index
+        # Load annotation index and prepare reference
         if args.build is not None:
             if (
                 args.build == "GRCh38"
                 and paths.gencode_v34 is not None
                 and paths.bowtie_grch38 is not None
             ):
-                with open(
-                    os.path.join(paths.gencode_v34, "intervals_to_transcript.pickle"),
-                    "rb",
-                ) as interval_stream:
-                    interval_dict = pickle.load(interval_stream)
-                with open(
-                    os.path.join(paths.gencode_v34, "transcript_to_CDS.pickle"), "rb"
-                ) as cds_stream:
-                    cds_dict = pickle.load(cds_stream)
-                with open(
-                    os.path.join(paths.gencode_v34, "transcript_to_gene_info.pickle"), "rb"
-                ) as info_stream:
-                    info_dict = pickle.load(info_stream)
-                with open(
-                    os.path.join(paths.gencode_v34, "feature_to_feature_length.pickle"), "rb"
-                ) as info_stream:
-                    feature_length_dict = pickle.load(info_stream)
+                (
+                    interval_dict,
+                    cds_dict,
+                    info_dict,
+                    feature_length_dict,
+                ) = load_annotation(paths.gencode_v34)
                 reference_index = bowtie_index.BowtieIndexReference(paths.bowtie_grch38)
             elif (
                 args.build == "hg19"
                 and paths.gencode_v19 is not None
                 and paths.bowtie_hg19 is not None
             ):
-                with open(
-                    os.path.join(paths.gencode_v19, "intervals_to_transcript.pickle"),
-                    "rb",
-                ) as interval_stream:
-                    interval_dict = pickle.load(interval_stream)
-                with open(
-                    os.path.join(paths.gencode_v19, "transcript_to_CDS.pickle"), "rb"
-                ) as cds_stream:
-                    cds_dict = pickle.load(cds_stream)
-                with open(
-                    os.path.join(paths.gencode_v19, "transcript_to_gene_info.pickle"), "rb"
-                ) as info_stream:
-                    info_dict = pickle.load(info_stream)
-                with open(
-                    os.path.join(paths.gencode_v19, "feature_to_feature_length.pickle"), "rb"
-                ) as info_stream:
-                    feature_length_dict = pickle.load(info_stream)
+                (
+                    interval_dict,
+                    cds_dict,
+                    info_dict,
+                    feature_length_dict,
+                ) = load_annotation(paths.gencode_v19)
                 reference_index = bowtie_index.BowtieIndexReference(paths.bowtie_hg19)
             elif (
                 args.build == "mm9"
                 and paths.gencode_vM1 is not None
                 and paths.bowtie_mm9 is not None
             ):
-                with open(
-                    os.path.join(paths.gencode_vM1, "intervals_to_transcript.pickle"),
-                    "rb",
-                ) as interval_stream:
-                    interval_dict = pickle.load(interval_stream)
-                with open(
-                    os.path.join(paths.gencode_vM1, "transcript_to_CDS.pickle"), "rb"
-                ) as cds_stream:
-                    cds_dict = pickle.load(cds_stream)
-                with open(
-                    os.path.join(paths.gencode_vM1, "transcript_to_gene_info.pickle"), "rb"
-                ) as info_stream:
-                    info_dict = pickle.load(info_stream)
-                with open(
-                    os.path.join(paths.gencode_vM1, "feature_to_feature_length.pickle"), "rb"
-                ) as info_stream:
-                    feature_length_dict = pickle.load(info_stream)
+                (
+                    interval_dict,
+                    cds_dict,
+                    info_dict,
+                    feature_length_dict,
+                ) = load_annotation(paths.gencode_vM1)
                 reference_index = bowtie_index.BowtieIndexReference(paths.bowtie_mm9)
             elif (
                 args.build == "mm10"
                 and paths.gencode_vM25 is not None
                 and paths.bowtie_mm10 is not None
             ):
-                with open(
-                    os.path.join(paths.gencode_vM25, "intervals_to_transcript.pickle"),
-                    "rb",
-                ) as interval_stream:
-                    interval_dict = pickle.load(interval_stream)
-                with open(
-                    os.path.join(paths.gencode_vM25, "transcript_to_CDS.pickle"), "rb"
-                ) as cds_stream:
-                    cds_dict = pickle.load(cds_stream)
-                with open(
-                    os.path.join(paths.gencode_vM25, "transcript_to_gene_info.pickle"), "rb"
-                ) as info_stream:
-                    info_dict = pickle.load(info_stream)
-                with open(
-                    os.path.join(paths.gencode_vM25, "feature_to_feature_length.pickle"), "rb"
-                ) as info_stream:
-                    feature_length_dict = pickle.load(info_stream)
+                (
+                    interval_dict,
+                    cds_dict,
+                    info_dict,
+                    feature_length_dict,
+                ) = load_annotation(paths.gencode_vM25)
                 reference_index = bowtie_index.BowtieIndexReference(paths.bowtie_mm10)
             else:
                 raise RuntimeError(
@@ -503,78 +563,40 @@ def main():
                     )
                 )
         else:
-            if args.bowtie_index is not None and args.dicts is not None:
-                intervals_path = os.path.join(
-                    args.dicts, "intervals_to_transcript.pickle"
+            if args.bowtie_index is not None and args.reference is not None:
+                raise RuntimeError(
+                    "Only one of --bowtie-index and --reference may be specified"
                 )
-                if os.path.isfile(intervals_path):
-                    with open(intervals_path, "rb") as interval_stream:
-                        interval_dict = pickle.load(interval_stream)
-                else:
-                    raise RuntimeError(
-                        "".join(
-                            [
-                                "Cannot find ",
-                                intervals_path,
-                                "; have you indexed your GTF with neoepiscope index?",
-                            ]
-                        )
-                    )
-                cds_path = os.path.join(args.dicts, "transcript_to_CDS.pickle")
-                if os.path.isfile(cds_path):
-                    with open(cds_path, "rb") as cds_stream:
-                        cds_dict = pickle.load(cds_stream)
-                else:
-                    raise RuntimeError(
-                        "".join(
-                            [
-                                "Cannot find ",
-                                cds_path,
-                                "; have you indexed your GTF with neoepiscope index?",
-                            ]
-                        )
-                    )
-                info_path = os.path.join(args.dicts, "transcript_to_gene_info.pickle")
-                if os.path.isfile(info_path):
-                    with open(info_path, "rb") as info_stream:
-                        info_dict = pickle.load(info_stream)
-                else:
-                    raise RuntimeError(
-                        "".join(
-                            [
-                                "Cannot find ",
-                                info_path,
-                                "; have you indexed your GTF with neoepiscope index?",
-                            ]
-                        )
-                    )
-                feature_length_path = os.path.join(args.dicts, "feature_to_feature_length.pickle")
-                if os.path.isfile(feature_length_path):
-                    with open(feature_length_path, "rb") as length_stream:
-                        feature_length_dict = pickle.load(length_stream)
-                else:
-                    raise RuntimeError(
-                        "".join(
-                            [
-                                "Cannot find ",
-                                feature_length_path,
-                                "; have you indexed your GTF with neoepiscope index?",
-                            ]
+            if args.dicts is not None and (
+                args.bowtie_index is not None
+                or args.reference is not None
+                or recorded_reference(args.dicts) is not None
+            ):
+                (
+                    interval_dict,
+                    cds_dict,
+                    info_dict,
+                    feature_length_dict,
+                ) = load_annotation(args.dicts)
+                if args.bowtie_index is not None:
+                    bowtie_files = [
+                        "".join([args.bowtie_index, ".", str(x), ".ebwt"])
+                        for x in range(1, 5)
+                    ]
+                    if list(set([os.path.isfile(x) for x in bowtie_files])) == [True]:
+                        reference_index = bowtie_index.BowtieIndexReference(
+                            args.bowtie_index
                         )
-                    )
-                bowtie_files = [
-                    "".join([args.bowtie_index, ".", str(x), ".ebwt"]) for x in range(1, 5)
-                ]
-                if list(set([os.path.isfile(x) for x in bowtie_files])) == [True]:
-                    reference_index = bowtie_index.BowtieIndexReference(
-                        args.bowtie_index
-                    )
+                    else:
+                        raise RuntimeError("Cannot find specified bowtie index")
+                elif args.reference is not None:
+                    reference_index = open_reference(args.reference)
                 else:
-                    raise RuntimeError("Cannot find specified bowtie index")
+                    reference_index = open_reference(recorded_reference(args.dicts))
             else:
                 raise RuntimeError(
                     "User must specify either --build OR "
-                    "--bowtie_index and --dicts options"
+                    "--bowtie_index (or --reference) and --dicts options"
                 )
         # Check affinity predictor(s)
         if args.no_affinity:
@@ -598,6 +620,36 @@ def main():
                     "user must specify at least one allele "
                     "via the --alleles option"
                 )
+            # Check alleles before enumerating neoepitopes
+            unsupported = unsupported_alleles(tool_dict, hla_alleles)
+            for tool in sorted(unsupported.keys()):
+                for allele in unsupported[tool]:
+                    warnings.warn(
+                        " ".join(
+                            [
+                                allele,
+                                "is not a valid allele for",
+                                tool,
+                                "- it will receive NA scores from this tool",
+                            ]
+                        ),
+                        Warning,
+                    )
+            if len(unsupported) == len(tool_dict):
+                unscorable = [
+                    allele
+                    for allele in hla_alleles
+                    if all([allele in unsupported[tool] for tool in unsupported])
+                ]
+                if unscorable:
+                    raise RuntimeError(
+                        " ".join(
+                            [
+                                "No binding prediction tool supports allele(s)",
+                                ", ".join(unscorable),
+                            ]
+                        )
+                    )
         # Obtain peptide sizes for kmerizing peptides
         if "," in args.kmer_size:
             size_list = args.kmer_size.split(",")
@@ -693,6 +745,7 @@ def main():
             args.merged_hapcut2_output, interval_dict, phase_mutations
         )
         # Apply mutations to transcripts and get neoepitopes
+        enumeration_stats = {}
         neoepitopes, fasta = get_peptides_from_transcripts(
             relevant_transcripts,
             homozygous_variants,
@@ -712,12 +765,45 @@ def main():
             include_germline,
             include_somatic,
             protein_fasta=args.fasta,
+            threads=args.threads,
+            max_cliques=args.max_cliques,
+            stats=enumeration_stats,
+        )
+        print(
+            "Neopeptide enumeration: {} of {} edit sets skipped as repeats".format(
+                enumeration_stats["repeats"], enumeration_stats["edit_sets"]
+            ),
+            file=sys.stderr,
         )
         # If neoepitopes are found, get binding scores and write results
         if len(neoepitopes) > 0:
-            full_neoepitopes = gather_binding_scores(
-                neoepitopes, tool_dict, hla_alleles, size_list
-            )
+            if args.binding_cache is not None:
+                binding_cache = BindingCache(
+                    args.binding_cache, max_entries=args.binding_cache_size
+                )
+            else:
+                binding_cache = None
+            try:
+                full_neoepitopes = gather_binding_scores(
+                    neoepitopes,
+                    tool_dict,
+                    hla_alleles,
+                    size_list,
+                    threads=args.threads,
+                    cache=binding_cache,
+                    chunk_size=args.chunk_size,
+                    retries=args.retries,
+                )
+            finally:
+                if binding_cache is not None:
+                    binding_cache.close()
+            if binding_cache is not None:
+                print(
+                    "Binding score cache: {} hits, {} misses".format(
+                        binding_cache.hits, binding_cache.misses
+                    ),
+                    file=sys.stderr,
+                )
             # Find expressed variants if relevant
             if args.rna_bam:
                 expressed_variants, covered_variants = get_expressed_variants(
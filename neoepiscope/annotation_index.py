@@ -0,0 +1,739 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+annotation_index.py
+
+Includes functions for writing the annotation produced by neoepiscope index
+to memory-mappable binary files sharded by contig, and a class for reading
+them back lazily so that neoepiscope call only opens the contigs and decodes
+the transcripts it touches.
+
+The MIT License (MIT)
+Copyright (c) 2018 Mary A. Wood, Austin Nguyen,
+                   Abhinav Nellore, and Reid F. Thompson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import re
+import json
+import mmap
+import pickle
+import hashlib
+import struct
+import numpy as np
+from intervaltree import Interval
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# Name of binary annotation index manifest within a dictionary directory;
+#   CDS blocks and intervals for each contig are stored in shards alongside
+annotation_index_file = "annotation.idx"
+_shard_file = "annotation.{}.idx"
+_shard_pattern = re.compile(r"^annotation\.([0-9]+)\.idx$")
+
+# Layout: magic, version and header length, then a JSON header describing
+#   8-byte-aligned little-endian arrays that follow it
+_magic = b"NEOEPIDX"
+_version = 2
+_preamble = struct.Struct("<8sII")
+_alignment = 8
+
+# Pickled dictionaries written by earlier versions of neoepiscope index
+_pickle_files = [
+    "intervals_to_transcript.pickle",
+    "transcript_to_CDS.pickle",
+    "transcript_to_gene_info.pickle",
+    "feature_to_feature_length.pickle",
+]
+
+
+def _string_table(strings):
+    """ Packs strings into a fixed-width byte string array
+
+        strings: iterable of strings
+        Return value: NumPy array of dtype S<max length>
+    """
+    encoded = [x.encode("utf-8") for x in strings]
+    width = max([len(x) for x in encoded] + [1])
+    return np.array(encoded, dtype="S{}".format(width))
+
+
+def _codes(values, table):
+    """ Replaces values with their positions in a string table
+
+        values: list of strings
+        table: list of unique strings
+        Return value: list of integers
+    """
+    code_of = {value: i for i, value in enumerate(table)}
+    return [code_of[value] for value in values]
+
+
+def _write_arrays(path, arrays, header):
+    """ Writes arrays to a binary index file, replacing it atomically
+
+        path: path to index file
+        arrays: list of (name, NumPy array) tuples
+        header: dictionary of additional JSON-serializable header fields
+        No return value.
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // _alignment) * _alignment
+    header = dict(header, arrays=layout)
+    header = json.dumps(header, sort_keys=True).encode("utf-8")
+    header += b" " * (-(_preamble.size + len(header)) % _alignment)
+    temp_path = "".join([path, ".tmp"])
+    with open(temp_path, "wb") as index_stream:
+        index_stream.write(_preamble.pack(_magic, _version, len(header)))
+        index_stream.write(header)
+        for name, array in arrays:
+            index_stream.write(array.tobytes())
+            index_stream.write(b"\0" * (-array.nbytes % _alignment))
+    os.rename(temp_path, path)
+
+
+def _read_arrays(path):
+    """ Memory-maps a binary index file written by _write_arrays()
+
+        path: path to index file
+        Return value: tuple (header dictionary, dictionary linking array
+            names to read-only NumPy arrays backed by the file)
+    """
+    with open(path, "rb") as index_stream:
+        index_mm = mmap.mmap(index_stream.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(index_mm) < _preamble.size:
+        raise RuntimeError("".join([path, " is not a neoepiscope index"]))
+    magic, version, header_size = _preamble.unpack(index_mm[: _preamble.size])
+    if magic != _magic:
+        raise RuntimeError("".join([path, " is not a neoepiscope index"]))
+    if version != _version:
+        raise RuntimeError(
+            "".join(
+                [
+                    path,
+                    " was written by an incompatible version of neoepiscope; ",
+                    "rerun neoepiscope index",
+                ]
+            )
+        )
+    header = json.loads(
+        index_mm[_preamble.size : _preamble.size + header_size].decode("utf-8")
+    )
+    data_start = _preamble.size + header_size
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        dtype = np.dtype(str(dtype))
+        count = int(np.prod(shape))
+        if count:
+            arrays[name] = np.frombuffer(
+                index_mm, dtype=dtype, count=count, offset=data_start + offset
+            ).reshape(shape)
+        else:
+            arrays[name] = np.empty(shape, dtype=dtype)
+    return header, arrays
+
+
+def _shard_arrays(transcripts, cds_dict, tx_code):
+    """ Packs CDS blocks and intervals for the transcripts on one contig
+
+        transcripts: list of transcript IDs whose first block is on the contig
+        cds_dict: CDS dictionary produced by gtf_to_cds()
+        tx_code: dictionary linking transcript IDs to their positions in
+            the manifest's transcript table
+
+        Return value: list of (name, NumPy array) tuples
+    """
+    cds_ptr = [0]
+    blocks = []
+    for transcript_id in transcripts:
+        blocks.extend(cds_dict[transcript_id])
+        cds_ptr.append(len(blocks))
+    columns = list(zip(*blocks))
+    chroms = sorted(set(columns[0]))
+    seq_types = sorted(set(columns[1]))
+    strands = sorted(set(columns[4]))
+    tx_types = sorted(set(columns[5]))
+    # Interval table mirroring cds_to_tree(): all intervals of a transcript
+    #   are placed on the chromosome of its first block; identical intervals
+    #   are stored once, as in an IntervalTree
+    intervals = set()
+    for transcript_id in transcripts:
+        for cds in cds_dict[transcript_id]:
+            if cds[3] + 1 > cds[2]:
+                intervals.add((cds[2], cds[3] + 1, tx_code[transcript_id]))
+    iv_columns = list(zip(*sorted(intervals))) if intervals else [[], [], []]
+    iv_end = np.array(iv_columns[1], dtype="<i8")
+    return [
+        ("chroms", _string_table(chroms)),
+        ("seq_types", _string_table(seq_types)),
+        ("strands", _string_table(strands)),
+        ("tx_types", _string_table(tx_types)),
+        ("cds_ptr", np.array(cds_ptr, dtype="<i8")),
+        ("block_chrom", np.array(_codes(columns[0], chroms), dtype="<i4")),
+        ("block_type", np.array(_codes(columns[1], seq_types), dtype="<i4")),
+        ("block_start", np.array(columns[2], dtype="<i8")),
+        ("block_end", np.array(columns[3], dtype="<i8")),
+        ("block_strand", np.array(_codes(columns[4], strands), dtype="<i4")),
+        ("block_tx_type", np.array(_codes(columns[5], tx_types), dtype="<i4")),
+        ("iv_start", np.array(iv_columns[0], dtype="<i8")),
+        ("iv_end", iv_end),
+        ("iv_max_end", np.maximum.accumulate(iv_end)),
+        ("iv_tx", np.array(iv_columns[2], dtype="<i4")),
+    ]
+
+
+def _shard_arrays_star(args):
+    """ Calls _shard_arrays() on a tuple of arguments; run by worker processes
+
+        args: tuple (transcripts, cds_dict, tx_code) for _shard_arrays()
+
+        Return value: list returned by _shard_arrays()
+    """
+    return _shard_arrays(*args)
+
+
+def _build_tag(contigs, array_lists):
+    """ Derives an index's build tag from its contents, so that rebuilding
+        an index from the same GTF reproduces it byte for byte
+
+        contigs: list of contigs, one per shard
+        array_lists: lists of (name, NumPy array) tuples, one per file
+
+        Return value: hex digest
+    """
+    digest = hashlib.sha1(json.dumps(contigs).encode("utf-8"))
+    for arrays in array_lists:
+        for name, array in arrays:
+            digest.update(name.encode("utf-8"))
+            digest.update(array.dtype.str.encode("utf-8"))
+            digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def write_annotation_index(
+    cds_dict, tx_data_dict, feature_lengths, dictdir, threads=1
+):
+    """ Writes annotation from neoepiscope index to binary files: a manifest
+        with transcript/gene tables, and a shard of CDS blocks and intervals
+        for each contig
+
+        cds_dict: CDS dictionary produced by gtf_to_cds()
+        tx_data_dict: transcript data dictionary produced by gtf_to_cds()
+        feature_lengths: dictionary produced by cds_to_feature_length()
+        dictdir: path to directory in which to write index
+        threads: number of processes to pack shards with; output does not
+            depend on it
+
+        Return value: path to manifest
+    """
+    transcripts = sorted(set(cds_dict) | set(tx_data_dict) | set(feature_lengths))
+    tx_code = {transcript_id: i for i, transcript_id in enumerate(transcripts)}
+    # Shard transcripts by the chromosome of their first block
+    contig_transcripts = {}
+    for transcript_id in transcripts:
+        if transcript_id in cds_dict:
+            contig_transcripts.setdefault(
+                cds_dict[transcript_id][0][0], []
+            ).append(transcript_id)
+    contigs = sorted(contig_transcripts)
+    tx_shard = [-1] * len(transcripts)
+    tx_slot = [-1] * len(transcripts)
+    for k, contig in enumerate(contigs):
+        for slot, transcript_id in enumerate(contig_transcripts[contig]):
+            tx_shard[tx_code[transcript_id]] = k
+            tx_slot[tx_code[transcript_id]] = slot
+    shard_args = [
+        (
+            contig_transcripts[contig],
+            {x: cds_dict[x] for x in contig_transcripts[contig]},
+            {x: tx_code[x] for x in contig_transcripts[contig]},
+        )
+        for contig in contigs
+    ]
+    if threads > 1 and len(contigs) > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(threads)
+        try:
+            shard_arrays = pool.map(_shard_arrays_star, shard_args)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        shard_arrays = [_shard_arrays_star(args) for args in shard_args]
+    # Transcript/gene information, with -1 where a transcript has none
+    info = [tx_data_dict.get(x) or [None, None, None] for x in transcripts]
+    tables = [
+        sorted(set([x[field] for x in info if x[field] is not None]))
+        for field in range(3)
+    ]
+    info_codes = []
+    for field, table in enumerate(tables):
+        code_of = {value: i for i, value in enumerate(table)}
+        info_codes.append([code_of.get(x[field], -1) for x in info])
+    lengths = [feature_lengths.get(x, np.nan) for x in transcripts]
+    manifest_arrays = [
+        ("transcripts", _string_table(transcripts)),
+        ("tx_types", _string_table(tables[0])),
+        ("gene_ids", _string_table(tables[1])),
+        ("gene_names", _string_table(tables[2])),
+        ("tx_shard", np.array(tx_shard, dtype="<i4")),
+        ("tx_slot", np.array(tx_slot, dtype="<i4")),
+        ("info_tx_type", np.array(info_codes[0], dtype="<i4")),
+        ("info_gene_id", np.array(info_codes[1], dtype="<i4")),
+        ("info_gene_name", np.array(info_codes[2], dtype="<i4")),
+        ("feature_length", np.array(lengths, dtype="<f8")),
+    ]
+    # Shards are tagged with the manifest they belong to
+    build = _build_tag(contigs, shard_arrays + [manifest_arrays])
+    shards = []
+    for k, contig in enumerate(contigs):
+        shards.append(_shard_file.format(k))
+        _write_arrays(
+            os.path.join(dictdir, shards[-1]),
+            shard_arrays[k],
+            {"build": build, "contig": contig},
+        )
+    index_path = os.path.join(dictdir, annotation_index_file)
+    _write_arrays(
+        index_path,
+        manifest_arrays,
+        {"build": build, "contigs": contigs, "shards": shards},
+    )
+    # Remove shards left behind by an earlier index with more contigs
+    for filename in os.listdir(dictdir):
+        match = _shard_pattern.match(filename)
+        if match and int(match.group(1)) >= len(contigs):
+            os.remove(os.path.join(dictdir, filename))
+    return index_path
+
+
+class _TranscriptView(Mapping):
+    """ Read-only dictionary keyed by transcript ID, decoding values from an
+        AnnotationIndex on demand
+    """
+
+    def __init__(self, index, present, decode):
+        self._index = index
+        self._present = present
+        self._decode = decode
+        self._decoded = {}
+
+    def __getitem__(self, transcript_id):
+        try:
+            return self._decoded[transcript_id]
+        except KeyError:
+            pass
+        i = self._index.transcript_index(transcript_id)
+        if i is None or not self._present[i]:
+            raise KeyError(transcript_id)
+        value = self._decoded[transcript_id] = self._decode(i)
+        return value
+
+    def __iter__(self):
+        for i in np.flatnonzero(self._present):
+            yield self._index.transcripts[i].decode("utf-8")
+
+    def __len__(self):
+        return int(np.count_nonzero(self._present))
+
+
+class IntervalIndex(object):
+    """
+    Sorted-array index of half-open genomic intervals labeled with transcript
+    IDs, answering the overlap queries neoepiscope makes of an IntervalTree.
+    Intervals are sorted by start, so those starting before the end of a
+    query are a prefix found by binary search; a running maximum of interval
+    ends marks where in that prefix intervals can begin to reach the query.
+    """
+
+    def __init__(self, starts, ends, max_ends, transcripts, transcript_ids):
+        """ starts: NumPy array of interval starts (inclusive), sorted
+            ends: NumPy array of interval ends (exclusive)
+            max_ends: NumPy array of running maxima of ends
+            transcripts: NumPy array of interval labels as positions in
+                transcript_ids
+            transcript_ids: NumPy array of transcript IDs as byte strings
+        """
+        self._starts = starts
+        self._ends = ends
+        self._max_ends = max_ends
+        self._transcripts = transcripts
+        self._transcript_ids = transcript_ids
+        self._decoded = {}
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """ Builds an index from labeled intervals; empty intervals are
+            skipped and identical intervals are stored once, as in an
+            IntervalTree
+
+            intervals: iterable of (start, end, transcript ID) tuples,
+                including Interval objects
+
+            Return value: IntervalIndex
+        """
+        intervals = sorted(
+            set([(begin, end, data) for begin, end, data in intervals if end > begin])
+        )
+        transcript_ids = sorted(set([data for _, _, data in intervals]))
+        code_of = {data: i for i, data in enumerate(transcript_ids)}
+        ends = np.array([end for _, end, _ in intervals], dtype=np.int64)
+        return cls(
+            np.array([begin for begin, _, _ in intervals], dtype=np.int64),
+            ends,
+            np.maximum.accumulate(ends),
+            np.array([code_of[data] for _, _, data in intervals], dtype=np.int32),
+            _string_table(transcript_ids),
+        )
+
+    def _transcript_id(self, code):
+        try:
+            return self._decoded[code]
+        except KeyError:
+            transcript_id = self._decoded[code] = self._transcript_ids[
+                code
+            ].decode("utf-8")
+            return transcript_id
+
+    def _hits(self, begin, end):
+        """ Finds positions of intervals overlapping a range
+
+            begin: start of range, inclusive
+            end: end of range, exclusive
+
+            Return value: NumPy array of positions, in order of start
+        """
+        if begin >= end:
+            return np.empty(0, dtype=np.int64)
+        # Intervals starting before end; only those from the first whose
+        #   running maximum end passes begin can reach into the range
+        hi = int(np.searchsorted(self._starts, end, side="left"))
+        lo = int(np.searchsorted(self._max_ends[:hi], begin, side="right"))
+        return lo + np.flatnonzero(self._ends[lo:hi] > begin)
+
+    def overlap(self, begin, end):
+        """ Finds intervals overlapping a range
+
+            begin: start of range, inclusive
+            end: end of range, exclusive
+
+            Return value: list of Interval objects with transcript IDs as data
+        """
+        return [
+            Interval(
+                int(self._starts[i]),
+                int(self._ends[i]),
+                self._transcript_id(self._transcripts[i]),
+            )
+            for i in self._hits(begin, end)
+        ]
+
+    def at(self, point):
+        """ Finds intervals containing a point
+
+            point: genomic position
+
+            Return value: list of Interval objects with transcript IDs as data
+        """
+        return self.overlap(point, point + 1)
+
+    def overlapping_transcripts(self, begin, end):
+        """ Finds transcripts with intervals overlapping a range
+
+            begin: start of range, inclusive
+            end: end of range, exclusive
+
+            Return value: list of unique transcript IDs, ordered by the start
+                of their first overlapping interval
+        """
+        codes = self._transcripts[self._hits(begin, end)].tolist()
+        return [
+            self._transcript_id(code)
+            for i, code in enumerate(codes)
+            if code not in codes[:i]
+        ]
+
+    def overlapping_transcripts_batch(self, begins, ends):
+        """ Finds transcripts with intervals overlapping each of many ranges
+            with one pass of binary searches
+
+            begins: iterable of range starts, inclusive
+            ends: iterable of range ends, exclusive
+
+            Return value: list with a list of unique transcript IDs for each
+                range, ordered as in overlapping_transcripts()
+        """
+        begins = np.asarray(begins, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        his = np.searchsorted(self._starts, ends, side="left")
+        los = np.searchsorted(self._max_ends, begins, side="right")
+        counts = np.where(begins < ends, np.maximum(his - los, 0), 0)
+        # Flatten candidate positions for all ranges, then keep overlaps
+        queries = np.repeat(np.arange(len(begins)), counts)
+        candidates = (
+            np.arange(counts.sum())
+            - np.repeat(np.cumsum(counts) - counts, counts)
+            + np.repeat(los, counts)
+        )
+        overlapping = self._ends[candidates] > begins[queries]
+        queries = queries[overlapping]
+        codes = self._transcripts[candidates[overlapping]].tolist()
+        bounds = np.searchsorted(queries, np.arange(len(begins) + 1)).tolist()
+        transcripts = []
+        for i in range(len(begins)):
+            range_codes = codes[bounds[i] : bounds[i + 1]]
+            transcripts.append(
+                [
+                    self._transcript_id(code)
+                    for j, code in enumerate(range_codes)
+                    if code not in range_codes[:j]
+                ]
+            )
+        return transcripts
+
+    def begin(self):
+        return int(self._starts[0]) if len(self._starts) else 0
+
+    def end(self):
+        return int(self._max_ends[-1]) if len(self._max_ends) else 0
+
+    def __iter__(self):
+        for i in range(len(self._starts)):
+            yield Interval(
+                int(self._starts[i]),
+                int(self._ends[i]),
+                self._transcript_id(self._transcripts[i]),
+            )
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class _IntervalView(Mapping):
+    """ Read-only dictionary linking contigs to IntervalIndex objects;
+        a contig's shard is opened when it is first looked up
+    """
+
+    def __init__(self, index):
+        self._index = index
+        self._opened = {}
+
+    def __getitem__(self, contig):
+        try:
+            return self._opened[contig]
+        except KeyError:
+            pass
+        shard = self._index.shard(self._index.contig_shard[contig])
+        intervals = self._opened[contig] = IntervalIndex(
+            shard["iv_start"],
+            shard["iv_end"],
+            shard["iv_max_end"],
+            shard["iv_tx"],
+            self._index.transcripts,
+        )
+        return intervals
+
+    def __contains__(self, contig):
+        return contig in self._index.contig_shard
+
+    def __iter__(self):
+        return iter(self._index.contigs)
+
+    def __len__(self):
+        return len(self._index.contigs)
+
+
+class AnnotationIndex(object):
+    """
+    Memory-maps the manifest of a binary annotation index written by
+    write_annotation_index() and exposes dictionary-like views equivalent to
+    the pickled dictionaries of earlier versions: interval_dict, cds_dict,
+    info_dict, and feature_lengths. A contig's shard is mapped only when its
+    intervals or one of its transcripts' CDS blocks are first looked up.
+    """
+
+    def __init__(self, index_path):
+        self.path = index_path
+        self._header, self.arrays = _read_arrays(index_path)
+        self.transcripts = self.arrays["transcripts"]
+        self._key_width = self.transcripts.dtype.itemsize
+        self.contigs = [str(x) for x in self._header["contigs"]]
+        self.contig_shard = {x: k for k, x in enumerate(self.contigs)}
+        self._shards = [None] * len(self.contigs)
+        self.cds_dict = _TranscriptView(
+            self, self.arrays["tx_shard"] >= 0, self._decode_cds
+        )
+        self.info_dict = _TranscriptView(
+            self, self.arrays["info_tx_type"] >= 0, self._decode_info
+        )
+        self.feature_lengths = _TranscriptView(
+            self,
+            ~np.isnan(self.arrays["feature_length"]),
+            lambda i: float(self.arrays["feature_length"][i]),
+        )
+        self.interval_dict = _IntervalView(self)
+
+    def __reduce__(self):
+        # Reopen rather than copy memory maps, e.g. in worker processes
+        return (self.__class__, (self.path,))
+
+    def shard(self, k):
+        """ Maps a contig's shard on first use
+
+            k: position of contig in self.contigs
+
+            Return value: dictionary linking array names to NumPy arrays
+        """
+        if self._shards[k] is None:
+            shard_path = os.path.join(
+                os.path.dirname(self.path), self._header["shards"][k]
+            )
+            header, self._shards[k] = _read_arrays(shard_path)
+            if header["build"] != self._header["build"]:
+                raise RuntimeError(
+                    "".join(
+                        [
+                            shard_path,
+                            " does not belong to ",
+                            self.path,
+                            "; rerun neoepiscope index",
+                        ]
+                    )
+                )
+        return self._shards[k]
+
+    def opened_contigs(self):
+        """ Lists contigs whose shards have been mapped
+
+            Return value: list of contig names
+        """
+        return [
+            self.contigs[k]
+            for k in range(len(self.contigs))
+            if self._shards[k] is not None
+        ]
+
+    def transcript_index(self, transcript_id):
+        """ Finds a transcript's position in the transcript table
+
+            transcript_id: transcript ID
+
+            Return value: integer position, or None if transcript is absent
+        """
+        try:
+            key = transcript_id.encode("utf-8")
+        except AttributeError:
+            return None
+        if len(key) > self._key_width:
+            return None
+        i = int(np.searchsorted(self.transcripts, key))
+        if i < len(self.transcripts) and self.transcripts[i] == key:
+            return i
+        return None
+
+    def _decode_cds(self, i):
+        """ Decodes a transcript's blocks in the format of gtf_to_cds() """
+        shard = self.shard(self.arrays["tx_shard"][i])
+        slot = self.arrays["tx_slot"][i]
+        begin, end = shard["cds_ptr"][slot : slot + 2]
+        return [
+            [
+                shard["chroms"][chrom].decode("utf-8"),
+                shard["seq_types"][seq_type].decode("utf-8"),
+                start,
+                stop,
+                shard["strands"][strand].decode("utf-8"),
+                shard["tx_types"][tx_type].decode("utf-8"),
+            ]
+            for chrom, seq_type, start, stop, strand, tx_type in zip(
+                shard["block_chrom"][begin:end].tolist(),
+                shard["block_type"][begin:end].tolist(),
+                shard["block_start"][begin:end].tolist(),
+                shard["block_end"][begin:end].tolist(),
+                shard["block_strand"][begin:end].tolist(),
+                shard["block_tx_type"][begin:end].tolist(),
+            )
+        ]
+
+    def _decode_info(self, i):
+        """ Decodes transcript data in the format of gtf_to_cds() """
+        info = []
+        for field, table in [
+            ("info_tx_type", "tx_types"),
+            ("info_gene_id", "gene_ids"),
+            ("info_gene_name", "gene_names"),
+        ]:
+            code = self.arrays[field][i]
+            info.append(self.arrays[table][code].decode("utf-8") if code >= 0 else None)
+        return info
+
+
+def load_annotation(dictdir):
+    """ Loads annotation written by neoepiscope index, preferring the binary
+        index and falling back to pickled dictionaries from earlier versions
+
+        dictdir: path to directory storing indexed annotation
+
+        Return value: tuple (interval_dict, cds_dict, info_dict,
+            feature_lengths)
+    """
+    index_path = os.path.join(dictdir, annotation_index_file)
+    if os.path.isfile(index_path):
+        index = AnnotationIndex(index_path)
+        return (
+            index.interval_dict,
+            index.cds_dict,
+            index.info_dict,
+            index.feature_lengths,
+        )
+    loaded = []
+    for pickle_file in _pickle_files:
+        pickle_path = os.path.join(dictdir, pickle_file)
+        if not os.path.isfile(pickle_path):
+            raise RuntimeError(
+                "".join(
+                    [
+                        "Cannot find ",
+                        index_path,
+                        " or ",
+                        pickle_path,
+                        "; have you indexed your GTF with neoepiscope index?",
+                    ]
+                )
+            )
+        with open(pickle_path, "rb") as pickle_stream:
+            loaded.append(pickle.load(pickle_stream))
+    # Earlier versions pickled a dictionary of IntervalTrees
+    loaded[0] = {
+        contig: IntervalIndex.from_intervals(intervals)
+        if not isinstance(intervals, IntervalIndex)
+        else intervals
+        for contig, intervals in loaded[0].items()
+    }
+    return tuple(loaded)
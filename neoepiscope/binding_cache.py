@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+binding_cache.py
+
+Part of neoepiscope
+Includes a class for storing binding scores on disk in an SQLite database,
+so that peptides scored in one run of neoepiscope call need not be scored
+again in the next.
+
+Licensed under the MIT license.
+
+The MIT License (MIT)
+Copyright (c) 2018 Mary A. Wood, Austin Nguyen,
+                   Abhinav Nellore, and Reid Thompson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from __future__ import absolute_import, division, print_function
+import json
+import sqlite3
+import time
+
+# Most host parameters SQLite allows in one statement, less room for the key
+_batch_size = 900
+
+
+class BindingCache(object):
+    """
+    Binding scores kept in an SQLite database, keyed by tool (name and
+    version), scoring methods, allele, and peptide. Scores are stored as
+    the strings the tools produce, "NA" included, so a cached peptide gets
+    exactly the scores a fresh prediction would give it.
+
+    Each row records when it was last looked up; if max_entries is set,
+    evict() drops the least recently used rows beyond it. hits and misses
+    count peptides looked up since the cache was opened.
+    """
+
+    def __init__(self, path, max_entries=None):
+        """ Opens a cache, creating it if necessary
+
+            path: path to SQLite database
+            max_entries: most rows to keep after evict(), or None for no
+                limit
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+        # Wait on other neoepiscope runs sharing the cache
+        self._connection = sqlite3.connect(path, timeout=600)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "tool TEXT NOT NULL, methods TEXT NOT NULL, "
+                "allele TEXT NOT NULL, peptide TEXT NOT NULL, "
+                "scores TEXT NOT NULL, used REAL NOT NULL, "
+                "PRIMARY KEY (tool, methods, allele, peptide))"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS scores_used ON scores (used)"
+            )
+
+    def lookup(self, tool, methods, allele, peptides):
+        """ Retrieves cached scores
+
+            tool: name of tool, including version, e.g. netMHCpan4
+            methods: list of scoring methods
+            allele: HLA allele
+            peptides: list of peptides
+
+            Return value: dictionary linking cached peptides to tuples of
+                their scores
+        """
+        key = [tool, json.dumps(list(methods)), allele]
+        now = time.time()
+        found = {}
+        with self._connection:
+            for i in range(0, len(peptides), _batch_size):
+                batch = list(peptides[i : i + _batch_size])
+                condition = "".join(
+                    [
+                        "tool = ? AND methods = ? AND allele = ? AND peptide IN (",
+                        ",".join(["?"] * len(batch)),
+                        ")",
+                    ]
+                )
+                for peptide, scores in self._connection.execute(
+                    "".join(["SELECT peptide, scores FROM scores WHERE ", condition]),
+                    key + batch,
+                ):
+                    found[peptide] = tuple(json.loads(scores))
+                self._connection.execute(
+                    "".join(["UPDATE scores SET used = ? WHERE ", condition]),
+                    [now] + key + batch,
+                )
+        self.hits += len(found)
+        self.misses += len(peptides) - len(found)
+        return found
+
+    def store(self, tool, methods, allele, binding_scores):
+        """ Adds scores to cache, replacing any already there
+
+            tool: name of tool, including version, e.g. netMHCpan4
+            methods: list of scoring methods
+            allele: HLA allele
+            binding_scores: list of tuples, each a peptide followed by its
+                scores
+
+            No return value.
+        """
+        key = (tool, json.dumps(list(methods)), allele)
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    key + (score[0], json.dumps(list(score[1:])), now)
+                    for score in binding_scores
+                ],
+            )
+
+    def evict(self):
+        """ Drops least recently used rows beyond max_entries
+
+            Return value: number of rows dropped
+        """
+        if self.max_entries is None:
+            return 0
+        with self._connection:
+            count = self._connection.execute(
+                "SELECT COUNT(*) FROM scores"
+            ).fetchone()[0]
+            excess = count - self.max_entries
+            if excess <= 0:
+                return 0
+            self._connection.execute(
+                "DELETE FROM scores WHERE rowid IN "
+                "(SELECT rowid FROM scores ORDER BY used LIMIT ?)",
+                (excess,),
+            )
+        return excess
+
+    def close(self):
+        """ Closes database connection """
+        self._connection.close()
@@ -32,16 +32,289 @@ SOFTWARE.
 from __future__ import absolute_import, division, print_function
 from . import paths
 from .file_processing import which
+import collections
+import itertools
 import os
 import warnings
 import tempfile
 import pickle
 import subprocess
+import threading
 from sys import version_info
 from mhcnames import parse_allele_name
 
 neoepiscope_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# mhcnuggets predicts within this process, and its models are not safe to
+#   share across threads; most recently used models are kept loaded
+_mhcnuggets_lock = threading.Lock()
+_mhcnuggets_models = collections.OrderedDict()
+_mhcnuggets_model_cache_size = 16
+
+# Allele names that tools take as given, bypassing availableAlleles.pickle
+_native_alleles = {
+    "netMHC4": set(["BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2C", "BoLA-T2a", "BoLA-T2b"]),
+    "netMHCcons1": set(
+        [
+            "BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2C", "BoLA-T2a", "BoLA-T2b",
+            "BoLA-T2c", "Mamu-AG:01",
+        ]
+    ),
+    "netMHCIIpan3": set(["DRB5_0108N"]),
+    "netMHCIIpan4": set(["DRB5_0108N"]),
+    "netMHCpan3": set(
+        [
+            "BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2a", "BoLA-T2b", "BoLA-T2c",
+            "H-2-Qa1", "H-2-Qa2", "Mamu-AG:01",
+        ]
+    ),
+    "netMHCpan4": set(
+        [
+            "BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2C", "BoLA-T2a", "BoLA-T2b",
+            "BoLA-T2c", "Chi-B0401", "Chi-B1201", "Chi-B1501", "H-2-Qa1",
+            "H-2-Qa2", "H2-Qa1", "H2-Qa2", "Mamu-A01", "Mamu-A02", "Mamu-A03",
+            "Mamu-A04", "Mamu-A06", "Mamu-A07", "Mamu-A11", "Mamu-A19",
+            "Mamu-A21", "Mamu-A23", "Mamu-A24", "Mamu-A25", "Mamu-A26",
+            "Mamu-A28", "Mamu-AG:01", "Mamu-B01", "Mamu-B02", "Mamu-B03",
+            "Mamu-B04", "Mamu-B05", "Mamu-B07", "Mamu-B08", "Mamu-B12",
+            "Mamu-B17", "Mamu-B19", "Mamu-B20", "Mamu-B21", "Mamu-B22",
+            "Mamu-B24", "Mamu-B27", "Mamu-B28", "Mamu-B36", "Mamu-B37",
+            "Mamu-B38", "Mamu-B39", "Mamu-B40", "Mamu-B41", "Mamu-B43",
+            "Mamu-B44", "Mamu-B45", "Mamu-B46", "Mamu-B47", "Mamu-B48",
+            "Mamu-B49", "Mamu-B52", "Mamu-B53", "Mamu-B55", "Mamu-B57",
+            "Mamu-B61", "Mamu-B63", "Mamu-B64", "Mamu-B65", "Mamu-B66",
+            "Mamu-B67", "Mamu-B69", "Mamu-B70", "Mamu-B71",
+        ]
+    ),
+    "netMHCpan4_1": set(
+        [
+            "BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2a", "BoLA-T2b", "BoLA-T2c",
+            "BoLA-amani.1", "BoLA-gb1.7", "H-2-Qa1", "H-2-Qa2", "H2-Qa1",
+            "H2-Qa2", "Mamu-AG:01",
+        ]
+    ),
+    "netMHCstabpan1": set(
+        [
+            "BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2a", "BoLA-T2b", "BoLA-T2c",
+            "H-2-Qa1", "H-2-Qa2", "Mamu-AG:01",
+        ]
+    ),
+    "pickpocket1": set(
+        [
+            "BoLA-D18.4", "BoLA-JSP.1", "BoLA-T2a", "BoLA-T2b", "BoLA-T2c",
+            "Mamu-AG:01",
+        ]
+    ),
+}
+# availableAlleles.pickle, loaded by _allele_tables(), and answers of
+#   resolve_allele()
+_available_alleles = None
+_resolved_alleles = {}
+_allele_lock = threading.Lock()
+
+# Binding prediction tools neoepiscope can run, keyed by tool name; see
+#   register_predictor()
+_predictors = collections.OrderedDict()
+
+# Failures of one tool run that a rerun may avoid: the tool exits with an
+#   error, or exits cleanly but leaves output that is truncated or empty,
+#   which parsers report as RuntimeError, IndexError, or ValueError
+_chunk_errors = (
+    subprocess.CalledProcessError,
+    OSError,
+    IOError,
+    RuntimeError,
+    IndexError,
+    ValueError,
+)
+
+# MHCflurry's affinity predictor, loaded by _mhcflurry_predictor(); False if
+#   MHCflurry cannot be imported
+_mhcflurry_affinity_predictor = None
+_mhcflurry_lock = threading.Lock()
+
+
+def _allele_tables():
+    """ Loads availableAlleles.pickle, once per process
+
+        Return value: dictionary linking tools to dictionaries linking
+            parsed alleles to tools' names for them
+    """
+    global _available_alleles
+    with _allele_lock:
+        if _available_alleles is None:
+            with open(
+                os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
+                "rb",
+            ) as allele_stream:
+                _available_alleles = pickle.load(allele_stream)
+        return _available_alleles
+
+
+def resolve_allele(tool, allele):
+    """ Finds a binding prediction tool's name for an allele, remembering
+        each answer
+
+        tool: tool's key in availableAlleles.pickle, e.g. netMHCpan4
+        allele: allele (string)
+
+        Return value: tool's name for allele, or None if tool does not
+            support allele
+    """
+    if (tool, allele) not in _resolved_alleles:
+        if allele in _native_alleles.get(tool, ()):
+            tool_allele = allele
+        else:
+            # Parse allele format
+            try:
+                allele_format = parse_allele_name(allele)
+            except:
+                allele_format = None
+            tool_allele = _allele_tables()[tool].get(allele_format)
+        _resolved_alleles[(tool, allele)] = tool_allele
+    return _resolved_alleles[(tool, allele)]
+
+
+def unsupported_alleles(tool_dict, hla_alleles):
+    """ Finds alleles that binding prediction tools cannot score
+
+        tool_dict: dictionary storing prediction tool data
+        hla_alleles: list of HLA alleles
+
+        Return value: dictionary linking each tool in tool_dict to a list
+            of alleles it does not support; tools without a record in
+            availableAlleles.pickle are left out
+    """
+    allele_tables = _allele_tables()
+    unsupported = {}
+    for tool in tool_dict:
+        keys = _predictors[tool].allele_tables if tool in _predictors else None
+        if keys is None or not all([key in allele_tables for key in keys]):
+            continue
+        unsupported[tool] = [
+            allele
+            for allele in hla_alleles
+            if all([resolve_allele(key, allele) is None for key in keys])
+        ]
+    return unsupported
+
+
+class Predictor(object):
+    """ A binding prediction tool: how to find and run it, and what it can
+        score. gather_binding_scores() applies caching, chunking, and
+        concurrency to every tool alike, guided by these capabilities.
+    """
+
+    def __init__(
+        self,
+        name,
+        program,
+        versions,
+        scoring,
+        score,
+        locate,
+        allele_tables=None,
+        lengths=(None, None),
+        max_batch=None,
+        multi_allele=False,
+        in_process=False,
+        tensorflow=False,
+        unsupported=None,
+    ):
+        """ Describes a tool
+
+            name: name of tool, including version, e.g. netMHCpan4; a key
+                of tool dictionaries and part of output column names
+            program: name of tool as given to neoepiscope call -p, e.g.
+                netMHCpan; matched case-insensitively
+            versions: list of versions as given to -p, e.g. ["4", "4.0"]
+            scoring: list of scoring methods tool supports
+            score: function taking (list of peptides, list of alleles,
+                tool dictionary entry, list of peptide sizes) and returning
+                a list of lists of tuples, one list per allele, each tuple
+                a peptide followed by its scores in order of sorted
+                scoring methods
+            locate: function returning path to tool's executable, or None
+                if tool is not installed
+            allele_tables: list of keys of availableAlleles.pickle that
+                record alleles tool supports (across MHC classes), or None
+                if unrecorded
+            lengths: (shortest, longest) peptide lengths tool can score,
+                with None for no limit
+            max_batch: most peptides to pass tool in one run, or None for
+                no limit
+            multi_allele: True if tool scores several alleles in one run
+            in_process: True, or a function returning True, if tool
+                predicts within this process; its runs then go on the
+                calling thread, with all alleles at once
+            tensorflow: True if tool needs TensorFlow
+            unsupported: message explaining why tool may not be used, or
+                None
+        """
+        self.name = name
+        self.program = program
+        self.versions = versions
+        self.scoring = scoring
+        self.score = score
+        self.locate = locate
+        self.allele_tables = allele_tables
+        self.lengths = lengths
+        self.max_batch = max_batch
+        self.multi_allele = multi_allele
+        self.in_process = in_process
+        self.tensorflow = tensorflow
+        self.unsupported = unsupported
+
+    def predicts_in_process(self):
+        """ Checks whether tool predicts within this process
+
+            Return value: True if tool predicts within this process
+        """
+        if callable(self.in_process):
+            return self.in_process()
+        return self.in_process
+
+
+def register_predictor(predictor):
+    """ Makes a binding prediction tool available to neoepiscope, replacing
+        any registered under the same name
+
+        predictor: Predictor object
+
+        No return value.
+    """
+    _predictors[predictor.name] = predictor
+
+
+def _locate(path, default):
+    """ Finds a tool's executable
+
+        path: path to executable from paths module, or None
+        default: name of executable to try if path is None
+
+        Return value: path to executable, or None if it cannot be run
+    """
+    if path is None:
+        return which(default)
+    return which(path)
+
+
+def _locate_PSSMHCpan():
+    """ Finds PSSMHCpan's perl script
+
+        Return value: path to script, or None if it is not installed
+    """
+    if paths.PSSMHCpan1 is None:
+        return None
+    program = os.path.join(paths.PSSMHCpan1, "PSSMHCpan-1.0.pl")
+    if not os.path.isfile(program):
+        warnings.warn(
+            "Cannot locate perl script PSSMHCpan-1.0.pl for PSSMHCpan version 1",
+            Warning,
+        )
+        return None
+    return program
+
 
 def get_binding_tools(binding_tool_list):
     """ Processes user-specified binding tools to ensure usability
@@ -61,625 +334,294 @@ def get_binding_tools(binding_tool_list):
         program = tool[0]
         version = tool[1]
         scoring = tool[2].split(",")
-        if "mhcflurry" in program.lower():
-            if version_info[0] == 3 and version_info[1] == 7:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "MHCflurry uses TensorFlow, which currently has",
-                            "limited compatibility with python 3.7 - please",
-                            "use an earlier version of python or choose a",
-                            "different binding prediction tool."
-                        ]
-                    )
-                )
-            if version == "1" and "mhcflurry1" not in tool_dict:
-                program = "mhcflurry-predict"
-                acceptable_scoring = ["rank", "affinity", "high", "low"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with MHCflurry"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    tool_dict["mhcflurry1"] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                    "for MHCflurry version", version,
-                                    "- will not use this tool for",
-                                    "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "mhcflurry1" in tool_dict:
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of MHCflurry given"
-                )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of MHCflurry",
-                        ]
-                    )
+        # Match the most specific program name, e.g. netMHCIIpan over netMHC
+        matches = [
+            predictor
+            for predictor in _predictors.values()
+            if predictor.program.lower() in program.lower()
+        ]
+        if not matches:
+            raise NotImplementedError(
+                " ".join(
+                    [
+                        "neoepiscope does not support",
+                        program,
+                        "for binding predictions",
+                    ]
                 )
-        elif "mhcnuggets" in program.lower():
-            if version_info[0] == 3 and version_info[1] == 7:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "MHCnuggets uses TensorFlow, which currently has",
-                            "limited compatibility with python 3.7 - please",
-                            "use an earlier version of python or choose a",
-                            "different binding prediction tool."
-                        ]
-                    )
+            )
+        longest = max([len(predictor.program) for predictor in matches])
+        matches = [
+            predictor for predictor in matches if len(predictor.program) == longest
+        ]
+        program = matches[0].program
+        matches = [predictor for predictor in matches if version in predictor.versions]
+        if not matches:
+            raise NotImplementedError(
+                " ".join(
+                    ["neoepiscope does not support version", version, "of", program]
                 )
-            if version == "2" and "mhcnuggets2" not in tool_dict:
-                program = "NA"
-                acceptable_scoring = ["affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join(
-                                [method, "not compatible with MHCnuggets"]
-                            ),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    tool_dict["mhcnuggets2"] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                    "for MHCnuggets version", version,
-                                    "- will not use this tool for",
-                                    "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "mhcnuggets2" in tool_dict:
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of MHCnuggets given"
+            )
+        predictor = matches[0]
+        if predictor.unsupported is not None:
+            raise NotImplementedError(predictor.unsupported)
+        if predictor.tensorflow and version_info[0] == 3 and version_info[1] == 7:
+            raise NotImplementedError(
+                " ".join(
+                    [
+                        program,
+                        "uses TensorFlow, which currently has",
+                        "limited compatibility with python 3.7 - please",
+                        "use an earlier version of python or choose a",
+                        "different binding prediction tool.",
+                    ]
                 )
+            )
+        if predictor.name in tool_dict:
+            raise RuntimeError(
+                " ".join(["Conflicting or repetitive installs of", program, "given"])
+            )
+        executable = predictor.locate()
+        if executable is None:
+            warnings.warn(
+                " ".join(
+                    ["No valid install of", program, "version", version, "available"]
+                ),
+                Warning,
+            )
+            continue
+        compatible_scoring = []
+        for method in scoring:
+            if method in predictor.scoring:
+                compatible_scoring.append(method)
             else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of MHCnuggets",
-                        ]
-                    )
-                )
-        elif "netmhciipan" in program.lower():
-            if (version == "3" and "netMHCIIpan3" not in tool_dict) or (
-                version == "4" and "netMHCIIpan4" not in tool_dict
-            ):
-                if version == "3":
-                    program = paths.netMHCIIpan3
-                    if program is None:
-                        program = which("netMHCIIpan3")
-                    else:
-                        program = which(program)
-                elif version == "4":
-                    program = paths.netMHCIIpan4
-                    if program is None:
-                        program = which("netMHCIIpan4")
-                    else:
-                        program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            ["No valid install of", "netMHCIIpan available"]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["rank", "affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join(
-                                [method, "not compatible with netMHCIIpan"]
-                            ),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "3":
-                        name = "netMHCIIpan3"
-                    elif version == "4":
-                        name = "netMHCIIpan4"          
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for netMHCIIpan version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif ("netMHCIIpan3" in tool_dict and version == "3") or (
-                  "netMHCIIpan4" in tool_dict and version == "4"
-            ):
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of netMHCIIpan given"
+                warnings.warn(
+                    " ".join([method, "not compatible with", program]), Warning
                 )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of netMHCIIpan",
-                        ]
-                    )
+        if compatible_scoring:
+            tool_dict[predictor.name] = [executable, sorted(compatible_scoring)]
+        else:
+            warnings.warn(
+                " ".join(
+                    [
+                        "No compatible scoring methods given",
+                        "for",
+                        program,
+                        "version",
+                        version,
+                        "- will not use this tool for",
+                        "binding predictions",
+                    ]
+                ),
+                Warning,
+            )
+    return tool_dict
+
+
+def _length_buckets(peptides):
+    """ Groups peptides by length
+
+        peptides: list of peptides
+
+        Return value: dictionary linking peptide lengths to lists of
+            peptides of that length, in the order given
+    """
+    buckets = collections.defaultdict(list)
+    for peptide in peptides:
+        buckets[len(peptide)].append(peptide)
+    return buckets
+
+
+def _resolve_alleles(tool, name, alleles):
+    """ Finds a tool's names for several alleles, warning about those it
+        does not support
+
+        tool: tool's key in availableAlleles.pickle, e.g. netMHCpan4
+        name: name of tool for warnings
+        alleles: list of alleles
+
+        Return value: list of tool's names for alleles, with None for each
+            allele tool does not support
+    """
+    tool_alleles = []
+    for allele in alleles:
+        tool_allele = resolve_allele(tool, allele)
+        if tool_allele is None:
+            warnings.warn(
+                " ".join([allele, "is not a valid allele for", name]), Warning
+            )
+        tool_alleles.append(tool_allele)
+    return tool_alleles
+
+
+def _read_xls_scores(xls_file, allele_count, columns, line_count=None):
+    """ Reads scores from -xls output of netMHC-family tools, which give
+        each allele a block of columns headed by its name in the first line
+
+        xls_file: path to -xls output
+        allele_count: number of alleles passed to tool
+        columns: dictionary linking scoring methods to their columns in
+            output for a single allele
+        line_count: number of peptide lines to read, or None for all
+
+        Return value: list of tuples (peptide, list of dictionaries linking
+            scoring methods to scores, one per allele in order given)
+    """
+    rows = []
+    with open(xls_file, "r") as f:
+        allele_line = f.readline().strip("\n").split("\t")
+        f.readline()
+        # Shift columns by distance of each allele's block from the first
+        starts = [i for i, token in enumerate(allele_line) if token.strip()]
+        if allele_count == 1:
+            offsets = [0]
+        elif len(starts) == allele_count:
+            offsets = [start - starts[0] for start in starts]
+        else:
+            raise RuntimeError(
+                " ".join(
+                    [
+                        "Cannot find columns for",
+                        str(allele_count),
+                        "alleles in",
+                        xls_file,
+                    ]
                 )
-        elif "netmhcii" in program.lower():
-            if version == "2" and "netMHCII2" not in tool_dict:
-                program = paths.netMHCII2
-                if program is None:
-                    program = which("netMHCII2")
-                else:
-                    program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            ["No valid install of", "netMHCII available"]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["rank", "affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join(
-                                [method, "not compatible with netMHCII"]
-                            ),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    tool_dict["netMHCII2"] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for netMHCII version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
+            )
+        for line in f:
+            if line_count is not None and len(rows) == line_count:
+                break
+            tokens = line.strip("\n").split("\t")
+            rows.append(
+                (
+                    tokens[1],
+                    [
+                        dict(
+                            [(method, tokens[column + offset])
+                             for method, column in columns.items()]
                         )
-            elif "netMHCII2" in tool_dict:
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of netMHCII given"
-                )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of netMHCII",
-                        ]
-                    )
+                        for offset in offsets
+                    ],
                 )
-        elif "netmhcpan" in program.lower():
-            if ("netMHCpan3" not in tool_dict and version == "3") or (
-                "netMHCpan4" not in tool_dict and (version == "4" or version == "4.0")) or (
-                "netMHCpan4_1" not in tool_dict and version == "4.1"
-            ):
-                if version == "3":
-                    program = paths.netMHCpan3
-                    if program is None:
-                        program = which("netMHCpan3")
-                    else:
-                        program = which(program)
-                elif version == "4" or version == "4.0":
-                    program = paths.netMHCpan4
-                    if program is None:
-                        program = which("netMHCpan4")
-                    else:
-                        program = which(program)
-                elif version == "4.1":
-                    program = paths.netMHCpan4_1
-                    if program is None:
-                        program = which("netMHCpan4.1")
+            )
+    if line_count is not None and len(rows) < line_count:
+        raise RuntimeError(
+            " ".join(["Missing peptides in binding predictions in", xls_file])
+        )
+    return rows
+
+
+def get_affinities_netMHCIIpan(
+    peptides, alleles, netmhciipan, version, scores, remove_files=True
+):
+    """ Obtains binding affinities for several alleles from one run of
+        netMHCIIpan
+
+        peptides: peptides of interest (list of strings)
+        alleles: list of alleles to use for binding affinity
+        netmhciipan: path to netMHCIIpan executable
+        version: version of netMHCIIpan
+        scores: list of scoring methods
+        remove_files: option to remove intermediate files
+
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its scores
+    """
+    files_to_remove = []
+    try:
+        # Check that alleles are valid for method
+        tool_alleles = _resolve_alleles(
+            "".join(["netMHCIIpan", str(version)]), "netMHCIIpan", alleles
+        )
+        run_alleles = sorted(set([x for x in tool_alleles if x is not None]))
+        score_dicts = dict([(allele, {}) for allele in run_alleles])
+        if run_alleles:
+            # Establish sample id
+            sample_id = ".".join(
+                [
+                    peptides[0],
+                    str(len(peptides)),
+                    "_".join(run_alleles),
+                    "netmhciipan",
+                    version,
+                ]
+            )
+            # Write one peptide per line to a temporary file for
+            #   input if peptide length is at least 9
+            # Count instances of smaller peptides
+            na_count = 0
+            peptide_file = tempfile.mkstemp(
+                suffix=".peptides", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(peptide_file)
+            with open(peptide_file, "w") as f:
+                for sequence in peptides:
+                    if len(sequence) >= 9:
+                        print(sequence, file=f)
                     else:
-                        program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "No valid install of",
-                                "netMHCpan version",
-                                version,
-                                "available",
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["rank", "affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with netMHCpan"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "3":
-                        name = "netMHCpan3"
-                    elif version == "4":
-                        name = "netMHCpan4"
-                    elif version == "4.1":
-                        name = "netMHCpan4_1"
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for NetMHCpan version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif ("netMHCpan3" in tool_dict and version == "3") or (
-                  "netMHCpan4" in tool_dict and version == "4") or (
-                  "netMHCpan4_1" in tool_dict and version == "4.1"
-            ):
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of netMHCpan given"
-                )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of netMHCpan",
-                        ]
-                    )
-                )
-        elif "netmhccons" in program.lower():
-            raise NotImplementedError("Binding predictions with netMHCcons "
-                                      "not currently supported due to instability"
-                                      " of predictions - support for netMHCcons "
-                                      "may be included in future releases.")
-            if "netMHCcons1" not in tool_dict and version == "1":
-                program = paths.netMHCcons1
-                if program is None:
-                    program = which("netMHCcons1")
-                else:
-                    program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "No valid install of",
-                                "netMHCcons version",
-                                version,
-                                "available",
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["rank", "affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with netMHCcons"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "1":
-                        name = "netMHCcons1"
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for NetMHCcons version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "netMHCcons1" in tool_dict and version == "1":
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of netMHCcons given"
-                )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of netMHCcons",
-                        ]
-                    )
-                )
-        elif "netmhcstabpan" in program.lower():
-            if "netMHCstabpan1" not in tool_dict and version == "1":
-                program = paths.netMHCstabpan1
-                if program is None:
-                    program = which("netMHCstabpan1")
-                else:
-                    program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "No valid install of",
-                                "netMHCstabpan version",
-                                version,
-                                "available",
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["rank_affinity", "affinity", "rank_stability", 
-                                      "stability", "rank_combined", "combined"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with netMHCstabpan"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "1":
-                        name = "netMHCstabpan1"
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for NetMHCstabpan version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "netMHCstabpan1" in tool_dict and version == "1":
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of netMHCstabpan given"
-                )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of netMHCstabpan",
-                        ]
-                    )
-                )
-        elif "netmhc" in program.lower():
-            if "netMHC4" not in tool_dict and version == "4":
-                program = paths.netMHC4
-                if program is None:
-                    program = which("netMHC4")
-                else:
-                    program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "No valid install of",
-                                "netMHC version",
-                                version,
-                                "available",
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["rank", "affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with netMHC"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "4":
-                        name = "netMHC4"
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for NetMHC version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "netMHC4" in tool_dict and version == "4":
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of netMHC given"
-                )
-            else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of netMHC",
-                        ]
-                    )
-                )
-        elif "pickpocket" in program.lower():
-            if "pickpocket1" not in tool_dict and version == "1":
-                program = paths.PickPocket1
-                if program is None:
-                    program = which("pickpocket1")
-                else:
-                    program = which(program)
-                if program is None:
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "No valid install of",
-                                "PickPocket version",
-                                version,
-                                "available",
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with PickPocket"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "1":
-                        name = "pickpocket1"
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for PickPocket version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "pickpocket1" in tool_dict and version == "1":
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of PickPocket given"
-                )
-            else:
-                raise NotImplementedError(
+                        na_count += 1
+            if na_count > 0:
+                warnings.warn(
                     " ".join(
                         [
-                            "neoepiscope does not support version",
-                            version,
-                            "of PickPocket",
+                            str(na_count),
+                            "peptides not compatible with",
+                            "netMHCIIpan will not receive score",
                         ]
-                    )
-                )
-        elif "pssmhcpan" in program.lower():
-            if "pssmhcpan" not in tool_dict and version == "1":
-                program_dir = paths.PSSMHCpan1
-                if program_dir is None:
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "No valid install of",
-                                "PSSMHCpan version",
-                                version,
-                                "available",
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                program = os.path.join(program_dir, "PSSMHCpan-1.0.pl")
-                if not os.path.isfile(program):
-                    warnings.warn(
-                        " ".join(
-                            [
-                                "Cannot locate perl script PSSMHCpan-1.0.pl",
-                                "for PSSMHCpan version",
-                                version,
-                            ]
-                        ),
-                        Warning,
-                    )
-                    continue
-                acceptable_scoring = ["affinity"]
-                for method in scoring:
-                    if method not in acceptable_scoring:
-                        warnings.warn(
-                            " ".join([method, "not compatible with PSSMHCpan"]),
-                            Warning,
-                        )
-                        scoring.remove(method)
-                if len(scoring) > 0:
-                    if version == "1":
-                        name = "PSSMHCpan1"
-                    tool_dict[name] = [program, sorted(scoring)]
-                else:
-                    warnings.warn(
-                            " ".join(
-                                [
-                                    "No compatible scoring methods given",
-                                      "for PSSMHCpan version", version,
-                                      "- will not use this tool for",
-                                      "binding predictions"
-                                ]
-                            ),
-                            Warning,
-                        )
-            elif "PSSMHCpan1" in tool_dict and version == "1":
-                raise RuntimeError(
-                    "Conflicting or repetitive installs of PSSMHCpan given"
+                    ),
+                    Warning,
                 )
+            # Establish temporary file to hold output
+            mhc_out = tempfile.mkstemp(
+                suffix=".netMHCIIpan.out", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(mhc_out)
+            # Run netMHCIIpan on all alleles at once
+            command = [netmhciipan]
+            if version == "4":
+                command.append("-BA")
+            subprocess.check_call(
+                command
+                + [
+                    "-a",
+                    ",".join(run_alleles),
+                    "-inptype",
+                    "1",
+                    "-xls",
+                    "-xlsfile",
+                    mhc_out,
+                    "-f",
+                    peptide_file,
+                ]
+            )
+            # Retrieve scores for valid peptides
+            # For v3, token 4 is affinity and token 5 is rank; for v4,
+            #   tokens 7 and 8
+            if version == "3":
+                columns = {"affinity": 4, "rank": 5}
             else:
-                raise NotImplementedError(
-                    " ".join(
-                        [
-                            "neoepiscope does not support version",
-                            version,
-                            "of PSSMHCpan",
-                        ]
+                columns = {"affinity": 7, "rank": 8}
+            for peptide, results in _read_xls_scores(
+                mhc_out, len(run_alleles), columns
+            ):
+                for allele, result_dict in zip(run_alleles, results):
+                    score_dicts[allele][peptide] = tuple(
+                        [result_dict[value] for value in sorted(scores)]
                     )
-                )
-        else:
-            raise NotImplementedError(
-                " ".join(
-                    [
-                        "neoepiscope does not support",
-                        program,
-                        "for binding predictions",
-                    ]
-                )
-            )
-    return tool_dict
+        # Produce list of scores for valid peptides
+        # Invalid peptides receive "NA" score
+        na_scores = tuple(["NA" for i in range(len(scores))])
+        return [
+            [
+                (sequence,) + score_dicts.get(allele, {}).get(sequence, na_scores)
+                for sequence in peptides
+            ]
+            for allele in tool_alleles
+        ]
+    finally:
+        if remove_files:
+            for file_to_remove in files_to_remove:
+                os.remove(file_to_remove)
 
 
 def get_affinity_netMHCIIpan(
@@ -697,143 +639,122 @@ def get_affinity_netMHCIIpan(
         Return value: affinities (a list of binding affinities
                         as strings)
     """
-    files_to_remove = []
-    try:
-        # Check that allele is valid for method
-        with open(
-            os.path.join(
-                os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle")
-            ),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Homogenize format if needed
-        if allele != 'DRB5_0108N':
-            # Parse allele format
+    return get_affinities_netMHCIIpan(
+        peptides, [allele], netmhciipan, version, scores, remove_files
+    )[0]
+
+
+def _mhcflurry_allele(allele):
+    """ Finds MHCflurry's name for an allele
+
+        allele: Allele to use for binding affinity (string)
+
+        Return value: MHCflurry's name for allele, or None if MHCflurry
+            does not support it
+    """
+    mhcflurry_allele = resolve_allele("mhcflurry", allele)
+    if mhcflurry_allele is not None:
+        return mhcflurry_allele
+    warnings.warn(
+        " ".join([allele, "is not a valid allele for mhcflurry"]), Warning
+    )
+    return None
+
+
+def _mhcflurry_predictor():
+    """ Loads MHCflurry's affinity predictor, once per process
+
+        Return value: Class1AffinityPredictor object, or None if MHCflurry
+            cannot be imported here, in which case mhcflurry-predict is
+            run instead
+    """
+    global _mhcflurry_affinity_predictor
+    with _mhcflurry_lock:
+        if _mhcflurry_affinity_predictor is None:
             try:
-                allele_format = parse_allele_name(allele)
-            except:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCIIpan"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-            # Store valid allele format if available
-            if allele_format in avail_alleles["".join(["netMHCIIpan", str(version)])]:
-                allele = avail_alleles["".join(["netMHCIIpan", str(version)])][allele_format]
+                from mhcflurry import Class1AffinityPredictor
+            except ImportError:
+                _mhcflurry_affinity_predictor = False
             else:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCIIpan"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Establish return list and sample id
-        sample_id = ".".join(
-            [peptides[0], str(len(peptides)), allele, "netmhciipan", version]
-        )
-        affinities = []
-        # Write one peptide per line to a temporary file for
-        #   input if peptide length is at least 9
-        # Count instances of smaller peptides
-        na_count = 0
-        peptide_file = tempfile.mkstemp(
-            suffix=".peptides", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(peptide_file)
-        with open(peptide_file, "w") as f:
-            for sequence in peptides:
-                if len(sequence) >= 9:
-                    print(sequence, file=f)
-                else:
-                    na_count += 1
+                _mhcflurry_affinity_predictor = Class1AffinityPredictor.load()
+        return _mhcflurry_affinity_predictor or None
+
+
+def get_affinities_mhcflurry(peptide_lists, alleles, scores):
+    """ Obtains binding affinities for several alleles at once from
+        MHCflurry's predictor, loaded in this process
+
+        peptide_lists: list of lists of peptides, one per allele
+        alleles: list of alleles to use for binding affinity
+        scores: list of scoring methods
+
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its scores
+    """
+    predictor = _mhcflurry_predictor()
+    # Queue valid peptides for all alleles in one batch
+    query_peptides, query_alleles, offsets = [], [], []
+    for peptides, allele in zip(peptide_lists, alleles):
+        offsets.append(len(query_peptides))
+        mhcflurry_allele = _mhcflurry_allele(allele)
+        if mhcflurry_allele is None:
+            continue
+        valid_peptides = [x for x in peptides if 8 <= len(x) <= 15]
+        na_count = len(peptides) - len(valid_peptides)
         if na_count > 0:
             warnings.warn(
                 " ".join(
                     [
                         str(na_count),
                         "peptides not compatible with",
-                        "netMHCIIpan will not receive score",
-                    ]
-                ),
-                Warning,
-            )
-        # Establish temporary file to hold output
-        mhc_out = tempfile.mkstemp(
-            suffix=".netMHCIIpan.out", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(mhc_out)
-        # Run netMHCIIpan
-        if version == "3":
-            subprocess.check_call(
-                [
-                    netmhciipan,
-                    "-a",
-                    allele,
-                    "-inptype",
-                    "1",
-                    "-xls",
-                    "-xlsfile",
-                    mhc_out,
-                    "-f",
-                    peptide_file,
-                ]
+                        "mhcflurry will not receive score",
+                    ]
+                ),
+                Warning,
             )
-        elif version == "4":
-            subprocess.check_call(
-                [
-                    netmhciipan,
-                    "-BA",
-                    "-a",
-                    allele,
-                    "-inptype",
-                    "1",
-                    "-xls",
-                    "-xlsfile",
-                    mhc_out,
-                    "-f",
-                    peptide_file,
-                ]
+        query_peptides.extend(valid_peptides)
+        query_alleles.extend([mhcflurry_allele] * len(valid_peptides))
+    offsets.append(len(query_peptides))
+    results = []
+    if query_peptides:
+        with _mhcflurry_lock:
+            predictions = predictor.predict_to_dataframe(
+                peptides=query_peptides,
+                alleles=query_alleles,
+                include_percentile_ranks=True,
+                include_confidence_intervals=True,
+                throw=False,
             )
-        # Retrieve scores for valid peptides
-        score_dict = {}
-        with open(mhc_out, "r") as f:
-            # Skip headers
-            f.readline()
-            f.readline()
-            for line in f:
-                # token 1 is peptide; token 4 is affinity; token[5] is rank
-                tokens = line.strip("\n").split("\t")
-                if version == "3":
-                    if sorted(scores) == ["affinity", "rank"]:
-                        score_dict[tokens[1]] = (tokens[4], tokens[5])
-                    elif sorted(scores) == ["affinity"]:
-                        score_dict[tokens[1]] = (tokens[4],)
-                    elif sorted(scores) == ["rank"]:
-                        score_dict[tokens[1]] = (tokens[5],)
-                elif version == "4":
-                    if sorted(scores) == ["affinity", "rank"]:
-                        score_dict[tokens[1]] = (tokens[7], tokens[8])
-                    elif sorted(scores) == ["affinity"]:
-                        score_dict[tokens[1]] = (tokens[7],)
-                    elif sorted(scores) == ["rank"]:
-                        score_dict[tokens[1]] = (tokens[8],)
-        # Produce list of scores for valid peptides
-        # Invalid peptides receive "NA" score
-        for sequence in peptides:
-            if sequence in score_dict:
-                nM = (sequence,) + score_dict[sequence]
-            else:
-                nM = (sequence, ) + tuple(['NA' for i in range(len(scores))])
-            affinities.append(nM)
-        return affinities
-    finally:
-        if remove_files:
-            for file_to_remove in files_to_remove:
-                os.remove(file_to_remove)
+        # Rows come back in query order; NaN marks an unscored peptide
+        for values in zip(
+            predictions["prediction"],
+            predictions["prediction_low"],
+            predictions["prediction_high"],
+            predictions["prediction_percentile"],
+        ):
+            result_dict = dict(
+                zip(
+                    ["affinity", "low", "high", "rank"],
+                    ["NA" if value != value else str(value) for value in values],
+                )
+            )
+            results.append(tuple([result_dict[value] for value in sorted(scores)]))
+    # Produce list of scores for valid peptides of each allele
+    # Invalid peptides receive "NA" score
+    affinities = []
+    for i, peptides in enumerate(peptide_lists):
+        start, end = offsets[i], offsets[i + 1]
+        score_dict = dict(zip(query_peptides[start:end], results[start:end]))
+        na_scores = tuple(["NA" for j in range(len(scores))])
+        affinities.append(
+            [(sequence,) + score_dict.get(sequence, na_scores) for sequence in peptides]
+        )
+    return affinities
 
 
 def get_affinity_mhcflurry(peptides, allele, scores, version, remove_files=True):
-    """ Obtains binding affinities from list of peptides
+    """ Obtains binding affinities from list of peptides by running
+        mhcflurry-predict
 
         peptides: peptides of interest (list of strings)
         allele: Allele to use for binding affinity (string)
@@ -846,28 +767,8 @@ def get_affinity_mhcflurry(peptides, allele, scores, version, remove_files=True)
     """
     files_to_remove = []
     try:
-        # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Parse allele format
-        try:
-            allele_format = parse_allele_name(allele)
-        except:
-            warnings.warn(
-                " ".join([allele, "is not a valid allele for mhcflurry"]), Warning
-            )
-            score_form = tuple(["NA" for i in range(0, len(scores))])
-            return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Store valid allele format if available
-        if allele_format in avail_alleles['mhcflurry']:
-            allele = avail_alleles['mhcflurry'][allele_format]
-        else:
-            warnings.warn(
-                " ".join([allele, "is not a valid allele for mhcflurry"]), Warning
-            )
+        allele = _mhcflurry_allele(allele)
+        if allele is None:
             score_form = tuple(["NA" for i in range(0, len(scores))])
             return [(peptides[i],) + score_form for i in range(0, len(peptides))]
         # Establish return list and sample id
@@ -940,102 +841,94 @@ def get_affinity_mhcflurry(peptides, allele, scores, version, remove_files=True)
                 os.remove(file_to_remove)
 
 
-def get_affinity_netMHC(
-    peptides, allele, netmhc, version, scores, remove_files=True
+def get_affinities_netMHC(
+    peptides, alleles, netmhc, version, scores, remove_files=True
 ):
-    """ Obtains binding affinities from list of peptides
+    """ Obtains binding affinities for several alleles from one run of
+        netMHC
 
         peptides: peptides of interest (list of strings)
-        allele: allele to use for binding affinity
-                    (string, format HLA-A02:01)
+        alleles: list of alleles to use for binding affinity
         netmhc: path to netMHC executable
         version: version of netMHC software
         scores: list of scoring methods
         remove_files: option to remove intermediate files
 
-        Return value: affinities (a list of binding affinities
-                        as strings)
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its scores
     """
     files_to_remove = []
     try:
-        # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Homogenize format if needed
-        if allele not in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2C', 'BoLA-T2a', 'BoLA-T2b']:
-            # Parse allele format
-            try:
-                allele_format = parse_allele_name(allele)
-            except:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHC"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-            # Store valid allele format if available
-            if allele_format in avail_alleles["".join(["netMHC", str(version)])]:
-                allele = avail_alleles["".join(["netMHC", str(version)])][allele_format]
-            else:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHC"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Establish return list and sample id
-        sample_id = ".".join(
-            [peptides[0], str(len(peptides)), allele, "netmhc", version]
+        # Check that alleles are valid for method
+        tool_alleles = _resolve_alleles(
+            "".join(["netMHC", str(version)]), "netMHC", alleles
         )
-        affinities = []
-        # Write one peptide per line to a temporary file for input
-        peptide_file = tempfile.mkstemp(
-            suffix=".peptides", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(peptide_file)
-        with open(peptide_file, "w") as f:
-            for sequence in peptides:
-                print(sequence, file=f)
-        # Establish temporary file to hold output
-        mhc_out = tempfile.mkstemp(
-            suffix=".netMHC.out", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(mhc_out)
-        err_file = tempfile.mkstemp(
-            suffix=".netMHC.err", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(err_file)
-        with open(err_file, "w") as e:
-            # Run netMHC
-            subprocess.check_call(
+        run_alleles = sorted(set([x for x in tool_alleles if x is not None]))
+        allele_scores = {}
+        if run_alleles:
+            # Establish sample id
+            sample_id = ".".join(
                 [
-                    netmhc,
-                    "-a",
-                    allele,
-                    "-inptype",
-                    "1",
-                    "-p",
-                    "-xls",
-                    "-xlsfile",
-                    mhc_out,
-                    peptide_file,
-                ],
-                stderr=e,
+                    peptides[0],
+                    str(len(peptides)),
+                    "_".join(run_alleles),
+                    "netmhc",
+                    version,
+                ]
             )
-        with open(mhc_out, "r") as f:
-            f.readline()
-            f.readline()
-            for i in range(0, len(peptides)):
-                tokens = f.readline().strip("\n").split("\t")
-                # for v4, tokens[3] is affinity, tokens[4] is rank
-                result_dict = {"affinity": tokens[3],
-                               "rank": tokens[4]}
-                nM = [peptides[i]]
-                for value in sorted(scores):
-                    nM.append(result_dict[value])
-                affinities.append(tuple(nM))
-        return affinities
+            # Write one peptide per line to a temporary file for input
+            peptide_file = tempfile.mkstemp(
+                suffix=".peptides", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(peptide_file)
+            with open(peptide_file, "w") as f:
+                for sequence in peptides:
+                    print(sequence, file=f)
+            # Establish temporary file to hold output
+            mhc_out = tempfile.mkstemp(
+                suffix=".netMHC.out", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(mhc_out)
+            err_file = tempfile.mkstemp(
+                suffix=".netMHC.err", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(err_file)
+            with open(err_file, "w") as e:
+                # Run netMHC on all alleles at once
+                command = [netmhc]
+                subprocess.check_call(
+                    command
+                    + [
+                        "-a",
+                        ",".join(run_alleles),
+                        "-inptype",
+                        "1",
+                        "-p",
+                        "-xls",
+                        "-xlsfile",
+                        mhc_out,
+                        peptide_file,
+                    ],
+                    stderr=e,
+                )
+            # For v4, token 3 is affinity and token 4 is rank
+            columns = {"affinity": 3, "rank": 4}
+            rows = _read_xls_scores(
+                mhc_out, len(run_alleles), columns, line_count=len(peptides)
+            )
+            for j, allele in enumerate(run_alleles):
+                allele_scores[allele] = [
+                    (peptides[i],)
+                    + tuple([rows[i][1][j][value] for value in sorted(scores)])
+                    for i in range(0, len(peptides))
+                ]
+        na_scores = tuple(["NA" for i in range(0, len(scores))])
+        return [
+            allele_scores.get(
+                allele, [(sequence,) + na_scores for sequence in peptides]
+            )
+            for allele in tool_alleles
+        ]
     finally:
         # Remove temporary files
         if remove_files:
@@ -1043,6 +936,27 @@ def get_affinity_netMHC(
                 os.remove(file_to_remove)
 
 
+def get_affinity_netMHC(
+    peptides, allele, netmhc, version, scores, remove_files=True
+):
+    """ Obtains binding affinities from list of peptides
+
+        peptides: peptides of interest (list of strings)
+        allele: allele to use for binding affinity
+                    (string, format HLA-A02:01)
+        netmhc: path to netMHC executable
+        version: version of netMHC software
+        scores: list of scoring methods
+        remove_files: option to remove intermediate files
+
+        Return value: affinities (a list of binding affinities
+                        as strings)
+    """
+    return get_affinities_netMHC(
+        peptides, [allele], netmhc, version, scores, remove_files
+    )[0]
+
+
 def get_affinity_netMHCstabpan(
     peptides, allele, netmhcstabpan, version, scores, size_list, remove_files=True
 ):
@@ -1062,34 +976,18 @@ def get_affinity_netMHCstabpan(
     files_to_remove = []
     try:
         # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Homogenize format if needed
-        if allele not in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2c', 'BoLA-T2a', 'BoLA-T2b', 'Mamu-AG:01', 'H-2-Qa2', 'H-2-Qa1']:
-            # Parse allele format
-            try:
-                allele_format = parse_allele_name(allele)
-            except:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCstabpan"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-            # Store valid allele format if available
-            if allele_format in avail_alleles["".join(["netMHCstabpan", str(version)])]:
-                allele = avail_alleles["".join(["netMHCstabpan", str(version)])][allele_format]
-            else:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCstabpan"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        tool_allele = resolve_allele("".join(["netMHCstabpan", str(version)]), allele)
+        if tool_allele is None:
+            warnings.warn(
+                " ".join([allele, "is not a valid allele for netMHCstabpan"]), Warning
+            )
+            score_form = tuple(["NA" for i in range(0, len(scores))])
+            return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        allele = tool_allele
         score_dict = {}
         affinities = []
-        for i in range(size_list[0], size_list[-1]+1):
+        buckets = _length_buckets(peptides)
+        for i in sorted(buckets.keys()):
             # Establish return list and sample id
             sample_id = ".".join(
                 [peptides[0], str(len(peptides)), allele, "netmhcstabpan", version, str(i)]
@@ -1100,7 +998,7 @@ def get_affinity_netMHCstabpan(
             )[1]
             files_to_remove.append(peptide_file)
             # Get peptides of correct size
-            sized_peps = [x for x in peptides if len(x) == i]
+            sized_peps = buckets[i]
             if len(sized_peps) == 0:
                 continue
             with open(peptide_file, "w") as f:
@@ -1181,31 +1079,14 @@ def get_affinity_pickpocket(
     files_to_remove = []
     try:
         # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Homogenize format if needed
-        if allele not in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2c', 'BoLA-T2a', 'BoLA-T2b', 'Mamu-AG:01']:
-            # Parse allele format
-            try:
-                allele_format = parse_allele_name(allele)
-            except:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for PickPocket"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-            # Store valid allele format if available
-            if allele_format in avail_alleles["".join(["pickpocket", str(version)])]:
-                allele = avail_alleles["".join(["pickpocket", str(version)])][allele_format]
-            else:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for PickPocket"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        tool_allele = resolve_allele("".join(["pickpocket", str(version)]), allele)
+        if tool_allele is None:
+            warnings.warn(
+                " ".join([allele, "is not a valid allele for PickPocket"]), Warning
+            )
+            score_form = tuple(["NA" for i in range(0, len(scores))])
+            return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        allele = tool_allele
         # Establish return list and sample id
         sample_id = ".".join(
             [peptides[0], str(len(peptides)), allele, "pickpocket", version]
@@ -1285,29 +1166,14 @@ def get_affinity_netMHCII(
     files_to_remove = []
     try:
         # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Parse allele format
-        try:
-            allele_format = parse_allele_name(allele)
-        except:
-            warnings.warn(
-                " ".join([allele, "is not a valid allele for netMHCII"]), Warning
-            )
-            score_form = tuple(["NA" for i in range(0, len(scores))])
-            return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Store valid allele format if available
-        if allele_format in avail_alleles["".join(["netMHCII", str(version)])]:
-            allele = avail_alleles["".join(["netMHCII", str(version)])][allele_format]
-        else:
+        tool_allele = resolve_allele("".join(["netMHCII", str(version)]), allele)
+        if tool_allele is None:
             warnings.warn(
                 " ".join([allele, "is not a valid allele for netMHCII"]), Warning
             )
             score_form = tuple(["NA" for i in range(0, len(scores))])
             return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        allele = tool_allele
         # Establish return list and sample id
         sample_id = ".".join(
             [peptides[0], str(len(peptides)), allele, "netMHCII", version]
@@ -1403,36 +1269,20 @@ def get_affinity_netMHCcons(
     files_to_remove = []
     try:
         # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Homogenize format if needed
-        if allele not in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2C', 'BoLA-T2c', 'BoLA-T2a', 'BoLA-T2b', 'Mamu-AG:01']:
-            # Parse allele format
-            try:
-                allele_format = parse_allele_name(allele)
-            except:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCcons"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-            # Store valid allele format if available
-            if allele_format in avail_alleles["".join(["netMHCcons", str(version)])]:
-                allele = avail_alleles["".join(["netMHCcons", str(version)])][allele_format]
-            else:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCcons"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        tool_allele = resolve_allele("".join(["netMHCcons", str(version)]), allele)
+        if tool_allele is None:
+            warnings.warn(
+                " ".join([allele, "is not a valid allele for netMHCcons"]), Warning
+            )
+            score_form = tuple(["NA" for i in range(0, len(scores))])
+            return [(peptides[i],) + score_form for i in range(0, len(peptides))]
+        allele = tool_allele
         # Establish score dict and return list
         score_dict = {}
         affinities = []
         # Get scores for peptides of each size
-        for i in range(size_list[0], size_list[-1]+1):
+        buckets = _length_buckets(peptides)
+        for i in sorted(buckets.keys()):
             # Sample id
             sample_id = ".".join(
                 [peptides[0], str(len(peptides)), allele, "netmhccons", version, str(i)]
@@ -1443,7 +1293,7 @@ def get_affinity_netMHCcons(
             )[1]
             files_to_remove.append(peptide_file)
             # Get peptides of correct size
-            sized_peps = [x for x in peptides if len(x) == i]
+            sized_peps = buckets[i]
             if len(sized_peps) == 0:
                 continue
             with open(peptide_file, "w") as f:
@@ -1491,9 +1341,110 @@ def get_affinity_netMHCcons(
             if peptides[i] in score_dict:
                 nM = score_dict[peptides[i]]
             else:
-                nM = (peptides[i], ) + tuple(['NA' for i in range(len(scores))])
-            affinities.append(nM)
-        return affinities
+                nM = (peptides[i], ) + tuple(['NA' for i in range(len(scores))])
+            affinities.append(nM)
+        return affinities
+    finally:
+        # Remove temporary files
+        if remove_files:
+            for file_to_remove in files_to_remove:
+                os.remove(file_to_remove)
+
+
+def get_affinities_netMHCpan(
+    peptides, alleles, netmhcpan, version, scores, remove_files=True
+):
+    """ Obtains binding affinities for several alleles from one run of
+        netMHCpan
+
+        peptides: peptides of interest (list of strings)
+        alleles: list of alleles to use for binding affinity
+        netmhcpan: path to netMHCpan executable
+        version: version of netMHCpan software
+        scores: list of scoring methods
+        remove_files: option to remove intermediate files
+
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its scores
+    """
+    files_to_remove = []
+    try:
+        # Check that alleles are valid for method
+        tool_alleles = _resolve_alleles(
+            "".join(["netMHCpan", str(version)]), "netMHCpan", alleles
+        )
+        run_alleles = sorted(set([x for x in tool_alleles if x is not None]))
+        allele_scores = {}
+        if run_alleles:
+            # Establish sample id
+            sample_id = ".".join(
+                [
+                    peptides[0],
+                    str(len(peptides)),
+                    "_".join(run_alleles),
+                    "netmhcpan",
+                    version,
+                ]
+            )
+            # Write one peptide per line to a temporary file for input
+            peptide_file = tempfile.mkstemp(
+                suffix=".peptides", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(peptide_file)
+            with open(peptide_file, "w") as f:
+                for sequence in peptides:
+                    print(sequence, file=f)
+            # Establish temporary file to hold output
+            mhc_out = tempfile.mkstemp(
+                suffix=".netMHCpan.out", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(mhc_out)
+            err_file = tempfile.mkstemp(
+                suffix=".netMHCpan.err", prefix="".join([sample_id, "."]), text=True
+            )[1]
+            files_to_remove.append(err_file)
+            with open(err_file, "w") as e:
+                # Run netMHCpan on all alleles at once
+                command = [netmhcpan]
+                if version == "4" or version == "4_1":
+                    command.append("-BA")
+                subprocess.check_call(
+                    command
+                    + [
+                        "-a",
+                        ",".join(run_alleles),
+                        "-inptype",
+                        "1",
+                        "-p",
+                        "-xls",
+                        "-xlsfile",
+                        mhc_out,
+                        peptide_file,
+                    ],
+                    stderr=e,
+                )
+            # For v3, token 5 is affinity and token 6 is rank; for v4,
+            #   tokens 6 and 7
+            if version == "3":
+                columns = {"affinity": 5, "rank": 6}
+            else:
+                columns = {"affinity": 6, "rank": 7}
+            rows = _read_xls_scores(
+                mhc_out, len(run_alleles), columns, line_count=len(peptides)
+            )
+            for j, allele in enumerate(run_alleles):
+                allele_scores[allele] = [
+                    (peptides[i],)
+                    + tuple([rows[i][1][j][value] for value in sorted(scores)])
+                    for i in range(0, len(peptides))
+                ]
+        na_scores = tuple(["NA" for i in range(0, len(scores))])
+        return [
+            allele_scores.get(
+                allele, [(sequence,) + na_scores for sequence in peptides]
+            )
+            for allele in tool_alleles
+        ]
     finally:
         # Remove temporary files
         if remove_files:
@@ -1517,151 +1468,185 @@ def get_affinity_netMHCpan(
         Return value: affinities (a list of binding affinities
                         as strings)
     """
-    files_to_remove = []
+    return get_affinities_netMHCpan(
+        peptides, [allele], netmhcpan, version, scores, remove_files
+    )[0]
+
+
+def _mhcnuggets_allele(allele):
+    """ Finds MHCnuggets' name and MHC class for an allele
+
+        allele: Allele to use for binding affinity (string)
+
+        Return value: tuple (MHCnuggets' name for allele, "I" or "II"), or
+            None if MHCnuggets does not support allele
+    """
+    for key, allele_class in [("mhcnuggets_mhcI", "I"), ("mhcnuggets_mhcII", "II")]:
+        mhcnuggets_allele = resolve_allele(key, allele)
+        if mhcnuggets_allele is not None:
+            return mhcnuggets_allele, allele_class
+    warnings.warn(
+        " ".join([allele, "is not a valid allele for mhcnuggets"]), Warning
+    )
+    return None
+
+
+def _mhcnuggets_model(allele, allele_class):
+    """ Loads MHCnuggets' model for an allele, keeping the most recently
+        used models loaded; call only while holding _mhcnuggets_lock
+
+        allele: MHCnuggets' name for allele
+        allele_class: MHC class of allele, "I" or "II"
+
+        Return value: compiled Keras model
+    """
+    key = (allele, allele_class)
+    if key in _mhcnuggets_models:
+        model = _mhcnuggets_models.pop(key)
+        _mhcnuggets_models[key] = model
+        return model
+    from keras.optimizers import Adam
+    from mhcnuggets.src.predict import MHCNUGGETS_HOME
+    from mhcnuggets.src.models import mhcnuggets_lstm
+    from mhcnuggets.src.aa_embeddings import (
+        NUM_AAS,
+        MHCI_MASK_LEN,
+        MHCII_MASK_LEN,
+    )
+    # predict()'s default, which closest_allele() looks for in MHCNUGGETS_HOME
+    pickle_path = os.path.join(
+        MHCNUGGETS_HOME, "data", "production", "examples_per_allele.pkl"
+    )
+    if allele_class == "I":
+        from mhcnuggets.src.find_closest_mhcI import closest_allele
+        model = mhcnuggets_lstm((MHCI_MASK_LEN, NUM_AAS))
+    else:
+        from mhcnuggets.src.find_closest_mhcII import closest_allele
+        model = mhcnuggets_lstm((MHCII_MASK_LEN, NUM_AAS))
+    # Choose weights as mhcnuggets.src.predict.predict() does
+    predictor_allele = closest_allele(allele, pickle_path)
+    weights = os.path.join(
+        MHCNUGGETS_HOME,
+        "saves/production/",
+        "".join([predictor_allele, "_BA_to_HLAp.h5"]),
+    )
+    if not os.path.isfile(weights):
+        weights = os.path.join(
+            MHCNUGGETS_HOME,
+            "saves/production/",
+            "".join([predictor_allele, "_BA.h5"]),
+        )
+    model.load_weights(weights)
+    model.compile(loss="mse", optimizer=Adam(lr=0.001))
+    _mhcnuggets_models[key] = model
+    while len(_mhcnuggets_models) > _mhcnuggets_model_cache_size:
+        _mhcnuggets_models.popitem(last=False)
+    return model
+
+
+def get_affinities_mhcnuggets(peptide_lists, alleles, version):
+    """ Obtains binding affinities for several alleles at once from
+        MHCnuggets, predicting in this process without intermediate files
+
+        peptide_lists: list of lists of peptides, one per allele
+        alleles: list of alleles to use for binding affinity
+        version: version of mhcnuggets
+
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its affinity
+    """
     try:
-        # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Homogenize format if needed
-        if version == '3' and allele in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2c', 'BoLA-T2a', 
-                                         'BoLA-T2b', 'Mamu-AG:01', 'H-2-Qa2', 'H-2-Qa1']:
-            pass
-        elif version == '4' and allele in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2C', 'BoLA-T2c', 
-                                           'BoLA-T2a', 'BoLA-T2b', 'Mamu-AG:01', 'H-2-Qa2', 
-                                           'H-2-Qa1', 'H2-Qa1', 'H2-Qa2', 'Chi-B0401', 
-                                           'Chi-B1201', 'Chi-B1501', 'Mamu-A01', 'Mamu-A01',
-                                           'Mamu-A02', 'Mamu-A02', 'Mamu-A03', 'Mamu-A04',
-                                           'Mamu-A06', 'Mamu-A07', 'Mamu-A07', 'Mamu-A11',
-                                           'Mamu-A11', 'Mamu-A19', 'Mamu-A21', 'Mamu-A23',
-                                           'Mamu-A24', 'Mamu-A25', 'Mamu-A26', 'Mamu-A28',
-                                           'Mamu-B01', 'Mamu-B01', 'Mamu-B02', 'Mamu-B03',
-                                           'Mamu-B03', 'Mamu-B04', 'Mamu-B04', 'Mamu-B05',
-                                           'Mamu-B07', 'Mamu-B08', 'Mamu-B08', 'Mamu-B12',
-                                           'Mamu-B17', 'Mamu-B17', 'Mamu-B19', 'Mamu-B20',
-                                           'Mamu-B21', 'Mamu-B22', 'Mamu-B24', 'Mamu-B27',
-                                           'Mamu-B28', 'Mamu-B36', 'Mamu-B37', 'Mamu-B38',
-                                           'Mamu-B39', 'Mamu-B40', 'Mamu-B41', 'Mamu-B43',
-                                           'Mamu-B44', 'Mamu-B45', 'Mamu-B46', 'Mamu-B47',
-                                           'Mamu-B48', 'Mamu-B48', 'Mamu-B49', 'Mamu-B52',
-                                           'Mamu-B53', 'Mamu-B55', 'Mamu-B57', 'Mamu-B61',
-                                           'Mamu-B63', 'Mamu-B64', 'Mamu-B65', 'Mamu-B66',
-                                           'Mamu-B67', 'Mamu-B69', 'Mamu-B70', 'Mamu-B71']:
-            pass
-        elif version == '4.1' and allele in ['BoLA-D18.4', 'BoLA-JSP.1', 'BoLA-T2c', 'BoLA-T2a', 
-                                             'BoLA-T2b', 'BoLA-amani.1', 'BoLA-gb1.7',
-                                             'Mamu-AG:01', 'H-2-Qa2', 'H-2-Qa1', 'H2-Qa1', 
-                                             'H2-Qa2']:
-            pass
-        else:
-            # Parse allele format
-            try:
-                allele_format = parse_allele_name(allele)
-            except:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCpan"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-            # Store valid allele format if available
-            if allele_format in avail_alleles["".join(["netMHCpan", str(version)])]:
-                allele = avail_alleles["".join(["netMHCpan", str(version)])][allele_format]
-            else:
-                warnings.warn(
-                    " ".join([allele, "is not a valid allele for netMHCpan"]), Warning
-                )
-                score_form = tuple(["NA" for i in range(0, len(scores))])
-                return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Establish return list and sample id
-        sample_id = ".".join(
-            [peptides[0], str(len(peptides)), allele, "netmhcpan", version]
+        # Also imports what _mhcnuggets_model() needs, so that a version of
+        #   mhcnuggets laid out differently falls back on its predict()
+        from keras.optimizers import Adam
+        from mhcnuggets.src.predict import MHCNUGGETS_HOME
+        from mhcnuggets.src.models import get_predictions, mhcnuggets_lstm
+        from mhcnuggets.src.dataset import (
+            mask_peptides,
+            tensorize_keras,
+            map_proba_to_ic50,
         )
-        affinities = []
-        # Write one peptide per line to a temporary file for input
-        peptide_file = tempfile.mkstemp(
-            suffix=".peptides", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(peptide_file)
-        with open(peptide_file, "w") as f:
-            for sequence in peptides:
-                print(sequence, file=f)
-        # Establish temporary file to hold output
-        mhc_out = tempfile.mkstemp(
-            suffix=".netMHCpan.out", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(mhc_out)
-        err_file = tempfile.mkstemp(
-            suffix=".netMHCpan.err", prefix="".join([sample_id, "."]), text=True
-        )[1]
-        files_to_remove.append(err_file)
-        with open(err_file, "w") as e:
-            # Run netMHCpan
-            if version == "3":
-                subprocess.check_call(
+        from mhcnuggets.src.aa_embeddings import (
+            NUM_AAS,
+            MHCI_MASK_LEN,
+            MHCII_MASK_LEN,
+        )
+        from mhcnuggets.src.find_closest_mhcI import closest_allele as closest_mhcI
+        from mhcnuggets.src.find_closest_mhcII import closest_allele as closest_mhcII
+    except (ImportError, AttributeError):
+        # This version of mhcnuggets is not laid out as expected, so run
+        #   its predict() for one allele at a time instead
+        return [
+            _predict_mhcnuggets(peptides, allele, version)
+            for peptides, allele in zip(peptide_lists, alleles)
+        ]
+
+    # Encode each distinct list of valid peptides only once per MHC class
+    tensors = {}
+    affinities = []
+    for peptides, allele in zip(peptide_lists, alleles):
+        allele_info = _mhcnuggets_allele(allele)
+        if allele_info is None:
+            affinities.append([(sequence, "NA") for sequence in peptides])
+            continue
+        allele, allele_class = allele_info
+        if allele_class == "I":
+            max_length = MHCI_MASK_LEN
+        else:
+            max_length = MHCII_MASK_LEN
+        valid_peptides = tuple([x for x in peptides if len(x) <= max_length])
+        na_count = len(peptides) - len(valid_peptides)
+        if na_count > 0:
+            warnings.warn(
+                " ".join(
                     [
-                        netmhcpan,
-                        "-a",
-                        allele,
-                        "-inptype",
-                        "1",
-                        "-p",
-                        "-xls",
-                        "-xlsfile",
-                        mhc_out,
-                        peptide_file,
-                    ],
-                    stderr=e,
+                        str(na_count),
+                        "peptides not compatible with",
+                        "mhcnuggets will not receive score",
+                    ]
+                ),
+                Warning,
+            )
+        score_dict = {}
+        if valid_peptides:
+            if (allele_class, valid_peptides) not in tensors:
+                tensors[(allele_class, valid_peptides)] = tensorize_keras(
+                    mask_peptides(list(valid_peptides), max_len=max_length)[0],
+                    embed_type="softhot",
                 )
-            elif version == "4" or version == "4_1":
-                subprocess.check_call(
-                    [
-                        netmhcpan,
-                        "-BA",
-                        "-a",
-                        allele,
-                        "-inptype",
-                        "1",
-                        "-p",
-                        "-xls",
-                        "-xlsfile",
-                        mhc_out,
-                        peptide_file,
-                    ],
-                    stderr=e,
+            with _mhcnuggets_lock:
+                predictions = get_predictions(
+                    test_peptides=tensors[(allele_class, valid_peptides)],
+                    model=_mhcnuggets_model(allele, allele_class),
+                    binary=False,
+                    embed_peptides=False,
+                    ic50_threshold=500,
+                    max_ic50=50000,
+                )[0]
+            # Round as mhcnuggets' own output does
+            for sequence, prediction in zip(valid_peptides, predictions):
+                if isinstance(prediction, (int, float)):
+                    # get_predictions() replaces negative predictions with 0
+                    proba = float(prediction)
+                else:
+                    proba = prediction[0]
+                score_dict[sequence] = str(
+                    round(map_proba_to_ic50(proba, 50000), 2)
                 )
-        with open(mhc_out, "r") as f:
-            f.readline()
-            f.readline()
-            for i in range(0, len(peptides)):
-                tokens = f.readline().strip("\n").split("\t")
-                # for v3, tokens[5] is affinity, tokens[6] is rank
-                # for v4, tokens[6] is affinity, tokens[7] is rank
-                if version == "3":
-                    result_dict = {"affinity": tokens[5],
-                                   "rank": tokens[6]}
-                elif version == "4" or version == "4_1":
-                    result_dict = {"affinity": tokens[6],
-                                   "rank": tokens[7]}
-                nM = [peptides[i]]
-                for value in sorted(scores):
-                    nM.append(result_dict[value])
-                affinities.append(tuple(nM))
-        return affinities
-    finally:
-        # Remove temporary files
-        if remove_files:
-            for file_to_remove in files_to_remove:
-                os.remove(file_to_remove)
+        # Produce list of scores for valid peptides
+        # Invalid peptides receive "NA" score
+        affinities.append(
+            [(sequence, score_dict.get(sequence, "NA")) for sequence in peptides]
+        )
+    return affinities
 
 
-def get_affinity_mhcnuggets(peptides, allele, version, remove_files=True):
-    """ Obtains binding affinities from list of peptides
+def _predict_mhcnuggets(peptides, allele, version, remove_files=True):
+    """ Obtains binding affinities from list of peptides by running
+        mhcnuggets.src.predict.predict() on temporary files
 
         peptides: peptides of interest (list of strings)
         allele: Allele to use for binding affinity (string)
-        scores: list of scoring methods
         version: version of mhcnuggets
         remove_files: option to remove intermediate files
 
@@ -1669,46 +1654,21 @@ def get_affinity_mhcnuggets(peptides, allele, version, remove_files=True):
                         as strings)
     """
     from mhcnuggets.src.predict import predict
+
+    allele_info = _mhcnuggets_allele(allele)
+    if allele_info is None:
+        return [(sequence, "NA") for sequence in peptides]
+    allele, allele_class = allele_info
+    if allele_class == "I":
+        max_length = 15
+    else:
+        max_length = 30
     files_to_remove = []
     try:
-        # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Parse allele format
-        try:
-            allele_format = parse_allele_name(allele)
-        except:
-            warnings.warn(
-                " ".join([allele, "is not a valid allele for mhcnuggets"]), Warning
-            )
-            score_form = tuple(["NA" for i in range(0, len(scores))])
-            return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Check that allele is valid for method
-        if allele_format in avail_alleles["mhcnuggets_mhcI"]:
-            allele = avail_alleles["mhcnuggets_mhcI"][allele_format]
-            allele_class = "I"
-            max_length = 15
-        elif allele_format in avail_alleles["mhcnuggets_mhcII"]:
-            allele = avail_alleles["mhcnuggets_mhcII"][allele_format]
-            allele_class = "II"
-            max_length = 30
-        else:
-            warnings.warn(
-                " ".join([allele, "is not a valid allele for mhcnuggets"]), Warning
-            )
-            return [(peptides[i], "NA") for i in range(0, len(peptides))]
-        # Establish return list and sample id
         sample_id = ".".join(
             [peptides[0], str(len(peptides)), allele, "mhcnuggets", version]
         )
-        affinities = []
-        # Write one peptide per line to a temporary file for
-        #   input if peptide length is at least 9
-        # Count instances of smaller peptides
-        # Establish temporary file to hold output
+        # Write one peptide per line to a temporary file for input
         peptide_file = tempfile.mkstemp(
             suffix=".txt", prefix="".join([sample_id, "."]), text=True
         )[1]
@@ -1736,10 +1696,13 @@ def get_affinity_mhcnuggets(peptides, allele, version, remove_files=True):
             suffix=".mhcnuggets.out", prefix="".join([sample_id, "."]), text=True
         )[1]
         files_to_remove.append(mhc_out)
-        # Run mhcnuggets
-        predict(
-            class_=allele_class, peptides_path=peptide_file, mhc=allele, output=mhc_out
-        )
+        with _mhcnuggets_lock:
+            predict(
+                class_=allele_class,
+                peptides_path=peptide_file,
+                mhc=allele,
+                output=mhc_out,
+            )
         # Retrieve scores for valid peptides
         score_dict = {}
         with open(mhc_out, "r") as f:
@@ -1748,21 +1711,29 @@ def get_affinity_mhcnuggets(peptides, allele, version, remove_files=True):
             for line in f:
                 tokens = line.strip("\n").split(",")
                 score_dict[tokens[0]] = tokens[1]
-        # Produce list of scores for valid peptides
         # Invalid peptides receive "NA" score
-        for sequence in peptides:
-            if sequence in score_dict:
-                nM = (sequence, score_dict[sequence])
-            else:
-                nM = (sequence, "NA")
-            affinities.append(nM)
-        return affinities
+        return [(sequence, score_dict.get(sequence, "NA")) for sequence in peptides]
     finally:
         if remove_files:
             for file_to_remove in files_to_remove:
                 os.remove(file_to_remove)
 
 
+def get_affinity_mhcnuggets(peptides, allele, version, remove_files=True):
+    """ Obtains binding affinities from list of peptides
+
+        peptides: peptides of interest (list of strings)
+        allele: Allele to use for binding affinity (string)
+        version: version of mhcnuggets
+        remove_files: unused; kept for compatibility, as MHCnuggets no
+            longer writes intermediate files
+
+        Return value: affinities (a list of binding affinities
+                        as strings)
+    """
+    return get_affinities_mhcnuggets([peptides], [allele], version)[0]
+
+
 def get_affinity_PSSMHCpan(
     peptides, allele, pssmhcpan, version, scores, size_list, remove_files=True
 ):
@@ -1784,28 +1755,14 @@ def get_affinity_PSSMHCpan(
     files_to_remove = []
     try:
         # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Parse allele format
-        try:
-            allele_format = parse_allele_name(allele)
-        except:
+        tool_allele = resolve_allele("".join(["PSSMHCpan", str(version)]), allele)
+        if tool_allele is None:
             warnings.warn(
                 " ".join([allele, "is not a valid allele for PSSMHCpan"]), Warning
             )
             score_form = tuple(["NA" for i in range(0, len(scores))])
             return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Check that allele is valid for method
-        if allele_format in avail_alleles["".join(["PSSMHCpan", str(version)])]:
-            allele = avail_alleles["".join(["PSSMHCpan", str(version)])][allele_format]
-        else:
-            warnings.warn(
-                " ".join([allele, "is not a valid allele for PSSMHCpan"]), Warning
-            )
-            return [(peptides[i], "NA") for i in range(0, len(peptides))]
+        allele = tool_allele
         # Get valid sizes
         with open(
             os.path.join(neoepiscope_dir, "neoepiscope", "PSSMHCpan1Sizes.pickle"),
@@ -1815,8 +1772,9 @@ def get_affinity_PSSMHCpan(
         affinities = []
         score_dict = {}
         na_count = 0
-        for i in range(size_list[0], size_list[-1]+1):
-            sized_peps = [x for x in peptides if len(x) == i]
+        buckets = _length_buckets(peptides)
+        for i in sorted(buckets.keys()):
+            sized_peps = buckets[i]
             # Skip not a valid size for the allele
             if i not in valid_sizes[allele]:
                 na_count += len(sized_peps)
@@ -1844,12 +1802,10 @@ def get_affinity_PSSMHCpan(
                 suffix=".PSSMHCpan.err", prefix="".join([sample_id, "."]), text=True
             )[1]
             files_to_remove.append(err_file)
-            # Change to appropriate directory for command
-            wd = os.getcwd()
-            os.chdir(paths.PSSMHCpan1)
             with open(err_file, "w") as e:
                 with open(mhc_out, "w") as o:
-                    # Run PSSMHCpan
+                    # Run PSSMHCpan from its own directory; cwd rather than
+                    #   os.chdir() leaves other threads' working directory be
                     subprocess.check_call(
                         [
                             'perl',
@@ -1859,9 +1815,8 @@ def get_affinity_PSSMHCpan(
                             allele,
                             pssm_file
                         ],
-                        stderr=e, stdout=o
+                        stderr=e, stdout=o, cwd=paths.PSSMHCpan1
                     )
-            os.chdir(wd)
             with open(mhc_out, "r") as f:
                 f.readline()
                 for i in range(0, len(sized_peps)):
@@ -1911,33 +1866,20 @@ def get_affinity_IEDBtools(
     files_to_remove = []
     try:
         # Check that allele is valid for method
-        with open(
-            os.path.join(neoepiscope_dir, "neoepiscope", "availableAlleles.pickle"),
-            "rb",
-        ) as allele_stream:
-            avail_alleles = pickle.load(allele_stream)
-        # Parse allele format
-        try:
-            allele_format = parse_allele_name(allele)
-        except:
+        tool_allele = resolve_allele("".join(["IEDBtools", str(version), '-', method]), allele)
+        if tool_allele is None:
             warnings.warn(
                 "".join([allele, " is not a valid allele for IEDBtools-", method]), Warning
             )
             score_form = tuple(["NA" for i in range(0, len(scores))])
             return [(peptides[i],) + score_form for i in range(0, len(peptides))]
-        # Check that allele is valid for method
-        if allele_format in avail_alleles["".join(["IEDBtools", str(version), '-', method])]:
-            allele = avail_alleles["".join(["IEDBtools", str(version), '-', method])][allele_format]
-        else:
-            warnings.warn(
-                "".join([allele, " is not a valid allele for IEDBtools-", method]), Warning
-            )
-            return [(peptides[i], "NA") for i in range(0, len(peptides))]
+        allele = tool_allele
         affinities = []
         score_dict = {}
         na_count = 0
-        for i in range(size_list[0], size_list[-1]+1):
-            sized_peps = [x for x in peptides if len(x) == i]
+        buckets = _length_buckets(peptides)
+        for i in sorted(buckets.keys()):
+            sized_peps = buckets[i]
             # Skip not a valid size for the allele
             if i not in valid_sizes[allele]:
                 na_count += len(sized_peps)
@@ -1965,12 +1907,9 @@ def get_affinity_IEDBtools(
                 suffix=".IEDBtools.err", prefix="".join([sample_id, "."]), text=True
             )[1]
             files_to_remove.append(err_file)
-            # Change to appropriate directory for command
-            wd = os.getcwd()
-            os.chdir(os.path.realpath(iedbtools))
             with open(err_file, "w") as e:
                 with open(mhc_out, "w") as o:
-                    # Run IEDBtools
+                    # Run IEDBtools from its own directory
                     subprocess.check_call(
                         [
                             'python',
@@ -1980,9 +1919,8 @@ def get_affinity_IEDBtools(
                             str(i),
                             peptide_file
                         ],
-                        stderr=e, stdout=o
+                        stderr=e, stdout=o, cwd=os.path.realpath(iedbtools)
                     )
-            os.chdir(wd)
             with open(mhc_out, "r") as f:
                 f.readline()
                 for i in range(0, len(sized_peps)):
@@ -2011,159 +1949,424 @@ def get_affinity_IEDBtools(
                 os.remove(file_to_remove)
 
 
-def gather_binding_scores(neoepitopes, tool_dict, hla_alleles, size_list):
+def _score_mhcflurry(peptides, alleles, tool_data, size_list):
+    """ Scores peptides with MHCflurry, in this process if possible
+
+        peptides: list of peptides to score
+        alleles: list of HLA alleles used for binding predictions
+        tool_data: entry for MHCflurry in the tool dictionary
+        size_list: list of [min size, ..., max size] of peptide sizes
+
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its scores
+    """
+    if _mhcflurry_predictor() is not None:
+        return get_affinities_mhcflurry(
+            [peptides] * len(alleles), alleles, tool_data[1]
+        )
+    return [
+        get_affinity_mhcflurry(peptides, allele, tool_data[1], "1")
+        for allele in alleles
+    ]
+
+
+register_predictor(
+    Predictor(
+        "mhcflurry1",
+        "MHCflurry",
+        ["1"],
+        ["affinity", "high", "low", "rank"],
+        _score_mhcflurry,
+        lambda: "mhcflurry-predict",
+        allele_tables=["mhcflurry"],
+        lengths=(8, 15),
+        in_process=lambda: _mhcflurry_predictor() is not None,
+        tensorflow=True,
+    )
+)
+register_predictor(
+    Predictor(
+        "mhcnuggets2",
+        "MHCnuggets",
+        ["2"],
+        ["affinity"],
+        lambda peptides, alleles, tool_data, size_list: get_affinities_mhcnuggets(
+            [peptides] * len(alleles), alleles, "2"
+        ),
+        lambda: "NA",
+        allele_tables=["mhcnuggets_mhcI", "mhcnuggets_mhcII"],
+        in_process=True,
+        tensorflow=True,
+    )
+)
+for version, name in [("3", "netMHCIIpan3"), ("4", "netMHCIIpan4")]:
+    register_predictor(
+        Predictor(
+            name,
+            "netMHCIIpan",
+            [version],
+            ["affinity", "rank"],
+            lambda peptides, alleles, tool_data, size_list, version=version: (
+                get_affinities_netMHCIIpan(
+                    peptides, alleles, tool_data[0], version, tool_data[1]
+                )
+            ),
+            lambda name=name: _locate(getattr(paths, name), name),
+            allele_tables=[name],
+            lengths=(9, None),
+            multi_allele=True,
+        )
+    )
+register_predictor(
+    Predictor(
+        "netMHCII2",
+        "netMHCII",
+        ["2"],
+        ["affinity", "rank"],
+        lambda peptides, alleles, tool_data, size_list: [
+            get_affinity_netMHCII(peptides, allele, tool_data[0], "2", tool_data[1])
+            for allele in alleles
+        ],
+        lambda: _locate(paths.netMHCII2, "netMHCII2"),
+        allele_tables=["netMHCII2"],
+        lengths=(9, None),
+    )
+)
+for versions, name, default in [
+    (["3"], "netMHCpan3", "netMHCpan3"),
+    (["4", "4.0"], "netMHCpan4", "netMHCpan4"),
+    (["4.1"], "netMHCpan4_1", "netMHCpan4.1"),
+]:
+    register_predictor(
+        Predictor(
+            name,
+            "netMHCpan",
+            versions,
+            ["affinity", "rank"],
+            lambda peptides, alleles, tool_data, size_list, version=name[9:]: (
+                get_affinities_netMHCpan(
+                    peptides, alleles, tool_data[0], version, tool_data[1]
+                )
+            ),
+            lambda name=name, default=default: _locate(
+                getattr(paths, name), default
+            ),
+            allele_tables=[name],
+            multi_allele=True,
+        )
+    )
+register_predictor(
+    Predictor(
+        "netMHCcons1",
+        "netMHCcons",
+        ["1"],
+        ["affinity", "rank"],
+        lambda peptides, alleles, tool_data, size_list: [
+            get_affinity_netMHCcons(
+                peptides, allele, tool_data[0], "1", tool_data[1], size_list
+            )
+            for allele in alleles
+        ],
+        lambda: _locate(paths.netMHCcons1, "netMHCcons1"),
+        allele_tables=["netMHCcons1"],
+        unsupported=(
+            "Binding predictions with netMHCcons not currently supported "
+            "due to instability of predictions - support for netMHCcons "
+            "may be included in future releases."
+        ),
+    )
+)
+register_predictor(
+    Predictor(
+        "netMHCstabpan1",
+        "netMHCstabpan",
+        ["1"],
+        [
+            "affinity",
+            "combined",
+            "rank_affinity",
+            "rank_combined",
+            "rank_stability",
+            "stability",
+        ],
+        lambda peptides, alleles, tool_data, size_list: [
+            get_affinity_netMHCstabpan(
+                peptides, allele, tool_data[0], "1", tool_data[1], size_list
+            )
+            for allele in alleles
+        ],
+        lambda: _locate(paths.netMHCstabpan1, "netMHCstabpan1"),
+        allele_tables=["netMHCstabpan1"],
+    )
+)
+register_predictor(
+    Predictor(
+        "netMHC4",
+        "netMHC",
+        ["4"],
+        ["affinity", "rank"],
+        lambda peptides, alleles, tool_data, size_list: get_affinities_netMHC(
+            peptides, alleles, tool_data[0], "4", tool_data[1]
+        ),
+        lambda: _locate(paths.netMHC4, "netMHC4"),
+        allele_tables=["netMHC4"],
+        multi_allele=True,
+    )
+)
+register_predictor(
+    Predictor(
+        "pickpocket1",
+        "PickPocket",
+        ["1"],
+        ["affinity"],
+        lambda peptides, alleles, tool_data, size_list: [
+            get_affinity_pickpocket(peptides, allele, tool_data[0], "1", tool_data[1])
+            for allele in alleles
+        ],
+        lambda: _locate(paths.PickPocket1, "pickpocket1"),
+        allele_tables=["pickpocket1"],
+    )
+)
+register_predictor(
+    Predictor(
+        "PSSMHCpan1",
+        "PSSMHCpan",
+        ["1"],
+        ["affinity"],
+        lambda peptides, alleles, tool_data, size_list: [
+            get_affinity_PSSMHCpan(
+                peptides, allele, tool_data[0], "1", tool_data[1], size_list
+            )
+            for allele in alleles
+        ],
+        _locate_PSSMHCpan,
+        allele_tables=["PSSMHCpan1"],
+    )
+)
+
+
+def _chunk_binding_scores(
+    predictor, tool_data, peptides, alleles, size_list, retries=0
+):
+    """ Runs one binding prediction tool on a chunk of peptides, retrying
+        if the tool fails
+
+        predictor: Predictor object for tool
+        tool_data: entry for tool in the tool dictionary
+        peptides: list of peptides to score
+        alleles: list of HLA alleles used for binding predictions
+        size_list: list of [min size, ..., max size] of peptide sizes
+        retries: number of times to rerun tool after it fails
+
+        Return value: list of lists of tuples, one list per allele, each
+            tuple a peptide followed by its scores
+    """
+    for attempt in range(retries + 1):
+        try:
+            return predictor.score(peptides, alleles, tool_data, size_list)
+        except _chunk_errors as e:
+            if attempt == retries:
+                raise
+            warnings.warn(
+                " ".join(
+                    [
+                        predictor.name,
+                        "failed for allele(s)",
+                        ",".join(alleles),
+                        "on",
+                        str(len(peptides)),
+                        "peptides (",
+                        str(e),
+                        "); retrying",
+                    ]
+                ),
+                Warning,
+            )
+
+
+def gather_binding_scores(
+    neoepitopes,
+    tool_dict,
+    hla_alleles,
+    size_list,
+    threads=1,
+    cache=None,
+    chunk_size=None,
+    retries=0,
+):
     """ Adds binding scores from desired programs to neoepitope metadata
 
         neoepitopes: dictionary linking neoepitopes to their metadata
         tool_dict: dictionary storing prediction tool data
         hla_alleles: list of HLA alleles used for binding predictions
         size_list: list of [min size, ..., max size] of peptide sizes
+        threads: maximum number of predictions to run at once
+        cache: BindingCache object from which to take scores, and to which
+            to add new ones; None to predict all scores
+        chunk_size: most peptides to send to a tool in one run, or None
+            to send all peptides at once
+        retries: number of times to rerun a chunk after its tool fails
 
         Return value: dictionary linking neoepitopes to their metadata,
             which now includes binding scores
     """
-    for allele in hla_alleles:
-        for tool in sorted(tool_dict.keys()):
-            if tool == "mhcflurry1":
-                binding_scores = get_affinity_mhcflurry(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][1],
-                    "1",
-                    remove_files=True,
-                )
-            elif tool == "mhcnuggets2":
-                binding_scores = get_affinity_mhcnuggets(
-                    list(neoepitopes.keys()), allele, "2", remove_files=True
-                )
-            elif tool == "netMHCIIpan3":
-                binding_scores = get_affinity_netMHCIIpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "3",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHCIIpan4":
-                binding_scores = get_affinity_netMHCIIpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "4",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHCpan3":
-                binding_scores = get_affinity_netMHCpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "3",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHCpan4":
-                binding_scores = get_affinity_netMHCpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "4",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHCpan4_1":
-                binding_scores = get_affinity_netMHCpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "4_1",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHC4":
-                binding_scores = get_affinity_netMHC(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "4",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "pickpocket1":
-                binding_scores = get_affinity_pickpocket(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "1",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHCcons1":
-                binding_scores = get_affinity_netMHCcons(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "1",
-                    tool_dict[tool][1],
-                    size_list,
-                    remove_files=True,
-                )
-            elif tool == "netMHCII2":
-                binding_scores = get_affinity_netMHCII(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "2",
-                    tool_dict[tool][1],
-                    remove_files=True,
-                )
-            elif tool == "netMHCstabpan1":
-                binding_scores = get_affinity_netMHCstabpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "1",
-                    tool_dict[tool][1],
-                    size_list,
-                    remove_files=True,
-                )
-            elif tool == "PSSMHCpan1":
-                binding_scores = get_affinity_PSSMHCpan(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    "1",
-                    tool_dict[tool][1],
-                    size_list,
-                    remove_files=True,
-                )
-            elif "iedbtools-mhcii" in tool.lower():
-                method = tool.split('-')[2]
-                binding_scores = get_affinity_IEDBtools(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    method,
-                    "2",
-                    tool_dict[tool][1],
-                    size_list,
-                    remove_files=True,
+    for tool in tool_dict:
+        if tool not in _predictors:
+            raise RuntimeError(" ".join(["Unknown binding prediction tool", tool]))
+    peptides = list(neoepitopes.keys())
+    # Scores are appended to metadata in this order
+    jobs = [
+        (allele, tool) for allele in hla_alleles for tool in sorted(tool_dict.keys())
+    ]
+    # Give NA scores for alleles and peptide lengths that a tool cannot
+    #   score, without running it or looking them up in the cache
+    buckets = _length_buckets(peptides)
+    unsupported = unsupported_alleles(tool_dict, hla_alleles)
+    job_scores, scorable = [], []
+    for allele, tool in jobs:
+        if allele in unsupported.get(tool, []):
+            warnings.warn(
+                " ".join([allele, "is not a valid allele for", tool]), Warning
+            )
+            unscorable = set(peptides)
+        elif _predictors[tool].lengths != (None, None):
+            shortest, longest = _predictors[tool].lengths
+            unscorable = set()
+            for length in buckets:
+                if (shortest is not None and length < shortest) or (
+                    longest is not None and length > longest
+                ):
+                    unscorable.update(buckets[length])
+            if unscorable:
+                warnings.warn(
+                    " ".join(
+                        [
+                            str(len(unscorable)),
+                            "peptides not compatible with",
+                            tool,
+                            "will not receive score",
+                        ]
+                    ),
+                    Warning,
                 )
-            elif "iedbtools-mhci" in tool.lower():
-                method = tool.split('-')[2]
-                binding_scores = get_affinity_IEDBtools(
-                    list(neoepitopes.keys()),
-                    allele,
-                    tool_dict[tool][0],
-                    method,
-                    "2",
-                    tool_dict[tool][1],
+        else:
+            unscorable = set()
+        na_scores = tuple(["NA" for i in range(len(tool_dict[tool][1]))])
+        job_scores.append([(x,) + na_scores for x in peptides if x in unscorable])
+        scorable.append([x for x in peptides if x not in unscorable])
+    # Look up cached scores here rather than in worker threads, which
+    #   cannot share an SQLite connection
+    cached_scores = []
+    for k, (allele, tool) in enumerate(jobs):
+        if cache is None or not scorable[k]:
+            cached_scores.append({})
+        else:
+            cached_scores.append(
+                cache.lookup(tool, tool_dict[tool][1], allele, scorable[k])
+            )
+        job_scores[k].extend(
+            [(peptide,) + scores for peptide, scores in cached_scores[k].items()]
+        )
+    uncached = [
+        [x for x in scorable[k] if x not in cached_scores[k]]
+        for k in range(len(jobs))
+    ]
+    # Group jobs that one run of a tool scores together, then split each
+    #   group's uncached peptides into chunks, one tool run each
+    chunks, local_chunks = [], []
+    for tool in sorted(tool_dict.keys()):
+        predictor = _predictors[tool]
+        group = [k for k in range(len(jobs)) if jobs[k][1] == tool and uncached[k]]
+        if not group:
+            continue
+        in_process = predictor.predicts_in_process()
+        if predictor.multi_allele or in_process:
+            groups = [group]
+        else:
+            groups = [[k] for k in group]
+        for group in groups:
+            # Score peptides not cached for any allele in group
+            missing = set()
+            for k in group:
+                missing.update(uncached[k])
+            group_peptides = [x for x in peptides if x in missing]
+            step = min(
+                [
+                    x
+                    for x in [chunk_size, predictor.max_batch, len(group_peptides)]
+                    if x
+                ]
+            )
+            for i in range(0, len(group_peptides), step):
+                if in_process:
+                    local_chunks.append(len(chunks))
+                chunks.append((group, group_peptides[i : i + step]))
+    pool_chunks = sorted(set(range(len(chunks))) - set(local_chunks))
+
+    def run_chunk(c):
+        group, chunk_peptides = chunks[c]
+        tool = jobs[group[0]][1]
+        try:
+            return (
+                c,
+                _chunk_binding_scores(
+                    _predictors[tool],
+                    tool_dict[tool],
+                    chunk_peptides,
+                    [jobs[k][0] for k in group],
                     size_list,
-                    remove_files=True,
-                )
-            for score in binding_scores:
-                meta_data = neoepitopes[score[0]]
-                for i in range(0, len(meta_data)):
-                    neoepitopes[score[0]][i] = meta_data[i] + score[1:]
+                    retries,
+                ),
+                None,
+            )
+        except _chunk_errors as e:
+            return c, None, e
+
+    def finish_group(group, group_scores):
+        for k, binding_scores in zip(group, group_scores):
+            # Drop scores already cached for this allele
+            binding_scores = [
+                score for score in binding_scores if score[0] not in cached_scores[k]
+            ]
+            job_scores[k].extend(binding_scores)
+            if cache is not None and binding_scores:
+                allele, tool = jobs[k]
+                cache.store(tool, tool_dict[tool][1], allele, binding_scores)
+
+    if threads > 1 and len(pool_chunks) > 1:
+        from multiprocessing.pool import ThreadPool
+
+        # Predictors run as subprocesses, so threads suffice to overlap them
+        pool = ThreadPool(min(threads, len(pool_chunks)))
+        finished_chunks = pool.imap_unordered(run_chunk, pool_chunks)
+    else:
+        pool = None
+        finished_chunks = (run_chunk(c) for c in pool_chunks)
+    failures = []
+    try:
+        # Models loaded in this process (e.g. TensorFlow's) are tied to the
+        #   thread that loaded them, so in-process chunks are predicted here
+        #   while other tools run in the pool; cache each chunk as it
+        #   finishes, so that a rerun after a failure predicts only the
+        #   chunks that failed
+        for c, group_scores, error in itertools.chain(
+            (run_chunk(c) for c in local_chunks), finished_chunks
+        ):
+            if error is not None:
+                failures.append((c, error))
+                continue
+            finish_group(chunks[c][0], group_scores)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if failures:
+        raise min(failures, key=lambda failure: failure[0])[1]
+    for binding_scores in job_scores:
+        for score in binding_scores:
+            meta_data = neoepitopes[score[0]]
+            for i in range(0, len(meta_data)):
+                neoepitopes[score[0]][i] = meta_data[i] + score[1:]
+    if cache is not None:
+        cache.evict()
     return neoepitopes
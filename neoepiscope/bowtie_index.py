@@ -37,8 +37,8 @@ import os
 import struct
 import mmap
 from operator import itemgetter
-from collections import defaultdict
-from bisect import bisect_right
+from collections import OrderedDict
+import numpy as np
 import sys
 
 # Python 2-3 compatibility
@@ -52,20 +52,113 @@ if sys.version_info[0] > 2:
     def byte_readline(fh):
         return fh.readline().decode(encoding="UTF-8")
 
-    # we need a version of ord that does nothing in python 3
-    # but regular ord is still needed on refname reads thanks to
-    # our byte_readline
-    def ord2or3(chr):
-        return chr
-
 
 else:
 
     def byte_readline(fh):
         return fh.readline()
 
-    def ord2or3(chr):
-        return ord(chr)
+
+# Each byte of the .4.ebwt file packs four bases, least significant bits first;
+# decoding a whole byte at a time avoids shifting out every base individually
+_byte_to_bases = [
+    "".join(["ACGT"[(byte >> shift) & 3] for shift in (0, 2, 4, 6)])
+    for byte in xrange(256)
+]
+
+# Version of the layout of extent caches written alongside Bowtie indexes
+_EXTENT_CACHE_VERSION = 1
+
+
+def _index_stamp(path):
+    """ Summarizes the state of an index file so stale caches are detected
+
+        path: path to index file
+        Return value: tuple (size in bytes, modification time in microseconds)
+    """
+    stat = os.stat(path)
+    return stat.st_size, int(stat.st_mtime * 1000000)
+
+
+def _load_extent_cache(cache_file, stamp):
+    """ Memory-maps a cache of unambiguous-stretch extents if it is current
+
+        cache_file: path to cache written by _write_extent_cache()
+        stamp: output of _index_stamp() for the .3.ebwt file
+        Return value: extents array (see _parse_extents()) or None if the
+            cache is missing, unreadable, or stale
+    """
+    try:
+        extents = np.load(cache_file, mmap_mode="r")
+    except (IOError, OSError, ValueError):
+        return None
+    if (
+        extents.dtype != np.int64
+        or extents.ndim != 2
+        or extents.shape[0] != 5
+        or extents.shape[1] < 1
+        or tuple(extents[:4, 0]) != (
+            _EXTENT_CACHE_VERSION,
+            stamp[0],
+            stamp[1],
+            extents.shape[1] - 1,
+        )
+    ):
+        return None
+    return extents
+
+
+def _write_extent_cache(cache_file, extents):
+    """ Writes extents array to cache file, giving up quietly if the index
+        directory is not writable
+
+        cache_file: path to cache file
+        extents: extents array (see _parse_extents())
+        No return value.
+    """
+    temp_file = ".".join([cache_file, str(os.getpid()), "tmp"])
+    try:
+        with open(temp_file, "wb") as cache_stream:
+            np.save(cache_stream, extents)
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError):
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+
+
+def _parse_extents(fh3, sz, stamp):
+    """ Parses unambiguous-stretch records of a .3.ebwt file
+
+        fh3: file handle of .3.ebwt file, positioned after its leading 1
+        sz: size of unsigned ints in index
+        stamp: output of _index_stamp() for the .3.ebwt file
+        Return value: int64 array with 5 rows; after a header column
+            (cache version, index size, index mtime, number of records),
+            columns are records and rows are # of ambiguous characters
+            preceding the stretch, length of the stretch, whether the stretch
+            is the first of its reference, offset of the record in its
+            reference, and # of unambiguous characters preceding the stretch
+            in the index
+    """
+    nrecs = struct.unpack("I", fh3.read(sz))[0]
+    record_type = np.dtype([("off", "=u%d" % sz), ("ln", "=u%d" % sz), ("first", "u1")])
+    records = np.frombuffer(
+        fh3.read(nrecs * record_type.itemsize), dtype=record_type, count=nrecs
+    )
+    extents = np.zeros((5, nrecs + 1), dtype=np.int64)
+    extents[:4, 0] = (_EXTENT_CACHE_VERSION, stamp[0], stamp[1], nrecs)
+    off, ln, first = extents[0, 1:], extents[1, 1:], extents[2, 1:]
+    off[:], ln[:] = records["off"], records["ln"]
+    first[:] = records["first"] != 0
+    assert nrecs == 0 or first[0]
+    # Offsets in reference restart at each reference's first record
+    preceding = np.cumsum(off + ln) - off - ln
+    ref_starts = np.flatnonzero(first)
+    extents[3, 1:] = preceding - preceding[ref_starts][np.cumsum(first) - 1]
+    extents[4, 1:] = np.cumsum(ln) - ln
+    return extents
 
 
 class BowtieIndexReference(object):
@@ -75,9 +168,18 @@ class BowtieIndexReference(object):
     the unambiguous-stretch sequences.  get_stretch member function can
     retrieve stretches of characters from the reference, even if the stretch
     contains ambiguous characters.
+
+    Extents are cached next to the index (in <idx_prefix>.3.ebwt.npy) the
+    first time the index is opened, if its directory is writable; later
+    instances memory-map the cache instead of parsing the .3.ebwt file.
+
+    Retrieved stretches are kept in a bounded least-recently-used cache keyed
+    on (reference name, offset, length), so that exons shared by the
+    transcripts of a gene are decoded once; stretch_cache_hits and
+    stretch_cache_misses count lookups.
     """
 
-    def __init__(self, idx_prefix):
+    def __init__(self, idx_prefix, cache_extents=True, stretch_cache_size=10000):
 
         # Open file handles
         if os.path.exists(idx_prefix + ".3.ebwt"):
@@ -144,39 +246,42 @@ class BowtieIndexReference(object):
         assert len(refnames) == nref
 
         #
-        # Parse .3.bt2 file
+        # Parse .3.bt2 file, or load its cached extents
         #
         one = struct.unpack("<i", fh3.read(4))[0]
         assert one == 1
 
-        nrecs = struct_unsigned.unpack(fh3.read(sz))[0]
-
-        running_unambig, running_length = 0, 0
-        self.recs = defaultdict(list)
-        self.offset_in_ref = defaultdict(list)
-        self.unambig_preceding = defaultdict(list)
+        stamp = _index_stamp(idx_prefix + ".3.ebwt")
+        cache_file = idx_prefix + ".3.ebwt.npy"
+        extents = None
+        if cache_extents:
+            extents = _load_extent_cache(cache_file, stamp)
+        if extents is None:
+            extents = _parse_extents(fh3, sz, stamp)
+            if cache_extents:
+                _write_extent_cache(cache_file, extents)
+        nrecs = extents.shape[1] - 1
+
+        # Per-reference views of extents; these share the cache's pages
+        self.recs = {}
+        self.offset_in_ref = {}
+        self.unambig_preceding = {}
+        self._extents = {}
         length = {}
-
-        ref_id, ref_namenrecs_added = 0, None
-        for i in xrange(nrecs):
-            off = struct_unsigned.unpack(fh3.read(sz))[0]
-            ln = struct_unsigned.unpack(fh3.read(sz))[0]
-            first_of_chromosome = ord(fh3.read(1)) != 0
-            if first_of_chromosome:
-                if i > 0:
-                    length[ref_name] = running_length
-                ref_name = refnames[ref_id]
-                ref_id += 1
-                running_length = 0
-            assert ref_name is not None
-            self.recs[ref_name].append((off, ln, first_of_chromosome))
-            self.offset_in_ref[ref_name].append(running_length)
-            self.unambig_preceding[ref_name].append(running_unambig)
-            running_length += off + ln
-            running_unambig += ln
-
-        length[ref_name] = running_length
+        ref_starts = np.flatnonzero(extents[2, 1:]).tolist() + [nrecs]
+        assert len(ref_starts) - 1 <= len(refnames)
+        for ref_id in xrange(len(ref_starts) - 1):
+            ref_name = refnames[ref_id]
+            ref_extents = extents[:, ref_starts[ref_id] + 1 : ref_starts[ref_id + 1] + 1]
+            self.recs[ref_name] = ref_extents[:3].T
+            self.offset_in_ref[ref_name] = ref_extents[3]
+            self.unambig_preceding[ref_name] = ref_extents[4]
+            self._extents[ref_name] = ref_extents
+            length[ref_name] = int(
+                ref_extents[3, -1] + ref_extents[0, -1] + ref_extents[1, -1]
+            )
         assert nrecs == sum(map(len, self.recs.values()))
+        running_unambig = int(extents[4, -1] + extents[1, -1]) if nrecs else 0
 
         #
         # Memory-map the .4.bt2 file
@@ -217,10 +322,45 @@ class BowtieIndexReference(object):
 
         # For compatibility
         self.rname_lengths = self.length
+
+        # LRU cache of retrieved stretches
+        self.stretch_cache_size = stretch_cache_size
+        self.stretch_cache_hits, self.stretch_cache_misses = 0, 0
+        self._stretch_cache = OrderedDict()
+        self.idx_prefix = idx_prefix
+        self.cache_extents = cache_extents
         fh1.close()
         fh3.close()
         fh4.close()
 
+    def __reduce__(self):
+        # Reopen rather than copy memory maps, e.g. in worker processes
+        return (
+            self.__class__,
+            (self.idx_prefix, self.cache_extents, self.stretch_cache_size),
+        )
+
+    def _decode(self, buf_off, count):
+        """
+        Decode a run of unambiguous characters from the memory-mapped
+        .4.ebwt file.
+
+        @param buf_off: offset of first character among unambiguous
+            characters in the index
+        @param count: # of characters; must be > 0
+        @return: string of decoded characters
+        """
+        first_byte = buf_off >> 2
+        last_byte = (buf_off + count - 1) >> 2
+        decoded = "".join(
+            [
+                _byte_to_bases[byte]
+                for byte in bytearray(self.fh4mm[first_byte : last_byte + 1])
+            ]
+        )
+        skip = buf_off & 3
+        return decoded[skip : skip + count]
+
     def get_stretch(self, ref_id, ref_off, count):
         """
         Return a stretch of characters from the reference, retrieved
@@ -232,46 +372,146 @@ class BowtieIndexReference(object):
         @return: string extracted from reference
         """
         assert ref_id in self.recs
+        key = (ref_id, ref_off, count)
+        stretch = self._cached_stretch(key)
+        if stretch is None:
+            starting_rec = (
+                int(
+                    np.searchsorted(
+                        self.offset_in_ref[ref_id], max(ref_off, 0), side="right"
+                    )
+                )
+                - 1
+            )
+            stretch = self._stretch(ref_id, starting_rec, ref_off, count)
+            self._cache_stretch(key, stretch)
+        return stretch
+
+    def get_stretches(self, ref_id, intervals):
+        """
+        Return several stretches of characters from the same reference,
+        visiting its extents in a single pass.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param intervals: list of (offset into reference, 0-based,
+            # of characters) tuples
+        @return: list of strings extracted from reference, in the order
+            of intervals
+        """
+        assert ref_id in self.recs
+        stretches = [
+            self._cached_stretch((ref_id, ref_off, count))
+            for ref_off, count in intervals
+        ]
+        order = sorted(
+            [i for i in xrange(len(intervals)) if stretches[i] is None],
+            key=lambda j: intervals[j][0],
+        )
+        if not order:
+            return stretches
+        # Requests are sorted, so records are located in one pass
+        starting_recs = (
+            np.searchsorted(
+                self.offset_in_ref[ref_id],
+                [max(intervals[i][0], 0) for i in order],
+                side="right",
+            )
+            - 1
+        ).tolist()
+        for i, starting_rec in zip(order, starting_recs):
+            ref_off, count = intervals[i]
+            stretches[i] = self._stretch(ref_id, starting_rec, ref_off, count)
+            self._cache_stretch((ref_id, ref_off, count), stretches[i])
+        return stretches
+
+    def _cached_stretch(self, key):
+        """
+        Look up a stretch in the LRU cache, updating hit/miss counts.
+
+        @param key: tuple (name of ref seq, offset into reference, # of
+            characters)
+        @return: cached string, or None if it is not cached
+        """
+        if not self.stretch_cache_size:
+            return None
+        try:
+            stretch = self._stretch_cache.pop(key)
+        except KeyError:
+            self.stretch_cache_misses += 1
+            return None
+        # Reinsert to mark stretch as most recently used
+        self._stretch_cache[key] = stretch
+        self.stretch_cache_hits += 1
+        return stretch
+
+    def _cache_stretch(self, key, stretch):
+        """
+        Add a stretch to the LRU cache, evicting the least recently used
+        stretches if the cache is full.
+
+        @param key: tuple (name of ref seq, offset into reference, # of
+            characters)
+        @param stretch: string extracted from reference
+        @return: None
+        """
+        if not self.stretch_cache_size:
+            return
+        self._stretch_cache[key] = stretch
+        while len(self._stretch_cache) > self.stretch_cache_size:
+            self._stretch_cache.popitem(last=False)
+
+    def _stretch(self, ref_id, starting_rec, ref_off, count):
+        """
+        Return a stretch of characters from the reference, starting the
+        scan of unambiguous stretches at a given record.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param starting_rec: index of last record of ref_id whose offset
+            is <= max(ref_off, 0)
+        @param ref_off: offset into reference, 0-based
+        @param count: # of characters
+        @return: string extracted from reference
+        """
         # Account for negative reference offsets by padding with Ns
         N_count = min(abs(min(ref_off, 0)), count)
-        stretch = ["N"] * N_count
+        stretch = ["N" * N_count]
         count -= N_count
         if not count:
             return "".join(stretch)
         ref_off = max(ref_off, 0)
-        starting_rec = bisect_right(self.offset_in_ref[ref_id], ref_off) - 1
         assert starting_rec >= 0
-        off = self.offset_in_ref[ref_id][starting_rec]
-        buf_off = self.unambig_preceding[ref_id][starting_rec]
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for rec in self.recs[ref_id][starting_rec:]:
-            off += rec[0]
-            while ref_off < off and count > 0:
-                stretch.append("N")
-                count -= 1
-                ref_off += 1
+        ref_extents = self._extents[ref_id]
+        off = int(ref_extents[3, starting_rec])
+        buf_off = int(ref_extents[4, starting_rec])
+        rec_offs, rec_lns = ref_extents[0], ref_extents[1]
+        for rec_index in xrange(starting_rec, len(rec_offs)):
+            rec_ln = int(rec_lns[rec_index])
+            off += int(rec_offs[rec_index])
+            if ref_off < off:
+                # stretch starts in the ambiguous gap preceding this record
+                N_count = min(off - ref_off, count)
+                stretch.append("N" * N_count)
+                count -= N_count
+                ref_off += N_count
             if count == 0:
                 break
-            if ref_off < off + rec[1]:
+            if ref_off < off + rec_ln:
                 # stretch extends through part of the unambiguous stretch
                 buf_off += ref_off - off
             else:
-                buf_off += rec[1]
-            off += rec[1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append("ACGT"[(ord2or3(self.fh4mm[buf_elt]) >> shift_amt) & 3])
-                buf_off += 1
-                count -= 1
-                ref_off += 1
+                buf_off += rec_ln
+            off += rec_ln
+            if ref_off < off:
+                unambig_count = min(off - ref_off, count)
+                stretch.append(self._decode(buf_off, unambig_count))
+                buf_off += unambig_count
+                count -= unambig_count
+                ref_off += unambig_count
             if count == 0:
                 break
         # If the requested stretch went past the last unambiguous
         # character in the chromosome, pad with Ns
-        while count > 0:
-            count -= 1
-            stretch.append("N")
+        stretch.append("N" * count)
         return "".join(stretch)
 
 
@@ -392,6 +632,95 @@ CA
                 self.assertEqual(ref.length["short_name2"], 80)
                 self.assertEqual(ref.length["short_name3"], 2)
 
+            def test_stretch_across_records(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                self.assertEqual(
+                    "".join(
+                        [
+                            "N" * 40,
+                            "A" * 40,
+                            "N" * 40,
+                            "C" * 40,
+                            "N" * 40,
+                            "G" * 40,
+                            "N" * 40,
+                            "TT",
+                        ]
+                    ),
+                    ref.get_stretch("short_name4", 0, 282),
+                )
+                self.assertEqual(
+                    "NNAAA" + "N" * 40 + "CCNNN",
+                    ref.get_stretch("short_name4", 38, 4)
+                    + ref.get_stretch("short_name4", 79, 1)
+                    + ref.get_stretch("short_name4", 80, 40)
+                    + ref.get_stretch("short_name4", 158, 5),
+                )
+                self.assertEqual(
+                    "GTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTANNN",
+                    ref.get_stretch("short_name1", 38, 46),
+                )
+
+            def test_get_stretches(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                intervals = [(240, 42), (-3, 6), (41, 4), (0, 40), (85, 9), (41, 4)]
+                self.assertEqual(
+                    [
+                        ref.get_stretch("short_name4", ref_off, count)
+                        for ref_off, count in intervals
+                    ],
+                    ref.get_stretches("short_name4", intervals),
+                )
+                self.assertEqual([], ref.get_stretches("short_name1", []))
+
+            def test_extent_cache(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                self.assertTrue(os.path.exists(self.fa_fn_1 + ".3.ebwt.npy"))
+                cached_ref = BowtieIndexReference(self.fa_fn_1)
+                self.assertEqual(ref.length, cached_ref.length)
+                self.assertEqual(
+                    ref.get_stretch("short_name4", 30, 200),
+                    cached_ref.get_stretch("short_name4", 30, 200),
+                )
+                # A cache that does not match the index is rebuilt
+                extents = np.load(self.fa_fn_1 + ".3.ebwt.npy")
+                extents[1, 0] += 1
+                np.save(self.fa_fn_1 + ".3.ebwt.npy", extents)
+                rebuilt_ref = BowtieIndexReference(self.fa_fn_1)
+                self.assertEqual(ref.length, rebuilt_ref.length)
+                self.assertEqual(
+                    ref.get_stretch("short_name1", 0, 81),
+                    rebuilt_ref.get_stretch("short_name1", 0, 81),
+                )
+                uncached_ref = BowtieIndexReference(
+                    self.fa_fn_1, cache_extents=False
+                )
+                self.assertEqual(ref.length, uncached_ref.length)
+
+            def test_stretch_cache(self):
+                ref = BowtieIndexReference(self.fa_fn_1, stretch_cache_size=2)
+                self.assertEqual("AAAA", ref.get_stretch("short_name4", 41, 4))
+                self.assertEqual("AAAA", ref.get_stretch("short_name4", 41, 4))
+                self.assertEqual(1, ref.stretch_cache_hits)
+                self.assertEqual(1, ref.stretch_cache_misses)
+                self.assertEqual("CAGTC", ref.get_stretch("short_name2", 0, 5))
+                self.assertEqual(
+                    ["AAAA", "ACGTA"],
+                    ref.get_stretches("short_name4", [(41, 4)])
+                    + ref.get_stretches("short_name1", [(0, 5)]),
+                )
+                self.assertEqual(2, ref.stretch_cache_hits)
+                # Least recently used stretch was evicted
+                self.assertEqual(2, len(ref._stretch_cache))
+                self.assertNotIn(("short_name2", 0, 5), ref._stretch_cache)
+                uncached_ref = BowtieIndexReference(
+                    self.fa_fn_1, stretch_cache_size=0
+                )
+                self.assertEqual(
+                    "AAAA", uncached_ref.get_stretch("short_name4", 41, 4)
+                )
+                self.assertEqual(0, len(uncached_ref._stretch_cache))
+
             def test_off_reference_values(self):
                 ref = BowtieIndexReference(self.fa_fn_1)
                 self.assertEqual("NNNACG", ref.get_stretch("short_name1", -3, 6))
@@ -399,4 +728,16 @@ CA
                 self.assertEqual("NNNNNNNNN", ref.get_stretch("short_name1", 85, 9))
                 self.assertEqual("ANNNNNNNN", ref.get_stretch("short_name1", 80, 9))
 
+            def test_pickle(self):
+                import pickle
+
+                ref = BowtieIndexReference(self.fa_fn_1, stretch_cache_size=2)
+                reopened_ref = pickle.loads(pickle.dumps(ref))
+                self.assertIsNot(ref.fh4mm, reopened_ref.fh4mm)
+                self.assertEqual(2, reopened_ref.stretch_cache_size)
+                self.assertEqual(
+                    ref.get_stretch("short_name4", 30, 200),
+                    reopened_ref.get_stretch("short_name4", 30, 200),
+                )
+
         unittest.main(argv=[sys.argv[0]])
@@ -48,7 +48,8 @@ import tempfile
 import sys
 import os
 import subprocess
-from .transcript import gtf_to_cds, cds_to_feature_length, cds_to_tree
+from .transcript import gtf_to_cds, cds_to_feature_length
+from .annotation_index import write_annotation_index
 from distutils.core import Command
 
 download = {
@@ -545,9 +546,11 @@ class NeoepiscopeDownloader(object):
                 )
                 self._bail()
             self._print_to_screen_and_log("[Configuring] Indexing GENCODE v34...")
-            cds_dict, tx_data_dict = gtf_to_cds(gencode_v34_gtf, gencode_v34_temp)
-            feature_lengths = cds_to_feature_length(cds_dict, tx_data_dict, gencode_v34_temp)
-            cds_to_tree(cds_dict, gencode_v34_temp)
+            cds_dict, tx_data_dict = gtf_to_cds(gencode_v34_gtf, gencode_v34_temp, pickle_it=False)
+            feature_lengths = cds_to_feature_length(
+                cds_dict, tx_data_dict, gencode_v34_temp, pickle_it=False
+            )
+            write_annotation_index(cds_dict, tx_data_dict, feature_lengths, gencode_v34_temp)
         else:
             gencode_v34 = None
         if self._yes_no_query("Download GENCODE v19 gtf annotation file?"):
@@ -575,9 +578,11 @@ class NeoepiscopeDownloader(object):
                 )
                 self._bail()
             self._print_to_screen_and_log("[Configuring] Indexing GENCODE v19...")
-            cds_dict, tx_data_dict = gtf_to_cds(gencode_v19_gtf, gencode_v19_temp)
-            feature_lengths = cds_to_feature_length(cds_dict, tx_data_dict, gencode_v19_temp)
-            cds_to_tree(cds_dict, gencode_v19_temp)
+            cds_dict, tx_data_dict = gtf_to_cds(gencode_v19_gtf, gencode_v19_temp, pickle_it=False)
+            feature_lengths = cds_to_feature_length(
+                cds_dict, tx_data_dict, gencode_v19_temp, pickle_it=False
+            )
+            write_annotation_index(cds_dict, tx_data_dict, feature_lengths, gencode_v19_temp)
         else:
             gencode_v19 = None
         if self._yes_no_query("Download GENCODE vM25 gtf annotation file?"):
@@ -605,9 +610,11 @@ class NeoepiscopeDownloader(object):
                 )
                 self._bail()
             self._print_to_screen_and_log("[Configuring] Indexing GENCODE vM25...")
-            cds_dict, tx_data_dict = gtf_to_cds(gencode_vM25_gtf, gencode_vM25_temp)
-            feature_lengths = cds_to_feature_length(cds_dict, tx_data_dict, gencode_vM25_temp)
-            cds_to_tree(cds_dict, gencode_vM25_temp)
+            cds_dict, tx_data_dict = gtf_to_cds(gencode_vM25_gtf, gencode_vM25_temp, pickle_it=False)
+            feature_lengths = cds_to_feature_length(
+                cds_dict, tx_data_dict, gencode_vM25_temp, pickle_it=False
+            )
+            write_annotation_index(cds_dict, tx_data_dict, feature_lengths, gencode_vM25_temp)
         else:
             gencode_vM25 = None
         if self._yes_no_query("Download GENCODE vM1 gtf annotation file?"):
@@ -635,9 +642,11 @@ class NeoepiscopeDownloader(object):
                 )
                 self._bail()
             self._print_to_screen_and_log("[Configuring] Indexing GENCODE vM1...")
-            cds_dict, tx_data_dict = gtf_to_cds(gencode_vM1_gtf, gencode_vM1_temp)
-            feature_lengths = cds_to_feature_length(cds_dict, tx_data_dict, gencode_vM1_temp)
-            cds_to_tree(cds_dict, gencode_vM1_temp)
+            cds_dict, tx_data_dict = gtf_to_cds(gencode_vM1_gtf, gencode_vM1_temp, pickle_it=False)
+            feature_lengths = cds_to_feature_length(
+                cds_dict, tx_data_dict, gencode_vM1_temp, pickle_it=False
+            )
+            write_annotation_index(cds_dict, tx_data_dict, feature_lengths, gencode_vM1_temp)
         else:
             gencode_vM1 = None
         if self._yes_no_query("Download Bowtie NCBI GRCh38 index?"):
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+reference.py
+
+Includes classes for grabbing genome sequence from FASTA and UCSC .2bit
+files, which can stand in for a Bowtie index wherever reference sequence is
+needed.
+
+The MIT License (MIT)
+Copyright (c) 2018 Mary A. Wood, Austin Nguyen,
+                   Abhinav Nellore, and Reid F. Thompson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import mmap
+import struct
+from bisect import bisect_right
+from .bowtie_index import BowtieIndexReference
+
+# Python 2-3 compatibility
+try:
+    xrange
+except NameError:
+    xrange = range
+
+# Name of file in a dictionary directory recording the reference to use
+_reference_record = "reference_path.txt"
+
+# Bowtie treats soft-masked bases as unambiguous and IUPAC codes as N
+_normalize_bases = bytearray(b"N" * 256)
+for _base in bytearray(b"ACGTacgt"):
+    _normalize_bases[_base] = ord(chr(_base).upper())
+_normalize_bases = bytes(_normalize_bases)
+
+# .2bit files pack four bases per byte, most significant bits first
+_twobit_byte_to_bases = [
+    "".join(["TCAG"[(byte >> shift) & 3] for shift in (6, 4, 2, 0)])
+    for byte in xrange(256)
+]
+
+
+def _padded_stretch(length, ref_off, count, fetch):
+    """ Retrieves a stretch of reference, padding with Ns wherever the
+        stretch falls outside of the reference
+
+        length: length of reference
+        ref_off: offset into reference, 0-based
+        count: # of characters
+        fetch: function taking 0-based start and end (exclusive) offsets
+            within the reference and returning the sequence between them
+        Return value: string extracted from reference
+    """
+    start, end = max(ref_off, 0), min(ref_off + count, length)
+    if start >= end:
+        return "N" * count
+    return "".join(
+        ["N" * (start - ref_off), fetch(start, end), "N" * (ref_off + count - end)]
+    )
+
+
+class FastaReference(object):
+    """
+    Given a faidx-indexed FASTA file, retrieves stretches of characters from
+    the reference with the same interface as BowtieIndexReference. Plain
+    FASTA files are memory-mapped; bgzipped FASTA files (which also need a
+    .gzi index from samtools faidx) are read through pysam.
+    """
+
+    def __init__(self, fasta):
+        self.path = fasta
+        with open(fasta, "rb") as fasta_stream:
+            bgzipped = fasta_stream.read(2) == b"\x1f\x8b"
+        if not os.path.isfile(fasta + ".fai"):
+            raise RuntimeError(
+                "".join(
+                    [
+                        "Cannot find ",
+                        fasta,
+                        ".fai; have you indexed your FASTA with samtools faidx?",
+                    ]
+                )
+            )
+        self.length = {}
+        self._lines = {}
+        with open(fasta + ".fai") as fai_stream:
+            for line in fai_stream:
+                tokens = line.strip().split("\t")
+                if len(tokens) < 5:
+                    continue
+                self.length[tokens[0]] = int(tokens[1])
+                self._lines[tokens[0]] = (
+                    int(tokens[2]),
+                    int(tokens[3]),
+                    int(tokens[4]),
+                )
+        self.refnames = list(self.length.keys())
+        self.rname_lengths = self.length
+        if bgzipped:
+            import pysam
+
+            self._fasta = pysam.FastaFile(fasta)
+            self.fasta_mm = None
+        else:
+            self._fasta = None
+            with open(fasta, "rb") as fasta_stream:
+                self.fasta_mm = mmap.mmap(
+                    fasta_stream.fileno(), 0, access=mmap.ACCESS_READ
+                )
+
+    def __reduce__(self):
+        # Reopen rather than copy memory maps, e.g. in worker processes
+        return (self.__class__, (self.path,))
+
+    def _fetch(self, ref_id, start, end):
+        """ Retrieves normalized reference sequence within reference bounds
+
+            ref_id: name of ref seq
+            start: 0-based start offset
+            end: 0-based end offset (exclusive)
+            Return value: uppercase string with ambiguous characters as N
+        """
+        if self._fasta is not None:
+            raw = self._fasta.fetch(ref_id, start, end).encode("ascii")
+        else:
+            offset, line_bases, line_width = self._lines[ref_id]
+            raw = self.fasta_mm[
+                offset
+                + (start // line_bases) * line_width
+                + start % line_bases : offset
+                + ((end - 1) // line_bases) * line_width
+                + (end - 1) % line_bases
+                + 1
+            ]
+        return raw.translate(_normalize_bases, b"\r\n").decode("ascii")
+
+    def get_stretch(self, ref_id, ref_off, count):
+        """ Retrieves a stretch of characters from the reference, padding
+            with Ns outside of it
+
+            ref_id: name of ref seq, up to & excluding whitespace
+            ref_off: offset into reference, 0-based
+            count: # of characters
+            Return value: string extracted from reference
+        """
+        assert ref_id in self.length
+        return _padded_stretch(
+            self.length[ref_id],
+            ref_off,
+            count,
+            lambda start, end: self._fetch(ref_id, start, end),
+        )
+
+    def get_stretches(self, ref_id, intervals):
+        """ Retrieves several stretches of characters from the same reference
+
+            ref_id: name of ref seq, up to & excluding whitespace
+            intervals: list of (offset into reference, 0-based,
+                # of characters) tuples
+            Return value: list of strings extracted from reference, in the
+                order of intervals
+        """
+        return [self.get_stretch(ref_id, ref_off, count) for ref_off, count in intervals]
+
+
+class TwoBitReference(object):
+    """
+    Given a UCSC .2bit file, memory-maps it and retrieves stretches of
+    characters from the reference with the same interface as
+    BowtieIndexReference. Blocks of Ns recorded in the file are honored;
+    soft-masking is ignored.
+    """
+
+    def __init__(self, twobit):
+        self.path = twobit
+        with open(twobit, "rb") as twobit_stream:
+            self.twobit_mm = mmap.mmap(
+                twobit_stream.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        signature = self.twobit_mm[:4]
+        if signature == struct.pack("<I", 0x1A412743):
+            self._endian = "<"
+        elif signature == struct.pack(">I", 0x1A412743):
+            self._endian = ">"
+        else:
+            raise RuntimeError("%s is not a .2bit file" % twobit)
+        version, sequence_count = self._unpack("II", 4)
+        if version not in (0, 1):
+            raise RuntimeError("Unsupported .2bit version %d in %s" % (version, twobit))
+        offset_format = "Q" if version == 1 else "I"
+        # Index links sequence names to offsets of their records
+        self._records = {}
+        self.refnames = []
+        pos = 16
+        for _ in xrange(sequence_count):
+            name_size = bytearray(self.twobit_mm[pos : pos + 1])[0]
+            name = self.twobit_mm[pos + 1 : pos + 1 + name_size].decode("ascii")
+            pos += 1 + name_size
+            self._records[name] = self._unpack(offset_format, pos)[0]
+            pos += struct.calcsize(offset_format)
+            self.refnames.append(name)
+        self.length = {}
+        for name in self.refnames:
+            self.length[name] = self._unpack("I", self._records[name])[0]
+        self.rname_lengths = self.length
+        # Per-sequence N blocks and DNA offsets, parsed when first needed
+        self._layouts = {}
+
+    def __reduce__(self):
+        # Reopen rather than copy memory maps, e.g. in worker processes
+        return (self.__class__, (self.path,))
+
+    def _unpack(self, fmt, pos):
+        """ Unpacks values from the memory-mapped file
+
+            fmt: struct format string, without byte order
+            pos: offset into file
+            Return value: tuple of unpacked values
+        """
+        fmt = self._endian + fmt
+        return struct.unpack(fmt, self.twobit_mm[pos : pos + struct.calcsize(fmt)])
+
+    def _layout(self, ref_id):
+        """ Parses record header for a sequence
+
+            ref_id: name of ref seq
+            Return value: tuple (N block starts, N block ends, offset of
+                packed DNA in file)
+        """
+        try:
+            return self._layouts[ref_id]
+        except KeyError:
+            pass
+        pos = self._records[ref_id] + 4
+        n_block_count = self._unpack("I", pos)[0]
+        pos += 4
+        n_starts = list(self._unpack("%dI" % n_block_count, pos))
+        pos += 4 * n_block_count
+        n_sizes = self._unpack("%dI" % n_block_count, pos)
+        pos += 4 * n_block_count
+        mask_block_count = self._unpack("I", pos)[0]
+        # Skip mask blocks and reserved word
+        pos += 4 + 8 * mask_block_count + 4
+        layout = (
+            n_starts,
+            [start + size for start, size in zip(n_starts, n_sizes)],
+            pos,
+        )
+        self._layouts[ref_id] = layout
+        return layout
+
+    def _fetch(self, ref_id, start, end):
+        """ Retrieves reference sequence within reference bounds
+
+            ref_id: name of ref seq
+            start: 0-based start offset
+            end: 0-based end offset (exclusive)
+            Return value: uppercase string with ambiguous characters as N
+        """
+        n_starts, n_ends, dna_offset = self._layout(ref_id)
+        decoded = "".join(
+            [
+                _twobit_byte_to_bases[byte]
+                for byte in bytearray(
+                    self.twobit_mm[
+                        dna_offset + (start >> 2) : dna_offset + ((end - 1) >> 2) + 1
+                    ]
+                )
+            ]
+        )
+        seq = decoded[start & 3 : (start & 3) + end - start]
+        # Mask N blocks overlapping the stretch
+        block = max(bisect_right(n_starts, start) - 1, 0)
+        if block >= len(n_starts) or n_starts[block] >= end:
+            return seq
+        seq = list(seq)
+        while block < len(n_starts) and n_starts[block] < end:
+            n_start = max(n_starts[block], start)
+            n_end = min(n_ends[block], end)
+            if n_start < n_end:
+                seq[n_start - start : n_end - start] = "N" * (n_end - n_start)
+            block += 1
+        return "".join(seq)
+
+    def get_stretch(self, ref_id, ref_off, count):
+        """ Retrieves a stretch of characters from the reference, padding
+            with Ns outside of it
+
+            ref_id: name of ref seq, up to & excluding whitespace
+            ref_off: offset into reference, 0-based
+            count: # of characters
+            Return value: string extracted from reference
+        """
+        assert ref_id in self.length
+        return _padded_stretch(
+            self.length[ref_id],
+            ref_off,
+            count,
+            lambda start, end: self._fetch(ref_id, start, end),
+        )
+
+    def get_stretches(self, ref_id, intervals):
+        """ Retrieves several stretches of characters from the same reference
+
+            ref_id: name of ref seq, up to & excluding whitespace
+            intervals: list of (offset into reference, 0-based,
+                # of characters) tuples
+            Return value: list of strings extracted from reference, in the
+                order of intervals
+        """
+        return [self.get_stretch(ref_id, ref_off, count) for ref_off, count in intervals]
+
+
+def open_reference(path):
+    """ Opens a reference genome with the backend suited to its format
+
+        path: path to a UCSC .2bit file, a (possibly bgzipped) faidx-indexed
+            FASTA file, or the basename of a Bowtie index
+        Return value: TwoBitReference, FastaReference, or
+            BowtieIndexReference object
+    """
+    if path.endswith(".2bit"):
+        return TwoBitReference(path)
+    if os.path.isfile(path + ".fai"):
+        return FastaReference(path)
+    bowtie_files = ["".join([path, ".", str(x), ".ebwt"]) for x in range(1, 5)]
+    if all([os.path.isfile(x) for x in bowtie_files]):
+        return BowtieIndexReference(path)
+    raise RuntimeError(
+        "".join(
+            [
+                "Cannot find reference ",
+                path,
+                "; specify a .2bit file, a FASTA file indexed with samtools ",
+                "faidx, or a Bowtie index basename",
+            ]
+        )
+    )
+
+
+def record_reference(path, dictdir):
+    """ Records which reference genome to use with an indexed annotation
+
+        path: path to reference genome (see open_reference())
+        dictdir: path to directory storing indexed annotation
+        No return value.
+    """
+    with open(os.path.join(dictdir, _reference_record), "w") as record_stream:
+        print(os.path.abspath(path), file=record_stream)
+
+
+def recorded_reference(dictdir):
+    """ Retrieves path to reference genome recorded with record_reference()
+
+        dictdir: path to directory storing indexed annotation
+        Return value: path to reference genome, or None if none was recorded
+    """
+    record = os.path.join(dictdir, _reference_record)
+    if not os.path.isfile(record):
+        return None
+    with open(record) as record_stream:
+        return record_stream.read().strip() or None
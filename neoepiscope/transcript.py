@@ -42,26 +42,44 @@ from __future__ import absolute_import, division, print_function
 from . import bowtie_index
 import collections
 import copy
+import io
+import itertools
 import bisect
 import string
 import re
 import os
 import pickle
 from intervaltree import Interval, IntervalTree
+from .annotation_index import IntervalIndex
 from operator import itemgetter
+import numpy as np
 from numpy import median
 import sys
 import warnings
 import contextlib
-import networkx as nx
 
 from sys import version_info
 
 if version_info[0] < 3:
     from string import maketrans
     revcomp_translation_table = maketrans("ATCG", "TAGC")
+    _complement_table = maketrans("ATCGN", "TAGCN")
 else:
     revcomp_translation_table = str.maketrans("ATCG", "TAGC")
+    _complement_table = str.maketrans("ATCGN", "TAGCN")
+
+# Records of an edit to a transcript, a deletion, and a segment of
+#   annotated sequence; as named tuples, they need no more memory than plain
+#   tuples and compare equal to them
+Edit = collections.namedtuple(
+    "Edit", ["seq", "mutation_type", "mutation_class", "mutation_info"]
+)
+Deletion = collections.namedtuple(
+    "Deletion", ["start", "end", "mutation_class", "mutation_info"]
+)
+Segment = collections.namedtuple(
+    "Segment", ["seq", "mutation_class", "mutation_info", "position"]
+)
 
 
 @contextlib.contextmanager
@@ -243,6 +261,43 @@ _codon_table = {
 }
 
 
+# Base-5 digit of each base in a codon's index; any character other than
+#   A, C, G or T is 4, so codons containing one index "?" in the table below
+_base_index = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate("ACGT"):
+    _base_index[ord(_base)] = _i
+_codon_index_peptides = np.frombuffer(
+    "".join(
+        [
+            _codon_table.get("".join(codon), "?")
+            for codon in itertools.product("ACGT?", repeat=3)
+        ]
+    ).encode("ascii"),
+    dtype=np.uint8,
+)
+# Sequences shorter than this are translated codon by codon
+_bulk_translation_min_size = 96
+
+
+def _translate_codon(codon):
+    """ Translates a single codon, which may contain N's.
+        A codon with an N in the wobble position alone is translated when
+        all four possible codons encode the same amino acid.
+        codon: three-base string
+        Return value: amino acid, "X" for a stop codon, or "?" if unknown
+    """
+    if "N" not in codon:
+        return _codon_table[codon]
+    if codon.count("N") == 1 and codon[2] == "N":
+        # Only 1 N in the wobble position
+        codon_options = set(
+            [_codon_table["".join([codon[:2], x])] for x in ["A", "C", "G", "T"]]
+        )
+        if len(codon_options) == 1:
+            return list(codon_options)[0]
+    return "?"
+
+
 def seq_to_peptide(seq, reverse_strand=False, require_ATG=False):
     """ Translates nucleotide sequence into peptide sequence.
         All codons including and after stop codon are recorded as X's.
@@ -259,29 +314,36 @@ def seq_to_peptide(seq, reverse_strand=False, require_ATG=False):
             seq = seq[start:]
         else:
             return ""
-    seq_size = len(seq)
-    peptide = []
-    for i in range(0, seq_size - seq_size % 3, 3):
-        if 'N' not in seq[i : i + 3]:
-            codon = _codon_table[seq[i : i + 3]]
-        elif seq[i : i + 3].count('N') == 1 and seq[i+2] == 'N':
-            # Only 1 N in the wobble position
-            codon_options = set(
-                [_codon_table[''.join([seq[i : i + 2], x])] 
-                                        for x in ['A', 'C', 'G', 'T']]
-                )
-            if len(codon_options) == 1:
-                codon = list(codon_options)[0]
-            else:
-                codon = '?'
-        else:
-            codon = '?'
-        peptide.append(codon)
-        if codon == "X":
-            break
-    # for j in range(i + 3, seq_size - seq_size % 3, 3):
-    # peptide.append('X')
-    return "".join(peptide)
+    seq_size = len(seq) - len(seq) % 3
+    if seq_size < _bulk_translation_min_size:
+        peptide = []
+        for i in range(0, seq_size, 3):
+            codon = _translate_codon(seq[i : i + 3])
+            peptide.append(codon)
+            if codon == "X":
+                break
+        return "".join(peptide)
+    codon_bases = _base_index[
+        np.frombuffer(seq[:seq_size].encode("ascii"), dtype=np.uint8)
+    ].reshape(-1, 3)
+    peptide = _codon_index_peptides[
+        codon_bases[:, 0] * 25 + codon_bases[:, 1] * 5 + codon_bases[:, 2]
+    ]
+    # Codons with a base other than A, C, G or T, such as N, are translated
+    #   one at a time, but only up to the first stop
+    slow_codons = np.flatnonzero(peptide == ord("?"))
+    peptide = peptide.tobytes().decode("ascii")
+    stop = peptide.find("X")
+    if stop >= 0:
+        peptide = peptide[: stop + 1]
+    if slow_codons.size:
+        peptide = list(peptide)
+        for i in slow_codons:
+            if i >= len(peptide):
+                break
+            peptide[i] = _translate_codon(seq[3 * i : 3 * i + 3])
+        peptide = "".join(peptide)
+    return peptide
 
 
 class Transcript(object):
@@ -291,7 +353,7 @@ class Transcript(object):
     # I.E., should we break up a somatic deletion into two separate mutations
     # that surround the germline mutation? Or do we only call the somatic?
 
-    def __init__(self, bowtie_reference_index, cds, transcript_id):
+    def __init__(self, bowtie_reference_index, cds, transcript_id, prefetch=False):
         """ Initializes Transcript object.
             This class assumes edits added to a transcript are properly
             phased, consistent, and nonredundant. Most conspicuously, there
@@ -301,6 +363,9 @@ class Transcript(object):
             cds: list of all CDS lines for exactly one transcript from GTF;
                 a line can be a list pre-split by '\t' or not yet split
             transcript_id: transcript ID
+            prefetch: whether to retrieve the sequences of all exons in one
+                pass now rather than on first use (boolean); they are kept
+                for later calls to edit() and annotated_seq()
         """
         assert len(cds) > 0
         self.bowtie_reference_index = bowtie_reference_index
@@ -362,9 +427,15 @@ class Transcript(object):
         #                            self.intervals
         #                        )
         #            )
-        # For retrieving save point
+        # For retrieving save point; edits and save point share structure
+        #   until the next edit, which copies it
         self.last_edits = collections.defaultdict(list)
         self.last_deletion_intervals = []
+        self._edits_shared = False
+        # Edit states are numbered so annotated_seq() results can be kept
+        #   for the reference (state 0), the save point, and the current state
+        self._state, self._saved_state, self._next_state = 0, 0, 1
+        self._annotated_seqs = {}
         # Need to sort to bisect_left properly when editing!
         self.intervals.sort()
         if self._start_codon:
@@ -377,6 +448,69 @@ class Transcript(object):
             self.stop_codon_index = bisect.bisect_left(self.intervals, self._stop_codon)
         else:
             self.stop_codon_index = None
+        # Reference sequence of each exon, fetched once
+        self._exon_offsets = [
+            self.intervals[i] + 1 for i in range(0, len(self.intervals), 2)
+        ]
+        self._exon_seqs = None
+        if prefetch:
+            self._fetch_exons()
+
+    def _fetch_exons(self):
+        """ Retrieves the reference sequences of all exons in one pass.
+
+            No return value.
+        """
+        self._exon_seqs = self.bowtie_reference_index.get_stretches(
+            self.chrom,
+            [
+                (self.intervals[i] + 1, self.intervals[i + 1] - self.intervals[i])
+                for i in range(0, len(self.intervals), 2)
+            ],
+        )
+
+    def _reference_stretches(self, stretches):
+        """ Retrieves stretches of reference sequence, cutting those within
+            an exon from its sequence rather than fetching them again.
+
+            stretches: list of (0-based offset, number of bases) tuples
+            Return value: list of sequences, in the order of stretches
+        """
+        if self._exon_seqs is None:
+            self._fetch_exons()
+        seqs, missing = [], []
+        for i, (offset, count) in enumerate(stretches):
+            exon = bisect.bisect_right(self._exon_offsets, offset) - 1
+            if (
+                count > 0
+                and exon >= 0
+                and offset + count
+                <= self._exon_offsets[exon] + len(self._exon_seqs[exon])
+            ):
+                start = offset - self._exon_offsets[exon]
+                seqs.append(self._exon_seqs[exon][start : start + count])
+            else:
+                seqs.append(None)
+                missing.append(i)
+        if missing:
+            fetched = self.bowtie_reference_index.get_stretches(
+                self.chrom, [stretches[i] for i in missing]
+            )
+            for i, seq in zip(missing, fetched):
+                seqs[i] = seq
+        return seqs
+
+    def _new_state(self):
+        """ Prepares edits for a change, numbering the state that results.
+
+            No return value.
+        """
+        if self._edits_shared:
+            self.edits = copy.copy(self.edits)
+            self.deletion_intervals = list(self.deletion_intervals)
+            self._edits_shared = False
+        self._state = self._next_state
+        self._next_state += 1
 
     def reset(self, reference=False):
         """ Resets to last save point or reference (i.e., removes all edits).
@@ -389,11 +523,16 @@ class Transcript(object):
             self.edits = collections.defaultdict(list)
             self.deletion_intervals = []
             self.boundary_spanning_deletion = False
+            self._edits_shared = False
+            self._state = 0
         else:
-            self.edits = copy.copy(self.last_edits)
-            self.deletion_intervals = copy.copy(self.last_deletion_intervals)
-            if [x for x in self.deletion_intervals if x[3][6]] == []:
-                self.boundary_spanning_deletion = False
+            self.edits = self.last_edits
+            self.deletion_intervals = self.last_deletion_intervals
+            self._edits_shared = True
+            self._state = self._saved_state
+            self.boundary_spanning_deletion = any(
+                [x[3][6] for x in self.deletion_intervals]
+            )
 
     def edit(self, seq, pos, mutation_type="V", mutation_class="S", vaf=None):
         """ Adds an edit to the transcript.
@@ -411,14 +550,13 @@ class Transcript(object):
             No return value.
         """
         ## Need to add check for only 1 mutation of each class per position
+        self._new_state()
         if mutation_type == "D":
             try:
                 deletion_size = int(seq)
             except ValueError:
                 deletion_size = len(seq)
-                ref_deletion = self.bowtie_reference_index.get_stretch(
-                    self.chrom, pos - 1, pos + deletion_size + 1 - pos - 1
-                )
+                ref_deletion = self._reference_stretches([(pos - 1, deletion_size)])[0]
                 if ((bisect.bisect_left(self.intervals, pos-2) % 2) 
                     and (bisect.bisect_left(self.intervals, pos+deletion_size-2) % 2)):
                     boundary_span = False
@@ -433,7 +571,7 @@ class Transcript(object):
                     boundary_span = True
                     self.boundary_spanning_deletion = True
                 if seq == ref_deletion:
-                    del_interval = (
+                    del_interval = Deletion(
                         pos - 2,
                         pos + deletion_size - 2,
                         mutation_class,
@@ -467,16 +605,14 @@ class Transcript(object):
                 else:
                     boundary_span = True
                     self.boundary_spanning_deletion = True
-                del_interval = (
+                del_interval = Deletion(
                     pos - 2,
                     pos + deletion_size - 2,
                     mutation_class,
                     (
                         self.chrom,
                         pos,
-                        self.bowtie_reference_index.get_stretch(
-                            self.chrom, pos - 1, pos + deletion_size + 1 - pos - 1
-                        ),
+                        self._reference_stretches([(pos - 1, deletion_size)])[0],
                         "",
                         mutation_type,
                         vaf, boundary_span
@@ -514,14 +650,14 @@ class Transcript(object):
         elif mutation_type == "I":
             other_insertions = [edit for edit in self.edits[pos - 1] if edit[1] == 'I']
             if len(other_insertions) == 0:
-                self.edits[pos - 1].append(
-                    (
+                self.edits[pos - 1] = self.edits[pos - 1] + [
+                    Edit(
                         seq,
                         mutation_type,
                         mutation_class,
                         (self.chrom, pos, "", seq, mutation_type, vaf),
                     )
-                )
+                ]
             else:
                 raise NotImplementedError("".join(
                         [
@@ -532,19 +668,17 @@ class Transcript(object):
                     )
                 )
         elif mutation_type == "V":
-            reference_seq = self.bowtie_reference_index.get_stretch(
-                self.chrom, pos - 1, len(seq)
-            )
+            reference_seq = self._reference_stretches([(pos - 1, len(seq))])[0]
             other_snvs = [edit for edit in self.edits[pos - 1] if edit[1] == 'V']
             if mutation_class not in [snv[2] for snv in other_snvs]:
-                self.edits[pos - 1].append(
-                    (
+                self.edits[pos - 1] = self.edits[pos - 1] + [
+                    Edit(
                         seq,
                         mutation_type,
                         mutation_class,
                         (self.chrom, pos, reference_seq, seq, mutation_type, vaf),
                     )
-                )
+                ]
             else:
                 class_dict = {"S": "somatic", "G": "germline"}
                 raise NotImplementedError(
@@ -619,7 +753,7 @@ class Transcript(object):
         intervals = [start - 1] + self.intervals[start_index:end_index] + [end]
         assert len(intervals) % 2 == 0
         # Include only relevant deletion intervals
-        relevant_deletion_intervals, edits = [], collections.defaultdict(list)
+        relevant_deletion_intervals = []
         for i in range(0, len(self.deletion_intervals)):
             if (
                 self.deletion_intervals[i][0] <= self.intervals[0]
@@ -847,12 +981,16 @@ class Transcript(object):
         return (edits, adjusted_intervals)
 
     def save(self):
-        """ Creates save point for edits.
+        """ Creates save point for edits. The save point shares edits with
+            the transcript until its next edit, so saving and resetting are
+            cheap.
 
             No return value.
         """
-        self.last_edits = copy.copy(self.edits)
-        self.last_deletion_intervals = copy.copy(self.deletion_intervals)
+        self.last_edits = self.edits
+        self.last_deletion_intervals = self.deletion_intervals
+        self._edits_shared = True
+        self._saved_state = self._state
 
     def reading_frame(self, pos):
         """ Retrieves reading frame (0, 1, or 2) at given coordinate.
@@ -917,83 +1055,27 @@ class Transcript(object):
                 )
                 return (seq_length - 1) % 3
 
-    def _seq_append(
-        self, seq_list, seq, mutation_class, mutation_info, position, merge=True
-    ):
-        """ Appends mutation to seq_list, merging successive mutations.
-            seq_list: list of tuples (sequence, type) where type is one
-                of R, G, or S (for respectively reference, germline edit, or
-                somatic edit). Empty sequence means there was a deletion.
+    def _seq_append(self, seq_list, seq, mutation_class, mutation_info, position):
+        """ Appends a segment to seq_list; segments are never merged, so
+            each is built once, when it is appended.
+            seq_list: list of Segments (sequence, type, mutation info,
+                position) where type is one of R, G, or S (for respectively
+                reference, germline edit, or somatic edit). Empty sequence
+                means there was a deletion.
             seq: seq to add
             mutation_class: S for somatic, G for germline, R for reference
             mutation_info: tuple containing (1 based mutation position from
-                vcf, mutation sequence, mutation type, and VAF)
+                vcf, mutation sequence, mutation type, and VAF), or a list
+                of such tuples
             position: 1-based genomic position of first base added
             No return value; seq_list is merely updated.
         """
-        if not merge:
-            if seq or mutation_class != "R":
-                if isinstance(mutation_info, list):
-                    seq_list.append(
-                        (
-                            seq,
-                            mutation_class,
-                            [mutation_info[i] for i in range(0, len(mutation_info))],
-                            position,
-                        )
-                    )
-                else:
-                    seq_list.append((seq, mutation_class, [mutation_info], position))
-            return
-        try:
-            condition = seq_list[-1][1] == mutation_class
-        except IndexError:
-            # Add first item in seq_list
-            assert not seq_list
-            if seq or mutation_class != "R":
-                if isinstance(mutation_info, list):
-                    seq_list.append(
-                        (
-                            seq,
-                            mutation_class,
-                            [mutation_info[i] for i in range(0, len(mutation_info))],
-                            position,
-                        )
-                    )
-                else:
-                    seq_list.append((seq, mutation_class, [mutation_info], position))
-            return
-        if condition:
-            if self.rev_strand:
-                adjusted_position = position
-            else:
-                adjusted_position = seq_list[-1][3]
+        if seq or mutation_class != "R":
             if isinstance(mutation_info, list):
-                adjusted_mutation_info = seq_list[-1][2] + [
-                    x for x in mutation_info if x not in seq_list[-1][2]
-                ]
-            elif mutation_info not in seq_list[-1][2]:
-                adjusted_mutation_info = seq_list[-1][2] + [mutation_info]
+                mutation_info = list(mutation_info)
             else:
-                adjusted_mutation_info = seq_list[-1][2]
-            seq_list[-1] = (
-                seq_list[-1][0] + seq,
-                mutation_class,
-                adjusted_mutation_info,
-                adjusted_position,
-            )
-        elif seq or mutation_class != "R":
-            if isinstance(mutation_info, list):
-                seq_list.append(
-                    (
-                        seq,
-                        mutation_class,
-                        [mutation_info[i] for i in range(0, len(mutation_info))],
-                        position,
-                    )
-                )
-            else:
-                seq_list.append((seq, mutation_class, [mutation_info], position))
+                mutation_info = [mutation_info]
+            seq_list.append(Segment(seq, mutation_class, mutation_info, position))
 
     def hybridize_seq(self, prev_seq, new_seq, include_somatic=1, include_germline=2):
         """Hybridizes overlapping germline and somatic deletions for
@@ -1037,41 +1119,31 @@ class Transcript(object):
                 ref = [self.chrom, prev_pos, prev_del_seq, "", prev_mut_info]
             else:
                 ref = [self.chrom, new_seq[3], "", prev_del_seq, []]
-        adj_alt_seq = copy.copy(alt[2])
-        adj_alt_allele = copy.copy(alt[3])
-        adj_alt_mut_info = copy.copy(alt[4])
-        adj_ref_seq = copy.copy(ref[2])
-        adj_ref_allele = copy.copy(ref[3])
-        adj_ref_mut_info = copy.copy(ref[4])
+        # Strings are immutable, so only the lists need copying
+        adj_alt_seq = alt[2]
+        adj_alt_allele = alt[3]
+        adj_alt_mut_info = list(alt[4])
+        adj_ref_seq = ref[2]
+        adj_ref_allele = ref[3]
+        adj_ref_mut_info = list(ref[4])
         if self.rev_strand:
             for mut in new_seq[2]:
+                # Reverse complement each sequence once, not once per overlap
+                #   length tried
+                mut_revcomp = mut[2][::-1].translate(revcomp_translation_table)
+                alt_revcomp = adj_alt_seq[::-1].translate(revcomp_translation_table)
                 adj_index = max(
                     i
                     for i in range(len(mut[2]) + 1)
-                    if adj_alt_seq[::-1]
-                    .translate(revcomp_translation_table)
-                    .endswith(mut[2][::-1].translate(revcomp_translation_table)[:i])
+                    if alt_revcomp.endswith(mut_revcomp[:i])
                 )
-                added_seq = (
-                    mut[2][::-1]
-                    .translate(revcomp_translation_table)[adj_index:][::-1]
-                    .translate(revcomp_translation_table)
+                added_seq = mut_revcomp[adj_index:][::-1].translate(
+                    revcomp_translation_table
                 )
                 adj_alt_seq = added_seq + adj_alt_seq
                 adj_alt_mut_info.append(mut)
                 alt[1] = new_seq[3]
-                adj_ref_index = max(
-                    i
-                    for i in range(len(mut[2]) + 1)
-                    if adj_ref_seq[::-1]
-                    .translate(revcomp_translation_table)
-                    .endswith(mut[2][::-1].translate(revcomp_translation_table)[:i])
-                )
-                added_ref_seq = (
-                    mut[2][::-1]
-                    .translate(revcomp_translation_table)[adj_index:][::-1]
-                    .translate(revcomp_translation_table)
-                )
+                added_ref_seq = added_seq
                 if (new_seq[1] == "G" and include_germline == 2) or (
                     new_seq[1] == "S" and include_somatic == 2
                 ):
@@ -1115,13 +1187,13 @@ class Transcript(object):
                             if adj_ref_seq.endswith(mut[2][:i])
                         ) :
                     ]
-        alt[2] = copy.copy(adj_alt_seq)
-        alt[3] = copy.copy(adj_alt_allele)
-        alt[4] = copy.copy(adj_alt_mut_info)
-        ref[2] = copy.copy(adj_ref_seq)
-        ref[3] = copy.copy(adj_ref_allele)
-        ref[4] = copy.copy(adj_ref_mut_info)
-        return ("", "H", [alt, ref], alt[1])
+        alt[2] = adj_alt_seq
+        alt[3] = adj_alt_allele
+        alt[4] = adj_alt_mut_info
+        ref[2] = adj_ref_seq
+        ref[3] = adj_ref_allele
+        ref[4] = adj_ref_mut_info
+        return Segment("", "H", [alt, ref], alt[1])
 
     def annotated_seq(
         self, start=None, end=None, genome=True, include_somatic=1, include_germline=2
@@ -1152,6 +1224,33 @@ class Transcript(object):
                 adj. deletion, allele seq, [mutation information]] for the alternate and
                 reference sequences, respectively.
         """
+        # Results are kept for the reference, the save point, and the
+        #   current state of edits
+        key = (self._state, start, end, genome, include_somatic, include_germline)
+        if key in self._annotated_seqs:
+            return list(self._annotated_seqs[key])
+        annotated_seq = self._annotated_seq(
+            start, end, genome, include_somatic, include_germline
+        )
+        if not self.boundary_spanning_deletion:
+            # Warnings about truncated transcripts are given each time
+            kept = (0, self._saved_state, self._state)
+            for old_key in list(self._annotated_seqs.keys()):
+                if old_key[0] not in kept:
+                    del self._annotated_seqs[old_key]
+            self._annotated_seqs[key] = annotated_seq
+        return list(annotated_seq)
+
+    def _annotated_seq(self, start, end, genome, include_somatic, include_germline):
+        """ Builds transcript sequence for annotated_seq().
+
+            start: start position (1-indexed, inclusive), or None
+            end: end position (1-indexed, inclusive), or None
+            genome: True iff genome coordinates are specified
+            include_somatic: whether to include somatic mutations
+            include_germline: whether to include germline mutations
+            Return value: see annotated_seq()
+        """
         # Use 0-based coordinates internally
         if start is None:
             start = self.intervals[0] + 2
@@ -1192,19 +1291,18 @@ class Transcript(object):
                         new_edits[-1] = new_edits[intervals[i][0]]
                         del new_edits[intervals[i][0]]"""
                 i += 2
-            # Grab reference sequence to pull from
-            seqs = []
-            for i in range(0, len(intervals), 2):
-                seqs.append(
-                    (
-                        self.bowtie_reference_index.get_stretch(
-                            self.chrom,
-                            intervals[i][0] + 1,
-                            intervals[i + 1][0] - intervals[i][0],
-                        ),
-                        (intervals[i][0] + 2, intervals[i + 1][0] + 1),
-                    )
-                )
+            # Grab reference sequence to pull from in a single pass
+            stretches = self._reference_stretches(
+                [
+                    (intervals[i][0] + 1, intervals[i + 1][0] - intervals[i][0])
+                    for i in range(0, len(intervals), 2)
+                ]
+            )
+            seqs = [
+                (stretches[i // 2], (intervals[i][0] + 2, intervals[i + 1][0] + 1))
+                for i in range(0, len(intervals), 2)
+            ]
+            interval_positions = [x[0] for x in intervals]
             # Now build sequence in order of increasing edit position
             i = 1
             pos_group, final_seq = [], []
@@ -1228,7 +1326,6 @@ class Transcript(object):
                                 intervals[i - 1][1],
                                 intervals[i - 1][2],
                                 genomic_position,
-                                merge=False,
                             )
                         # Add reference sequence
                         if self.rev_strand:
@@ -1238,7 +1335,6 @@ class Transcript(object):
                                 "R",
                                 tuple(),
                                 seqs[(i - 1) // 2][1][0] + last_index + fill - 1,
-                                merge=False,
                             )
                         else:
                             self._seq_append(
@@ -1247,7 +1343,6 @@ class Transcript(object):
                                 "R",
                                 tuple(),
                                 seqs[(i - 1) // 2][1][0] + last_index,
-                                merge=False,
                             )
                         # Add edits
                         for edit in new_edits[pos_to_add]:
@@ -1258,22 +1353,21 @@ class Transcript(object):
                             else:
                                 # Edit is an insertion
                                 assert edit[1] == "I"
-                                ins_index = bisect.bisect_left([x[0] for x in intervals], edit[3][1] - 1)
+                                ins_index = bisect.bisect_left(interval_positions, edit[3][1] - 1)
                                 if (ins_index % 2) or (intervals[ins_index][0] == (edit[3][1] - 1)):
                                     # More reference sequence is needed to fill in - use snv for this
                                     snv = (
-                                            self.bowtie_reference_index.get_stretch(
-                                                                        self.chrom, 
-                                                                        edit[3][1] - 1, 1
-                                            ), "R", tuple(), edit[3][1]
+                                            self._reference_stretches(
+                                                [(edit[3][1] - 1, 1)]
+                                            )[0], "R", tuple(), edit[3][1]
 
                                     )
                                 else:
                                     # No reference sequence needed to fill in - use placeholder snv
                                     snv = ("", "R", tuple(), edit[3][1])
                                 insertion = (edit[0], edit[2], edit[3], edit[3][1])
-                        self._seq_append(final_seq, *snv, merge=False)
-                        self._seq_append(final_seq, *insertion, merge=False)
+                        self._seq_append(final_seq, *snv)
+                        self._seq_append(final_seq, *insertion)
                         last_index += fill + 1
                         last_pos += fill + 1
                     if intervals[i - 1][1] != "R":
@@ -1289,7 +1383,6 @@ class Transcript(object):
                                 intervals[i - 1][1],
                                 intervals[i - 1][2],
                                 genomic_position,
-                                merge=False,
                             )
                     # Add reference sequence if necessary
                     ref_to_add = seqs[(i - 1) // 2][0][last_index:]
@@ -1301,7 +1394,6 @@ class Transcript(object):
                                 "R",
                                 tuple(),
                                 seqs[(i - 1) // 2][1][1],
-                                merge=False,
                             )
                         else:
                             self._seq_append(
@@ -1310,7 +1402,6 @@ class Transcript(object):
                                 "R",
                                 tuple(),
                                 seqs[(i - 1) // 2][1][0] + last_index,
-                                merge=False,
                             )
                     if intervals[i][1] != "R":
                         # Exonic section bounded by deletion on right - add to seq
@@ -1324,7 +1415,6 @@ class Transcript(object):
                             intervals[i][1],
                             intervals[i][2],
                             genomic_position,
-                            merge=False,
                         )
                     # Move to next exonic section
                     i += 2
@@ -1345,7 +1435,6 @@ class Transcript(object):
                                     intervals[i - 1][1],
                                     intervals[i - 1][2],
                                     genomic_position,
-                                    merge=False,
                                 )
                             # Add reference sequence
                             if self.rev_strand:
@@ -1355,7 +1444,6 @@ class Transcript(object):
                                     "R",
                                     tuple(),
                                     seqs[(i - 1) // 2][1][1],
-                                    merge=False,
                                 )
                             else:
                                 self._seq_append(
@@ -1364,7 +1452,6 @@ class Transcript(object):
                                     "R",
                                     tuple(),
                                     seqs[(i - 1) // 2][1][0],
-                                    merge=False,
                                 )
                             if intervals[i][1] != "R":
                                 # Exonic section bounded by deletion on right - add to seq
@@ -1380,7 +1467,6 @@ class Transcript(object):
                                     intervals[i][1],
                                     intervals[i][2],
                                     genomic_position,
-                                    merge=False,
                                 )
                             # Move to next exonic section
                             i += 2
@@ -1394,7 +1480,7 @@ class Transcript(object):
             if self.rev_strand:
                 # Reverse complement sequence
                 final_seq = [
-                    (
+                    Segment(
                         seq[::-1].translate(revcomp_translation_table),
                         mutation_class,
                         orig_seq,
@@ -1438,11 +1524,11 @@ class Transcript(object):
                 for i in range(0, len(adj_seq)):
                     if adj_seq[i][0] == '':
                         if adj_seq[i][1] in ['G', 'S']:
-                            adj_seq[i] = (adj_seq[i][0], adj_seq[i][1], 
+                            adj_seq[i] = Segment(adj_seq[i][0], adj_seq[i][1], 
                                           [adj_seq[i][2][0][:-1]],
                                           adj_seq[i][3])
                         elif adj_seq[i][1] == 'H':
-                            adj_seq[i] = (adj_seq[i][0], adj_seq[i][1], 
+                            adj_seq[i] = Segment(adj_seq[i][0], adj_seq[i][1], 
                                           [adj_seq[i][2][0][0:4]+[[x[:-1] for x in adj_seq[i][2][0][4]]], 
                                            adj_seq[i][2][1][0:4]+[[x[:-1] for x in adj_seq[i][2][1][4]]]],
                                           adj_seq[i][3])
@@ -1512,11 +1598,11 @@ class Transcript(object):
                 for i in range(0, len(truncated_seq)):
                     if truncated_seq[i][0] == '':
                         if truncated_seq[i][1] in ['G', 'S']:
-                            truncated_seq[i] = (truncated_seq[i][0], truncated_seq[i][1], 
+                            truncated_seq[i] = Segment(truncated_seq[i][0], truncated_seq[i][1], 
                                                 [truncated_seq[i][2][0][:-1]],
                                                 truncated_seq[i][3])
                         elif truncated_seq[i][1] == 'H':
-                            truncated_seq[i] = (truncated_seq[i][0], truncated_seq[i][1], 
+                            truncated_seq[i] = Segment(truncated_seq[i][0], truncated_seq[i][1], 
                                                 [truncated_seq[i][2][0][0:4]+[[x[:-1] for x in truncated_seq[i][2][0][4]]], 
                                                  truncated_seq[i][2][1][0:4]+[[x[:-1] for x in truncated_seq[i][2][1][4]]]],
                                                 truncated_seq[i][3])
@@ -1728,7 +1814,6 @@ class Transcript(object):
         ATG_limit = 2
         coding_start, ref_start, coding_stop, ref_stop = -1, -1, -1, -1
         counter, ref_counter = 0, 0  # hold edited transcript level coordinates
-        linker_dict = {}
         seq_previous = []
         new_ATG_upstream = False
         transcript_warnings = []
@@ -1939,8 +2024,6 @@ class Transcript(object):
                         )
                 sequence += seq[0]
                 ref_sequence += seq[0]
-                for i in range(len(seq[0])):
-                    linker_dict[counter+i+1] = seq[3] + (i*strand)
                 counter += len(seq[0])
                 ref_counter += len(seq[0])
                 continue
@@ -1975,8 +2058,6 @@ class Transcript(object):
                         )
                         TAA_TGA_TAG = [seq[0], seq[1], seq[2][0][4], seq[3]]
                 sequence += seq[2][0][3]
-                for i in range(len(seq[0])):
-                    linker_dict[counter+i+1] = seq[3] + (i*strand)
                 counter += len(seq[2][0][3])
                 if self.rev_strand:
                     ref_sequence += seq[2][1][3][::-1].translate(
@@ -2041,8 +2122,6 @@ class Transcript(object):
                         TAA_TGA_TAG = seq
                 '''
                 sequence += seq[0]
-                for i in range(len(seq[0])):
-                    linker_dict[counter+i+1] = seq[3]
                 counter += len(seq[0])
                 if (seq[1] == "G" and include_germline == 2) or (
                     seq[1] == "S" and include_somatic == 2
@@ -2068,8 +2147,6 @@ class Transcript(object):
                         )
                         TAA_TGA_TAG = seq
                 sequence += seq[0]
-                for i in range(len(seq[0])):
-                    linker_dict[counter+i+1] = seq[3] + (i*strand)
                 counter += len(seq[0])
                 if (seq[1] == "G" and include_germline == 2) or (
                     seq[1] == "S" and include_somatic == 2
@@ -2525,7 +2602,204 @@ class Transcript(object):
             return peptide_seqs, protein
 
 
-def gtf_to_cds(gtf_file, dictdir, pickle_it=True):
+# Transcript types retained from GTF
+_coding_transcript_types = frozenset(
+    [
+        "protein_coding",
+        "nonsense_mediated_decay",
+        "polymorphic_pseudogene",
+        "IG_V_gene",
+        "TR_V_gene",
+    ]
+)
+
+# Lines of a compressed GTF handed to each worker process at a time
+_gtf_batch_size = 100000
+
+# Valid values of the GTF attributes used
+_gtf_value_patterns = {
+    "transcript_id": r"[A-Z0-9._]+",
+    "transcript_type": r"[A-Za-z_]+",
+    "gene_id": r"[A-Z0-9._]+",
+    "gene_name": r"[A-Za-z0-9._-]+",
+}
+_gtf_markers = {key: "".join([key, ' "']) for key in _gtf_value_patterns}
+_gtf_value_chars = {
+    "transcript_id": string.ascii_uppercase + string.digits + "._",
+    "transcript_type": string.ascii_letters + "_",
+    "gene_id": string.ascii_uppercase + string.digits + "._",
+    "gene_name": string.ascii_letters + string.digits + "._-",
+}
+# Greedy patterns taking the last valid value of a repeated attribute
+_gtf_fallbacks = {
+    key: re.compile("".join([".*", key, ' "(', pattern, ')"[;].*']))
+    for key, pattern in _gtf_value_patterns.items()
+}
+
+
+def gtf_attribute(attributes, key):
+    """ Extracts the value of an attribute from a GTF attribute field as the
+        pattern .*key "(value)";.* would, but without a regular expression
+        search in the usual case of a key that appears once
+
+        attributes: ninth column of a GTF line
+        key: one of transcript_id, transcript_type, gene_id, or gene_name
+
+        Return value: attribute value, or the whole attribute field if there
+            is no valid value
+    """
+    marker = _gtf_markers[key]
+    start = attributes.find(marker)
+    if start < 0:
+        return attributes
+    if attributes.rfind(marker) != start:
+        return _gtf_fallbacks[key].sub(r"\1", attributes)
+    start += len(marker)
+    end = attributes.find('";', start)
+    if end < 0:
+        return attributes
+    value = attributes[start:end]
+    # Valid iff nonempty and made up only of allowed characters
+    if value and not value.strip(_gtf_value_chars[key]):
+        return value
+    return attributes
+
+
+def _parse_gtf_lines(lines):
+    """ Parses GTF lines into the per-transcript data gtf_to_cds() gathers
+
+        lines: iterable of GTF lines, either strings or ASCII bytes
+
+        Return value: tuple (cds_dict, cds_lines, tx_data_dict) of
+            defaultdicts keyed by transcript ID, each listing data in the
+            order it appears among lines
+    """
+    cds_dict = collections.defaultdict(list)
+    cds_lines = collections.defaultdict(list)
+    tx_data_dict = collections.defaultdict(list)
+    for line in lines:
+        try:
+            line = line.decode("ascii")
+        except AttributeError:
+            # it's a string
+            pass
+        if line[0] != "#":
+            tokens = line.strip().split("\t")
+            if tokens[2] in ("exon", "start_codon", "stop_codon"):
+                transcript_type = gtf_attribute(tokens[8], "transcript_type")
+                if transcript_type in _coding_transcript_types:
+                    transcript_id = gtf_attribute(tokens[8], "transcript_id")
+                    # Create new dictionary entry for new transcripts
+                    cds_dict[transcript_id].append(
+                        [
+                            tokens[0],
+                            tokens[2],
+                            int(tokens[3]),
+                            int(tokens[4]),
+                            tokens[6],
+                            transcript_type,
+                        ]
+                    )
+            elif tokens[2] == "CDS":
+                transcript_id = gtf_attribute(tokens[8], "transcript_id")
+                # Keep only fields needed to place a faux start codon:
+                #   chromosome, start, stop, strand, and frame
+                cds_lines[transcript_id].append(
+                    (tokens[0], tokens[3], tokens[4], tokens[6], tokens[7])
+                )
+            elif tokens[2] == "transcript":
+                transcript_type = gtf_attribute(tokens[8], "transcript_type")
+                if transcript_type in _coding_transcript_types:
+                    tx_data_dict[
+                        gtf_attribute(tokens[8], "transcript_id")
+                    ] = [
+                        transcript_type,
+                        gtf_attribute(tokens[8], "gene_id"),
+                        gtf_attribute(tokens[8], "gene_name"),
+                    ]
+    return cds_dict, cds_lines, tx_data_dict
+
+
+def _parse_gtf_chunk(chunk):
+    """ Parses a byte range of an uncompressed GTF; run by worker processes
+
+        chunk: tuple (path to GTF, offset of first byte, offset past last
+            byte); both offsets fall at starts of lines
+
+        Return value: tuple returned by _parse_gtf_lines()
+    """
+    gtf_file, start, end = chunk
+    with open(gtf_file, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Decode just as open() would have
+    return _parse_gtf_lines(io.TextIOWrapper(io.BytesIO(data)))
+
+
+def _gtf_chunks(gtf_file, chunk_count):
+    """ Splits an uncompressed GTF into byte ranges at line boundaries
+
+        gtf_file: path to GTF
+        chunk_count: number of byte ranges to aim for
+
+        Return value: list of tuples (path to GTF, start offset, end offset)
+            for consumption by _parse_gtf_chunk(), in file order
+    """
+    size = os.path.getsize(gtf_file)
+    chunk_size = max(size // chunk_count, 1)
+    offsets = [0]
+    with open(gtf_file, "rb") as f:
+        while True:
+            f.seek(offsets[-1] + chunk_size)
+            # Advance to the start of the next line
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            offsets.append(offset)
+    offsets.append(size)
+    return [
+        (gtf_file, offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1)
+    ]
+
+
+def _gtf_batches(f, batch_size):
+    """ Groups lines of a GTF for parsing by worker processes
+
+        f: file object
+        batch_size: number of lines per batch
+
+        Yield value: list of lines
+    """
+    while True:
+        batch = list(itertools.islice(f, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _merge_gtf_chunks(parsed):
+    """ Merges data parsed from consecutive pieces of a GTF
+
+        parsed: iterable of tuples returned by _parse_gtf_lines(), in file
+            order
+
+        Return value: tuple (cds_dict, cds_lines, tx_data_dict) identical to
+            what _parse_gtf_lines() returns for the whole GTF
+    """
+    parsed = iter(parsed)
+    cds_dict, cds_lines, tx_data_dict = next(parsed)
+    for chunk_cds_dict, chunk_cds_lines, chunk_tx_data_dict in parsed:
+        for transcript_id, blocks in chunk_cds_dict.items():
+            cds_dict[transcript_id].extend(blocks)
+        for transcript_id, lines in chunk_cds_lines.items():
+            cds_lines[transcript_id].extend(lines)
+        # Later transcript lines win, as in a serial parse
+        tx_data_dict.update(chunk_tx_data_dict)
+    return cds_dict, cds_lines, tx_data_dict
+
+
+def gtf_to_cds(gtf_file, dictdir, pickle_it=True, threads=1):
     """ References cds_dict to get cds bounds for later Bowtie query
         Keys in the dictionary are transcript IDs, while entries are lists of
             relevant CDS/stop codon data
@@ -2534,72 +2808,38 @@ def gtf_to_cds(gtf_file, dictdir, pickle_it=True):
         Writes cds_dict as a pickled dictionary
         gtf_file: input gtf file to process
         dictdir: path to directory to store pickled dicts
+        threads: number of processes to parse GTF with; output does not
+            depend on it
         Return value: dictionaries
     """
-    cds_dict = collections.defaultdict(list)
-    cds_lines = collections.defaultdict(list)
-    tx_data_dict = collections.defaultdict(list)
     # Parse GTF to obtain CDS/stop codon info
-    with xopen(None, gtf_file) as f:
-        for line in f:
-            try:
-                line = line.decode("ascii")
-            except AttributeError:
-                # it's a string
-                pass
-            if line[0] != "#":
-                tokens = line.strip().split("\t")
-                if tokens[2] in ["exon", "start_codon", "stop_codon"]:
-                    transcript_id = re.sub(
-                        r".*transcript_id \"([A-Z0-9._]+)\"[;].*", r"\1", tokens[8]
-                    )
-                    transcript_type = re.sub(
-                        r".*transcript_type \"([A-Za-z_]+)\"[;].*", r"\1", tokens[8]
-                    )
-                    if transcript_type in [
-                        "protein_coding",
-                        "nonsense_mediated_decay",
-                        "polymorphic_pseudogene",
-                        "IG_V_gene",
-                        "TR_V_gene",
-                    ]:
-                        # Create new dictionary entry for new transcripts
-                        cds_dict[transcript_id].append(
-                            [
-                                tokens[0],
-                                tokens[2],
-                                int(tokens[3]),
-                                int(tokens[4]),
-                                tokens[6],
-                                transcript_type,
-                            ]
+    if threads > 1:
+        import multiprocessing
+
+        with open(gtf_file, "rb") as f:
+            gzipped = f.read(2) == b"\x1f\x8b"
+        pool = multiprocessing.Pool(threads)
+        try:
+            if gzipped:
+                # Decompress here, parse in workers
+                with xopen(None, gtf_file) as f:
+                    cds_dict, cds_lines, tx_data_dict = _merge_gtf_chunks(
+                        pool.imap(
+                            _parse_gtf_lines, _gtf_batches(f, _gtf_batch_size)
                         )
-                elif tokens[2] == "CDS":
-                    transcript_id = re.sub(
-                        r".*transcript_id \"([A-Z0-9._]+)\"[;].*", r"\1", tokens[8]
-                    )
-                    cds_lines[transcript_id].append(tokens)
-                elif tokens[2] == "transcript":
-                    transcript_id = re.sub(
-                        r".*transcript_id \"([A-Z0-9._]+)\"[;].*", r"\1", tokens[8]
                     )
-                    transcript_type = re.sub(
-                        r".*transcript_type \"([A-Za-z_]+)\"[;].*", r"\1", tokens[8]
-                    )
-                    gene_id = re.sub(
-                        r".*gene_id \"([A-Z0-9._]+)\"[;].*", r"\1", tokens[8]
-                    )
-                    gene_name = re.sub(
-                        r".*gene_name \"([A-Za-z0-9._-]+)\"[;].*", r"\1", tokens[8]
+            else:
+                cds_dict, cds_lines, tx_data_dict = _merge_gtf_chunks(
+                    pool.imap(
+                        _parse_gtf_chunk, _gtf_chunks(gtf_file, threads * 4)
                     )
-                    if transcript_type in [
-                        "protein_coding",
-                        "nonsense_mediated_decay",
-                        "polymorphic_pseudogene",
-                        "IG_V_gene",
-                        "TR_V_gene",
-                    ]:
-                        tx_data_dict[transcript_id] = [transcript_type, gene_id, gene_name]
+                )
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        with xopen(None, gtf_file) as f:
+            cds_dict, cds_lines, tx_data_dict = _parse_gtf_lines(f)
     # Sort cds_dict coordinates (left -> right) for each transcript
     delete_txs = []
     for transcript_id, tx_data in cds_dict.items():
@@ -2609,14 +2849,14 @@ def gtf_to_cds(gtf_file, dictdir, pickle_it=True):
         if "start_codon" not in seq_types:
             # Fake a start codon if we have strand info
             try:
-                reverse_strand = current_cds[0][6] == "-"
+                reverse_strand = current_cds[0][3] == "-"
             except IndexError:
                 # Remove incompletely annotated transcript
                 delete_txs.append(transcript_id)
             else:
                 if reverse_strand:
-                    current_cds.sort(key=lambda x: int(x[4]), reverse=True)
-                    pos = int(current_cds[0][4]) - int(current_cds[0][7])
+                    current_cds.sort(key=lambda x: int(x[2]), reverse=True)
+                    pos = int(current_cds[0][2]) - int(current_cds[0][4])
                     cds_dict[transcript_id].append(
                         [
                             current_cds[0][0],
@@ -2628,8 +2868,8 @@ def gtf_to_cds(gtf_file, dictdir, pickle_it=True):
                         ]
                     )
                 else:
-                    current_cds.sort(key=lambda x: int(x[3]))
-                    pos = int(current_cds[0][3]) + int(current_cds[0][7])
+                    current_cds.sort(key=lambda x: int(x[1]))
+                    pos = int(current_cds[0][1]) + int(current_cds[0][4])
                     cds_dict[transcript_id].append(
                         [
                             current_cds[0][0],
@@ -2696,7 +2936,7 @@ def cds_to_feature_length(cds_dict, tx_data_dict, dictdir, pickle_it=True):
 
 def cds_to_tree(cds_dict, dictdir, pickle_it=True):
     """ Creates searchable tree of chromosome intervals from CDS dictionary
-        Each chromosome is stored in the dictionary as an interval tree object
+        Each chromosome is stored in the dictionary as an IntervalIndex object
             Intervals are added for each CDS, with the associated transcript ID
             Assumes transcript is all on one chromosome - does not work for
                 gene fusions
@@ -2704,23 +2944,26 @@ def cds_to_tree(cds_dict, dictdir, pickle_it=True):
         cds_dict: CDS dictionary produced by gtf_to_cds()
         Return value: searchable tree
     """
-    searchable_tree = {}
+    chrom_intervals = {}
     # Add genomic intervals to the tree for each transcript
     for transcript_id in cds_dict:
         transcript = cds_dict[transcript_id]
         chrom = transcript[0][0]
         # Add new entry for chromosome if not already encountered
-        if chrom not in searchable_tree:
-            searchable_tree[chrom] = IntervalTree()
+        if chrom not in chrom_intervals:
+            chrom_intervals[chrom] = []
         # Add CDS interval to tree with transcript ID
         for cds in transcript:
             start = cds[2]
             stop = cds[3] + 1
             # Interval coordinates are inclusive of start, exclusive of stop
             if stop > start:
-                searchable_tree[chrom][start:stop] = transcript_id
+                chrom_intervals[chrom].append((start, stop, transcript_id))
             # else:
             # report an error?
+    searchable_tree = {}
+    for chrom in chrom_intervals:
+        searchable_tree[chrom] = IntervalIndex.from_intervals(chrom_intervals[chrom])
     # Write to pickled dictionary
     if pickle_it:
         pickle_dict = os.path.join(dictdir, "intervals_to_transcript.pickle")
@@ -2735,20 +2978,48 @@ def get_transcripts_from_tree(chrom, start, stop, cds_tree):
         chrom: (String) Specify chrom to use for transcript search.
         start: (Int) Specify start position to use for transcript search.
         stop: (Int) Specify ending position to use for transcript search
-        cds_tree: (Dict) dictionary of IntervalTree() objects containing
-            transcript IDs as function of exon coords indexed by chr/contig ID.
+        cds_tree: (Dict) dictionary of IntervalIndex() (or IntervalTree())
+            objects containing transcript IDs as function of exon coords
+            indexed by chr/contig ID.
 
-        Return value: (set) a set of matching unique transcript IDs.
+        Return value: (list) a list of matching unique transcript IDs.
     """
-    transcript_ids = set()
     # Interval coordinates are inclusive of start, exclusive of stop
     if chrom not in cds_tree:
         return []
+    if hasattr(cds_tree[chrom], "overlapping_transcripts"):
+        return cds_tree[chrom].overlapping_transcripts(start, stop)
+    transcript_ids = set()
     cds = list(cds_tree[chrom].overlap(start, stop))
     for cd in cds:
         transcript_ids.add(cd.data)
     return list(transcript_ids)
 
+
+def get_transcripts_from_tree_batch(chrom, starts, stops, cds_tree):
+    """ Uses cds tree to obtain transcript IDs for many genomic ranges on
+        the same chromosome at once
+
+        chrom: (String) Specify chrom to use for transcript search.
+        starts: (List) start positions to use for transcript search.
+        stops: (List) ending positions to use for transcript search
+        cds_tree: (Dict) dictionary of IntervalIndex() (or IntervalTree())
+            objects containing transcript IDs as function of exon coords
+            indexed by chr/contig ID.
+
+        Return value: (list) a list of matching unique transcript IDs for
+            each range.
+    """
+    if chrom not in cds_tree:
+        return [[] for _ in starts]
+    if hasattr(cds_tree[chrom], "overlapping_transcripts_batch"):
+        return cds_tree[chrom].overlapping_transcripts_batch(starts, stops)
+    return [
+        get_transcripts_from_tree(chrom, start, stop, cds_tree)
+        for start, stop in zip(starts, stops)
+    ]
+
+
 def add_mut_to_haplotype_block(alternative, contig):
     if len(alternatives) > 1:
         if i == 0:
@@ -2804,6 +3075,69 @@ def add_mut_to_haplotype_block(alternative, contig):
             )
 
 
+def assign_block_mutations(
+    block_alleles,
+    interval_dict,
+    phasing,
+    block_transcripts,
+    block_complex_pairs,
+    homozygous_variants,
+):
+    """ Finds transcripts overlapping the mutations of a haplotype block with
+        one batched interval search per contig, then assigns mutations to
+        those transcripts in the order they appeared in the block
+        block_alleles: list with, for each alternative allele in the block,
+                        a list of (end, mutation) tuples, where mutation is
+                        [contig, pos, ref, alt, gen1, gen2, genotype line,
+                        mutation type]
+        interval_dict: dictionary linking genomic intervals to transcripts
+        phasing: whether to phase mutations (boolean)
+        block_transcripts: dictionary linking transcripts to mutations of the
+                        block; updated in place
+        block_complex_pairs: list of mutations broken down from complex
+                        indels; updated in place
+        homozygous_variants: dictionary linking transcripts to homozygous
+                        mutations; updated in place
+        No return value.
+    """
+    contig_queries = collections.defaultdict(list)
+    for allele_mutations in block_alleles:
+        for end, mutation in allele_mutations:
+            contig_queries[mutation[0]].append((mutation[1], end))
+    overlaps = {}
+    for contig in contig_queries:
+        queries = contig_queries[contig]
+        overlaps[contig] = dict(
+            zip(
+                queries,
+                get_transcripts_from_tree_batch(
+                    contig,
+                    [pos for pos, _ in queries],
+                    [end for _, end in queries],
+                    interval_dict,
+                ),
+            )
+        )
+    for allele_mutations in block_alleles:
+        complex_pairs = []
+        for end, mutation in allele_mutations:
+            overlapping_transcripts = overlaps[mutation[0]][(mutation[1], end)]
+            if not phasing or mutation[4] != mutation[5]:
+                # For each overlapping transcript, add mutation entry
+                # Contains chromosome, position, reference, alternate, allele
+                #   A, allele B, genotype line from VCF
+                for transcript in overlapping_transcripts:
+                    block_transcripts[transcript].append(list(mutation))
+                    complex_pairs.append(list(mutation))
+            else:
+                for transcript in overlapping_transcripts:
+                    homozygous_variants[transcript].append(list(mutation))
+        # Store complex pairs if the variant was complex
+        if len(complex_pairs) > 1:
+            complex_pairs.sort(key=itemgetter(1))
+            block_complex_pairs.append(complex_pairs)
+
+
 def process_haplotypes(hapcut_output, interval_dict, phasing):
     """ Stores all haplotypes relevant to different transcripts as a dictionary
         hapcut_output: output from HAPCUT2, adjusted to include unphased
@@ -2827,11 +3161,22 @@ def process_haplotypes(hapcut_output, interval_dict, phasing):
             input_stream = open(hapcut_output)
         block_transcripts = collections.defaultdict(list)
         block_complex_pairs = []
+        block_alleles = []
         for line in input_stream:
             if line.startswith("BLOCK"):
                 # Skip block header lines
                 continue
             elif line[0] == "*":
+                # Find transcripts for all of the block's mutations at once
+                assign_block_mutations(
+                    block_alleles,
+                    interval_dict,
+                    phasing,
+                    block_transcripts,
+                    block_complex_pairs,
+                    homozygous_variants,
+                )
+                block_alleles = []
                 # Process all transcripts for the block
                 for transcript_id in block_transcripts:
                     block_transcripts[transcript_id].sort(key=itemgetter(1))
@@ -2936,8 +3281,9 @@ def process_haplotypes(hapcut_output, interval_dict, phasing):
                             alt = alternatives[i]
                             end = pos + 1
                             variants_to_process.append((pos, ref, alt, end, mutation_type))
-                    # Store complex variants together if relevant
-                    complex_pairs = []
+                    # Collect the allele's mutations; overlapping transcripts
+                    #   are found once the whole block has been read
+                    allele_mutations = []
                     for (pos, ref, alt, end, mutation_type) in variants_to_process:
                         if len(alternatives) > 1:
                             if i == 0:
@@ -2957,133 +3303,481 @@ def process_haplotypes(hapcut_output, interval_dict, phasing):
                         else:
                             gen1 = tokens[1]
                             gen2 = tokens[2]
-                        overlapping_transcripts = get_transcripts_from_tree(
-                            contig, pos, end, interval_dict
+                        allele_mutations.append(
+                            (
+                                end,
+                                [
+                                    contig,
+                                    pos,
+                                    ref,
+                                    alt,
+                                    gen1,
+                                    gen2,
+                                    tokens[7],
+                                    mutation_type,
+                                ],
+                            )
                         )
-                        if not phasing or gen1 != gen2:
-                            # For each overlapping transcript, add mutation entry
-                            # Contains chromosome, position, reference, alternate, allele
-                            #   A, allele B, genotype line from VCF
-                            for transcript in overlapping_transcripts:
-                                block_transcripts[transcript].append(
-                                    [
-                                        contig,
-                                        pos,
-                                        ref,
-                                        alt,
-                                        gen1,
-                                        gen2,
-                                        tokens[7],
-                                        mutation_type,
-                                    ]
-                                )
-                                complex_pairs.append([
-                                                    contig,
-                                                    pos,
-                                                    ref,
-                                                    alt,
-                                                    gen1,
-                                                    gen2,
-                                                    tokens[7],
-                                                    mutation_type,
-                                                ]
-                                            )
-                        else:
-                            for transcript in overlapping_transcripts:
-                                homozygous_variants[transcript].append(
-                                    [
-                                        contig,
-                                        pos,
-                                        ref,
-                                        alt,
-                                        gen1,
-                                        gen2,
-                                        tokens[7],
-                                        mutation_type,
-                                    ]
-                                )
-                    # Store complex pairs if the variant was complex
-                    if len(complex_pairs) > 1:
-                        complex_pairs.sort(key=itemgetter(1))
-                        block_complex_pairs.append(complex_pairs)
+                    block_alleles.append(allele_mutations)
+        # Mutations after the last block terminator are not assigned to
+        #   haplotypes, but homozygous mutations among them are still kept
+        assign_block_mutations(
+            block_alleles,
+            interval_dict,
+            phasing,
+            block_transcripts,
+            block_complex_pairs,
+            homozygous_variants,
+        )
     finally:
         if input_stream is not sys.stdin:
             input_stream.close()
     return affected_transcripts, homozygous_variants
 
-def get_haplotype_cliques(haplotype):
+def _variants_conflict(first, second):
+    """ Checks whether one variant cannot be phased with another
+
+        first: variant from a haplotype (see get_haplotype_cliques())
+        second: another variant from the same haplotype
+
+        Return value: True if first is incompatible with second
+    """
+    if first[7] != second[7]:
+        return False
+    if first[7] == "I":
+        # Insertions that start at same position are incompatible
+        return first[1] == second[1]
+    if ("*" in first[6]) != ("*" in second[6]):
+        # Variants of different mutation classes are compatible
+        return False
+    if first[7] == "V":
+        first_end = first[1] + len(first[3]) - 1
+        second_end = second[1] + len(second[3]) - 1
+    else:
+        first_end = first[1] + first[3] - 1
+        second_end = second[1] + second[3] - 1
+    # Variants overlap, or one is completely inside the other
+    return (
+        (second[1] <= first_end <= second_end)
+        or (second[1] <= first[1] <= second_end)
+        or (first[1] >= second[1] and first_end <= second_end)
+        or (second[1] >= first[1] and second_end <= first_end)
+    )
+
+
+def _variant_span(variant):
+    """ Finds the positions a variant may conflict with others across
+
+        variant: variant from a haplotype (see get_haplotype_cliques())
+
+        Return value: tuple (first position, last position)
+    """
+    if variant[7] == "V":
+        end = variant[1] + len(variant[3]) - 1
+    elif variant[7] == "D":
+        end = variant[1] + variant[3] - 1
+    else:
+        end = variant[1]
+    return min(variant[1], end), max(variant[1], end)
+
+
+def get_haplotype_cliques(haplotype, max_cliques=None):
     """ Finds the maximal cliques of phased variants for a predicted haplotype.
         
         HapCUT2 and GATK's ReadBackedPhasing may phase together incompatible, 
-        overlapping variants. This function turns a predicted haplotype into a
+        overlapping variants. This function treats a predicted haplotype as a
         graph, where variants that are predicted to be phased are connected by
         edges only if they are compatible with each other. The maximal cliques
         are then found and returned as their own haplotypes.
 
+        Only variants of the same type whose positions overlap can conflict,
+        so conflicts are found by sweeping across variants sorted by
+        position rather than by comparing every pair. Variants compatible
+        with all others (e.g. most homozygous variants) belong to every
+        maximal clique and are set aside, and the remaining cliques are
+        enumerated by Bron-Kerbosch with pivoting over bitsets.
+
         haplotype: predicted haplotype block (as output from process_haplotypes);
             list of lists containing [chromosome, position, reference allele, 
             alternate allele, presence on DNA copy 1 (0/1), presence on DNA copy
             2 (0/1), variant information from VCF, variant type ('V', 'D', or 'I')]
             for each variant in the block
+        max_cliques: most cliques to return, or None for all; a warning is
+            given if more cliques exist
 
-        Return value: list of maximal cliques within the haplotype
+        Return value: list of maximal cliques within the haplotype, each a
+            list of variant tuples sorted by position, then type ('D', 'I',
+            'V'), then their other fields, in a deterministic order; edits
+            are made in this order, which overlapping variants depend on
     """
-    graph = nx.Graph()
-    for i in range(len(haplotype)):
-        # Add node to graph for variant
-        graph.add_node(tuple(haplotype[i]))
-        # Check mutation class and start position of variant
-        if '*' in haplotype[i][6]:
-            i_class = 'G'
-        else:
-            i_class = 'S'
-        i_start = haplotype[i][1]
-        # Iterate through other variants to check compatibility
-        for j in range(len(haplotype)):
-            # Variants are different and predicted to be phased together
-            if (j != i and ((haplotype[i][4] == haplotype[j][4]) 
-                            or (haplotype[i][5] == haplotype[j][5]))):
-                # Check mutation class and start position of second variant
-                if '*' in haplotype[j][6]:
-                    j_class = 'G'
-                else:
-                    j_class = 'S'
-                j_start = haplotype[j][1]
-                # Check for compatibility of the two variants, add edge to graph if they're compatible
-                if haplotype[i][7] == 'I' and haplotype[j][7] == 'I' and haplotype[i][1] == haplotype[j][1]:
-                    # Insertions that start at same position are incompatible
-                    continue
-                elif haplotype[i][7] == 'V' and haplotype[j][7] == 'V' and i_class == j_class:
-                    # Check whether substitutions of same mutation class overlap
-                    i_end = i_start + len(haplotype[i][3]) - 1
-                    j_end = j_start + len(haplotype[j][3]) - 1
-                    if (i_end >= j_start and i_end <= j_end) or (i_start >= j_start and i_start <= j_end):
-                        # Substitutions overlap and are incompatible
-                        continue
-                    elif (i_start >= j_start and i_end <= j_end) or (j_start >= i_start and j_end <= i_end):
-                        # One substitution completely inside the other
-                        continue
-                    else:
-                        # Substitutions are compatible
-                        graph.add_edge(tuple(haplotype[i]), tuple(haplotype[j]))
-                elif haplotype[i][7] == 'D' and haplotype[j][7] == 'D' and i_class == j_class:
-                    # Check whether deletions of same mutation class overlap
-                    i_end = i_start + haplotype[i][3] - 1
-                    j_end = j_start + haplotype[j][3] - 1
-                    if (i_end >= j_start and i_end <= j_end) or (i_start >= j_start and i_start <= j_end):
-                        # Deletions overlap and are incompatible
-                        continue
-                    elif (i_start >= j_start and i_end <= j_end) or (j_start >= i_start and j_end <= i_end):
-                        # One deletion completely inside the other
-                        continue
-                    else:
-                        # Deletions are compatible
-                        graph.add_edge(tuple(haplotype[i]), tuple(haplotype[j]))
-                else:
-                    # Variants are compatible
-                    graph.add_edge(tuple(haplotype[i]), tuple(haplotype[j]))
+    # Sort variants so that cliques and the order of their edits do not
+    #   depend on the order of the haplotype
+    variants = sorted(
+        set(map(tuple, haplotype)),
+        key=lambda variant: (variant[1], variant[7], variant),
+    )
+    if not variants:
+        return []
+    # Variants are phased together if they share presence on a DNA copy
+    copies = collections.defaultdict(int)
+    for i, variant in enumerate(variants):
+        copies[(variant[4], variant[5])] |= 1 << i
+    phased = {}
+    for copy_i in copies:
+        phased[copy_i] = 0
+        for copy_j in copies:
+            if copy_i[0] == copy_j[0] or copy_i[1] == copy_j[1]:
+                phased[copy_i] |= copies[copy_j]
+    adjacency = [
+        phased[(variant[4], variant[5])] & ~(1 << i)
+        for i, variant in enumerate(variants)
+    ]
+    # Remove edges between overlapping variants that conflict
+    spans = sorted((_variant_span(variant), i) for i, variant in enumerate(variants))
+    active = []
+    for (start, end), i in spans:
+        active = [(active_end, j) for active_end, j in active if active_end >= start]
+        for active_end, j in active:
+            if _variants_conflict(variants[i], variants[j]) and _variants_conflict(
+                variants[j], variants[i]
+            ):
+                adjacency[i] &= ~(1 << j)
+                adjacency[j] &= ~(1 << i)
+        active.append((end, i))
+    # Variants adjacent to all others are in every maximal clique
+    everything = (1 << len(variants)) - 1
+    universal = 0
+    for i in range(len(variants)):
+        if adjacency[i] | (1 << i) == everything:
+            universal |= 1 << i
+    # Split other variants into groups with no conflicts between them, e.g.
+    #   distant clusters of overlapping variants; a maximal clique combines
+    #   one maximal clique from each group
+    remaining = everything & ~universal
+    groups = []
+    while remaining:
+        group = frontier = remaining & -remaining
+        while frontier:
+            v = frontier & -frontier
+            frontier ^= v
+            unreached = remaining & ~adjacency[v.bit_length() - 1] & ~group
+            group |= unreached
+            frontier |= unreached
+        groups.append(group)
+        remaining &= ~group
+    limit = None if max_cliques is None else max_cliques + 1
+    shared = list(_bit_indices(universal))
+    cliques = [
+        sorted(shared + list(itertools.chain.from_iterable(parts)))
+        for parts in itertools.islice(
+            itertools.product(
+                *[
+                    [
+                        list(_bit_indices(clique))
+                        for clique in _maximal_cliques(adjacency, group, limit)
+                    ]
+                    for group in groups
+                ]
+            ),
+            limit,
+        )
+    ]
+    if max_cliques is not None and len(cliques) > max_cliques:
+        warnings.warn(
+            " ".join(
+                [
+                    "More than",
+                    str(max_cliques),
+                    "maximal cliques of variants in haplotype at",
+                    str(variants[0][0]) + ":" + str(variants[0][1]),
+                    "- using only the first",
+                    str(max_cliques),
+                ]
+            ),
+            Warning,
+        )
+        cliques = cliques[:max_cliques]
     # Return maximal cliques for this predicted haplotype
-    return list(nx.find_cliques(graph))
+    return [[variants[i] for i in members] for members in sorted(cliques)]
+
+
+def _maximal_cliques(adjacency, candidates, limit=None):
+    """ Finds maximal cliques of a graph by Bron-Kerbosch with pivoting
+
+        adjacency: list whose ith element is a bitset of the vertices
+            adjacent to vertex i
+        candidates: bitset of vertices to find cliques among
+        limit: most cliques to find, or None for all
+
+        Return value: list of cliques, each a bitset of vertices
+    """
+    cliques = []
+    # Each frame is (clique so far, candidates, excluded, vertices to branch on)
+    stack = [(0, candidates, 0, None)]
+    while stack:
+        clique, candidates, excluded, branches = stack.pop()
+        if branches is None:
+            if not candidates and not excluded:
+                cliques.append(clique)
+                if limit is not None and len(cliques) >= limit:
+                    break
+                continue
+            # Branch only on candidates not adjacent to the pivot, chosen to
+            #   have the most adjacent candidates
+            pivot = max(
+                _bit_indices(candidates | excluded),
+                key=lambda u: bin(candidates & adjacency[u]).count("1"),
+            )
+            branches = list(_bit_indices(candidates & ~adjacency[pivot]))
+            branches.reverse()
+        if not branches:
+            continue
+        v = branches.pop()
+        stack.append((clique, candidates & ~(1 << v), excluded | (1 << v), branches))
+        stack.append(
+            (
+                clique | (1 << v),
+                candidates & adjacency[v],
+                excluded & adjacency[v],
+                None,
+            )
+        )
+    return cliques
+
+
+def _bit_indices(bits):
+    """ Lists the positions of set bits in an integer
+
+        bits: nonnegative integer
+
+        Return value: generator of indices of set bits, lowest first
+    """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def _mutation_class_and_vaf(mutation, vaf_pos):
+    """ Determines whether a mutation is somatic or germline, and its VAF
+
+        mutation: mutation tuple from process_haplotypes()
+        vaf_pos: position of VAF in VCF mutation data from HapCUT2
+
+        Return value: tuple (mutation class "S" or "G", VAF or None)
+    """
+    if mutation[6][-1] == "*":
+        mutation_class = "G"
+    else:
+        mutation_class = "S"
+    vaf = None
+    if vaf_pos is not None and mutation_class == "S":
+        vaf_entry = mutation[6].strip("*").split(":")[vaf_pos[0]]
+        if "," in vaf_entry:
+            vaf_entry = [x for x in vaf_entry.split(",") if x != "."]
+            if len(vaf_entry) > 0:
+                vaf = sum([float(x.strip("%")) for x in vaf_entry]) / len(
+                    vaf_entry
+                )
+                if vaf_pos[1] == "FREQ":
+                    vaf = vaf / 100.0
+        else:
+            if vaf_entry.strip("%") != ".":
+                vaf = float(vaf_entry.strip("%"))
+                if vaf_pos[1] == "FREQ":
+                    vaf = vaf / 100.0
+    return mutation_class, vaf
+
+
+def _edit_transcript(transcript, mutations, vaf_pos):
+    """ Makes edits to a transcript for mutations
+
+        transcript: Transcript object
+        mutations: list of mutation tuples from process_haplotypes()
+        vaf_pos: position of VAF in VCF mutation data from HapCUT2
+
+        No return value.
+    """
+    for mutation in mutations:
+        mutation_class, vaf = _mutation_class_and_vaf(mutation, vaf_pos)
+        transcript.edit(
+            mutation[3],
+            mutation[1],
+            mutation_type=mutation[7],
+            mutation_class=mutation_class,
+            vaf=vaf,
+        )
+
+
+def _transcript_neopeptides(task, reference_index, options, memo):
+    """ Applies mutations to one transcript and enumerates neopeptides
+
+        task: tuple (transcript ID, CDS blocks from cds_dict, haplotypes,
+            homozygous); if homozygous is False, haplotypes is a list of
+            haplotypes whose cliques are each applied to the reference
+            transcript; if True, it is a list of homozygous mutations, each
+            applied alone
+        reference_index: BowtieIndexReference object for retrieving
+            reference genome sequence
+        options: dictionary of keyword arguments from
+            get_peptides_from_transcripts(): vaf_pos, size_list,
+            include_germline, include_somatic, only_novel_upstream,
+            only_downstream, only_reference, protein_fasta, and max_cliques
+        memo: set of keys of (transcript, edits in the order made, options)
+            combinations already enumerated in this run, to which new ones
+            are added; their neopeptides and proteins were already found, so
+            repeats are skipped
+
+        Return value: tuple (dictionary linking neopeptides to lists of
+            metadata, in order found; set of mutated protein sequences;
+            number of edit sets; number of those skipped as repeats)
+    """
+    transcript_id, blocks, haplotypes, homozygous = task
+    transcript_a = Transcript(
+        reference_index,
+        [
+            [str(chrom), "blah", seq_type, str(start), str(end), ".", strand]
+            for (chrom, seq_type, start, end, strand, tx_type) in blocks
+        ],
+        transcript_id,
+        prefetch=True,
+    )
+    if homozygous:
+        edit_groups = [[mutation] for mutation in haplotypes]
+    else:
+        edit_groups = [
+            c
+            for ht in haplotypes
+            for c in get_haplotype_cliques(ht, options["max_cliques"])
+        ]
+    neoepitopes = collections.OrderedDict()
+    proteins = set()
+    repeats = 0
+    # Edits at the transcript's save point, which begin the current clique
+    saved = []
+    for k, c in enumerate(edit_groups):
+        edits = [tuple(mutation) for mutation in c]
+        # The same edits, made in the same order, to the same transcript give
+        #   the same neopeptides, which merge into results as no-ops; order
+        #   matters when edits overlap
+        key = (
+            transcript_id,
+            tuple(edits),
+            options["include_somatic"],
+            options["include_germline"],
+            options["only_novel_upstream"],
+            options["only_downstream"],
+            options["only_reference"],
+            options["size_list"][0],
+            options["size_list"][-1],
+        )
+        if key in memo:
+            repeats += 1
+            continue
+        memo.add(key)
+        if saved and edits[: len(saved)] == saved:
+            transcript_a.reset()
+            added = len(saved)
+        else:
+            # Save the edits this clique begins with in common with the next
+            #   (cliques are sorted, so they often share many), rather than
+            #   making them again
+            transcript_a.reset(reference=True)
+            added = 0
+            if k + 1 < len(edit_groups):
+                for mutation, next_mutation in zip(edits, edit_groups[k + 1]):
+                    if mutation != tuple(next_mutation):
+                        break
+                    added += 1
+            _edit_transcript(transcript_a, c[:added], options["vaf_pos"])
+            transcript_a.save()
+            saved = edits[:added]
+        # Make edits for each mutation
+        _edit_transcript(transcript_a, c[added:], options["vaf_pos"])
+        # Extract neoepitopes
+        peptides, protein = transcript_a.neopeptides(
+            min_size=options["size_list"][0],
+            max_size=options["size_list"][-1],
+            include_somatic=options["include_somatic"],
+            include_germline=options["include_germline"],
+            only_novel_upstream=options["only_novel_upstream"],
+            only_downstream=options["only_downstream"],
+            only_reference=options["only_reference"],
+            return_protein=True,
+        )
+        # Store neoepitopes and their metadata
+        for pep in peptides:
+            pep_data = neoepitopes.setdefault(pep, [])
+            for meta_data in peptides[pep]:
+                adj_meta_data = meta_data + (transcript_a.transcript_id,)
+                if adj_meta_data not in pep_data:
+                    pep_data.append(adj_meta_data)
+        if options["protein_fasta"]:
+            if len(peptides) > 0 and protein != "":
+                proteins.add(protein)
+    return neoepitopes, proteins, len(edit_groups), repeats
+
+
+# Reference, options, and memo of a get_peptides_from_transcripts() worker
+#   process
+_worker_state = {}
+
+
+def _init_peptide_worker(pickled_reference, options):
+    """ Prepares a worker process for get_peptides_from_transcripts()
+
+        pickled_reference: pickled BowtieIndexReference object; unpickling
+            reopens its memory maps in this process
+        options: dictionary passed to _transcript_neopeptides()
+
+        No return value.
+    """
+    _worker_state["reference_index"] = pickle.loads(pickled_reference)
+    _worker_state["options"] = options
+    _worker_state["memo"] = set()
+
+
+def _peptide_worker(task):
+    """ Runs _transcript_neopeptides() in a worker process
+
+        task: tuple passed to _transcript_neopeptides()
+
+        Return value: tuple (transcript ID, return value of
+            _transcript_neopeptides())
+    """
+    return (
+        task[0],
+        _transcript_neopeptides(
+            task,
+            _worker_state["reference_index"],
+            _worker_state["options"],
+            _worker_state["memo"],
+        ),
+    )
+
+
+def _transcript_type_included(blocks, nmd, pp, igv, trv):
+    """ Checks whether a transcript's type is included in neoepitope calling
+
+        blocks: CDS blocks of transcript from cds_dict
+        nmd: whether to include nonsense mediated decay transcripts (boolean)
+        pp: whether to include polymorphic pseudogene transcripts (boolean)
+        igv: whether to include IGV transcripts (boolean)
+        trv: whether to include TRV transcripts (boolean)
+
+        Return value: boolean
+    """
+    transcript_type = blocks[0][5]
+    if transcript_type == "nonsense_mediated_decay" and not nmd:
+        return False
+    elif transcript_type == "polymorphic_pseudogene" and not pp:
+        return False
+    elif transcript_type == "IG_V_gene" and not igv:
+        return False
+    elif transcript_type == "TR_V_gene" and not trv:
+        return False
+    return True
+
 
 def get_peptides_from_transcripts(
     relevant_transcripts,
@@ -3104,6 +3798,9 @@ def get_peptides_from_transcripts(
     include_germline=2,
     include_somatic=1,
     protein_fasta=False,
+    threads=1,
+    max_cliques=None,
+    stats=None,
 ):
     """ For transcripts that are affected by a mutation, mutations are applied
         and neoepitopes resulting from mutations are called
@@ -3134,44 +3831,30 @@ def get_peptides_from_transcripts(
         pp: whether to include polymorphic pseudogene transcripts (boolean)
         igv: whether to include IGV transcripts (boolean)
         trv: whether to include TRV transcripts (boolean)
+        threads: number of processes across which to spread transcripts;
+            results do not depend on it
+        max_cliques: most maximal cliques of variants to use per haplotype,
+            or None for all
+        stats: dictionary to which the number of edit sets applied to
+            transcripts ("edit_sets") and the number skipped because the
+            same edits were already applied to the same transcript
+            ("repeats") are added, or None
         return value: dictionary linking neoepitopes to their associated
             metadata
         """
-    neoepitopes = collections.defaultdict(list)
-    fasta_entries = collections.defaultdict(set)
+    # Gather work for each transcript, in the order results are merged
+    tasks = []
     used_homozygous_variants = set()
     for affected_transcript in relevant_transcripts:
+        blocks = cds_dict[affected_transcript]
         # Filter out NMD, polymorphic pseudogene, IG V, TR V transcripts if relevant
-        if cds_dict[affected_transcript][0][5] == "nonsense_mediated_decay" and not nmd:
-            continue
-        elif cds_dict[affected_transcript][0][5] == "polymorphic_pseudogene" and not pp:
-            continue
-        elif cds_dict[affected_transcript][0][5] == "IG_V_gene" and not igv:
-            continue
-        elif cds_dict[affected_transcript][0][5] == "TR_V_gene" and not trv:
+        if not _transcript_type_included(blocks, nmd, pp, igv, trv):
             continue
         # Filter out transcripts missing start or stop codons if relevant
-        if (
-            "start_codon" not in [x[1] for x in cds_dict[affected_transcript]]
-            and not allow_nonstart
-        ):
+        if "start_codon" not in [x[1] for x in blocks] and not allow_nonstart:
             continue
-        if (
-            "stop_codon" not in [x[1] for x in cds_dict[affected_transcript]]
-            and not allow_nonstop
-        ):
+        if "stop_codon" not in [x[1] for x in blocks] and not allow_nonstop:
             continue
-        # Create transcript object
-        transcript_a = Transcript(
-            reference_index,
-            [
-                [str(chrom), "blah", seq_type, str(start), str(end), ".", strand]
-                for (chrom, seq_type, start, end, strand, tx_type) in cds_dict[
-                    affected_transcript
-                ]
-            ],
-            affected_transcript,
-        )
         # Iterate over haplotypes associated with this transcript
         haplotypes = relevant_transcripts[affected_transcript]
         for ht in haplotypes:
@@ -3180,133 +3863,76 @@ def get_peptides_from_transcripts(
                 for homozygous in homozygous_variants[affected_transcript]:
                     ht.append(homozygous)
                     used_homozygous_variants.add(tuple(homozygous))
-            # Find maximal cliques
-            cliques = get_haplotype_cliques(ht)
-            for c in cliques:
-                # Make edits for each mutation
-                for mutation in c:
-                    # Determine if mutation is somatic or germline
-                    if mutation[6][-1] == "*":
-                        mutation_class = "G"
-                    else:
-                        mutation_class = "S"
-                    # Determine VAF if available
-                    vaf = None
-                    if vaf_pos is not None and mutation_class == "S":
-                        vaf_entry = mutation[6].strip('*').split(":")[vaf_pos[0]]
-                        if "," in vaf_entry:
-                            vaf_entry = [x for x in vaf_entry.split(",") if x != "."]
-                            if len(vaf_entry) > 0:
-                                vaf = sum(
-                                    [float(x.strip("%")) for x in vaf_entry]
-                                ) / len(vaf_entry)
-                                if vaf_pos[1] == 'FREQ':
-                                    vaf = vaf/100.0
-                        else:
-                            if vaf_entry.strip("%") != ".":
-                                vaf = float(vaf_entry.strip("%"))
-                                if vaf_pos[1] == 'FREQ':
-                                    vaf = vaf/100.0
-                    # Determine which copies variant exists on & make edits
-                    transcript_a.edit(
-                        mutation[3],
-                        mutation[1],
-                        mutation_type=mutation[7],
-                        mutation_class=mutation_class,
-                        vaf=vaf,
-                    )
-                # Extract neoepitopes
-                peptides, protein = transcript_a.neopeptides(
-                    min_size=size_list[0],
-                    max_size=size_list[-1],
-                    include_somatic=include_somatic,
-                    include_germline=include_germline,
-                    only_novel_upstream=only_novel_upstream,
-                    only_downstream=only_downstream,
-                    only_reference=only_reference,
-                    return_protein=True,
-                )
-                # Store neoepitopes and their metadata
-                for pep in peptides:
-                    for meta_data in peptides[pep]:
-                        adj_meta_data = meta_data + (transcript_a.transcript_id,)
-                        if adj_meta_data not in neoepitopes[pep]:
-                            neoepitopes[pep].append(adj_meta_data)
-                if protein_fasta:
-                    if len(peptides) > 0 and protein != "":
-                        fasta_entries[affected_transcript].add(protein)
-                transcript_a.reset(reference=True)
+        # Haplotypes may be shared with transcripts yet to come, which can
+        #   extend them further; copy them as they stand now
+        tasks.append(
+            (affected_transcript, blocks, [list(ht) for ht in haplotypes], False)
+        )
     for transcript in homozygous_variants:
+        blocks = cds_dict[transcript]
         # Filter out NMD, polymorphic pseudogene, IG V, TR V transcripts if relevant
-        if cds_dict[affected_transcript][0][5] == "nonsense_mediated_decay" and not nmd:
-            continue
-        elif cds_dict[affected_transcript][0][5] == "polymorphic_pseudogene" and not pp:
-            continue
-        elif cds_dict[affected_transcript][0][5] == "IG_V_gene" and not igv:
-            continue
-        elif cds_dict[affected_transcript][0][5] == "TR_V_gene" and not trv:
+        if not _transcript_type_included(blocks, nmd, pp, igv, trv):
             continue
-        transcript_a = Transcript(
-            reference_index,
-            [
-                [str(chrom), "blah", seq_type, str(start), str(end), ".", strand]
-                for (chrom, seq_type, start, end, strand, tx_type) in cds_dict[
-                   transcript
-                ]
-            ],
-            transcript,
+        mutations = [
+            mutation
+            for mutation in homozygous_variants[transcript]
+            if tuple(mutation) not in used_homozygous_variants
+        ]
+        if mutations:
+            tasks.append((transcript, blocks, mutations, True))
+    options = {
+        "vaf_pos": vaf_pos,
+        "size_list": size_list,
+        "include_germline": include_germline,
+        "include_somatic": include_somatic,
+        "only_novel_upstream": only_novel_upstream,
+        "only_downstream": only_downstream,
+        "only_reference": only_reference,
+        "protein_fasta": protein_fasta,
+        "max_cliques": max_cliques,
+    }
+    if threads > 1 and len(tasks) > 1:
+        import multiprocessing
+
+        # Each worker opens its own memory maps of the reference
+        pool = multiprocessing.Pool(
+            min(threads, len(tasks)),
+            _init_peptide_worker,
+            (pickle.dumps(reference_index), options),
         )
-        for mutation in homozygous_variants[transcript]:
-            if tuple(mutation) not in used_homozygous_variants:
-                # Determine if mutation is somatic or germline
-                if mutation[6][-1] == "*":
-                    mutation_class = "G"
-                else:
-                    mutation_class = "S"
-                # Determine VAF if available
-                vaf = None
-                if vaf_pos is not None and mutation_class == "S":
-                    vaf_entry = mutation[6].strip("*").split(":")[vaf_pos[0]]
-                    if "," in vaf_entry:
-                        vaf_entry = [x for x in vaf_entry.split(",") if x != "."]
-                        if len(vaf_entry) > 0:
-                            vaf = sum(
-                                [float(x.strip("%")) for x in vaf_entry]
-                            ) / len(vaf_entry)
-                            if vaf_pos[1] == 'FREQ':
-                                vaf = vaf/100.0
-                    else:
-                        if vaf_entry.strip("%") != ".":
-                            vaf = float(vaf_entry.strip("%"))
-                            if vaf_pos[1] == 'FREQ':
-                                vaf = vaf/100.0
-                # Make edits
-                transcript_a.edit(
-                    mutation[3],
-                    mutation[1],
-                    mutation_type=mutation[7],
-                    mutation_class=mutation_class,
-                    vaf=vaf,
+        try:
+            # imap() returns results in task order, keeping output the same
+            #   as in a serial run
+            results = list(
+                pool.imap(
+                    _peptide_worker,
+                    tasks,
+                    chunksize=max(1, len(tasks) // (threads * 8)),
                 )
-                # Extract neoepitopes
-                peptides, protein = transcript_a.neopeptides(
-                    min_size=size_list[0],
-                    max_size=size_list[-1],
-                    include_somatic=include_somatic,
-                    include_germline=include_germline,
-                    only_novel_upstream=only_novel_upstream,
-                    only_downstream=only_downstream,
-                    only_reference=only_reference,
-                    return_protein=True,
-                    )
-                # Store neoepitopes and their metadata
-                for pep in peptides:
-                    for meta_data in peptides[pep]:
-                        adj_meta_data = meta_data + (transcript_a.transcript_id,)
-                        if adj_meta_data not in neoepitopes[pep]:
-                            neoepitopes[pep].append(adj_meta_data)
-                if protein_fasta:
-                    if len(peptides) > 0 and protein != "":
-                        fasta_entries[transcript].add(protein)
-            transcript_a.reset(reference=True)
+            )
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        memo = set()
+        results = [
+            (task[0], _transcript_neopeptides(task, reference_index, options, memo))
+            for task in tasks
+        ]
+    neoepitopes = collections.defaultdict(list)
+    fasta_entries = collections.defaultdict(set)
+    edit_sets, repeats = 0, 0
+    for transcript_id, result in results:
+        transcript_neoepitopes, proteins, transcript_edit_sets, skipped = result
+        edit_sets += transcript_edit_sets
+        repeats += skipped
+        for pep in transcript_neoepitopes:
+            for meta_data in transcript_neoepitopes[pep]:
+                if meta_data not in neoepitopes[pep]:
+                    neoepitopes[pep].append(meta_data)
+        if proteins:
+            fasta_entries[transcript_id].update(proteins)
+    if stats is not None:
+        stats["edit_sets"] = stats.get("edit_sets", 0) + edit_sets
+        stats["repeats"] = stats.get("repeats", 0) + repeats
     return neoepitopes, fasta_entries
@@ -78,7 +78,7 @@ setup(
     include_package_data=True,
     package_data={"neoepiscope": ["*.py", "*.pickle"]},
     zip_safe=True,
-    install_requires=["intervaltree==3.0.2", "mhcflurry<=1.6.0", "mhcnuggets", "networkx", "pysam"],
+    install_requires=["intervaltree==3.0.2", "mhcflurry<=1.6.0", "mhcnuggets", "numpy", "pysam"],
     entry_points={"console_scripts": ["neoepiscope=neoepiscope:main"]},
     cmdclass={"download": DownloadDependencies, "test": DiscoverTest},
     keywords=["neoepitope", "neoantigen", "cancer", "immunotherapy"],
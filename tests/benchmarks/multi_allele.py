@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+multi_allele.py
+
+Times gather_binding_scores() scoring the peptides of
+tests/expected.neoepiscope.out for six HLA alleles with the stub netMHCpan
+in this directory, once with one netMHCpan run per allele and once with a
+single run for all alleles, and checks that scores are identical.
+
+Run from anywhere: python tests/benchmarks/multi_allele.py
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import time
+import warnings
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(benchmark_dir)))
+
+from neoepiscope import binding_scores
+
+alleles = [
+    "HLA-A*01:01",
+    "HLA-A*02:01",
+    "HLA-B*07:02",
+    "HLA-B*08:01",
+    "HLA-C*07:01",
+    "HLA-C*07:02",
+]
+tool_dict = {
+    "netMHCpan4": [os.path.join(benchmark_dir, "netMHCpan"), ["affinity", "rank"]]
+}
+
+
+def score(multi_allele):
+    """ Scores peptides with the stub netMHCpan
+
+        multi_allele: True iff all alleles are passed to one run
+
+        Return value: tuple (seconds taken, neoepitope dictionary)
+    """
+    predictor = binding_scores._predictors["netMHCpan4"]
+    saved = predictor.multi_allele
+    predictor.multi_allele = multi_allele
+    try:
+        start = time.time()
+        neoepitopes = binding_scores.gather_binding_scores(
+            dict([(peptide, [("meta",)]) for peptide in peptides]),
+            tool_dict,
+            alleles,
+            [8, 11],
+        )
+        return time.time() - start, neoepitopes
+    finally:
+        predictor.multi_allele = saved
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    with open(
+        os.path.join(os.path.dirname(benchmark_dir), "expected.neoepiscope.out")
+    ) as neoepiscope_stream:
+        peptides = sorted(
+            set(
+                [
+                    line.split("\t")[0]
+                    for line in neoepiscope_stream
+                    if not line.startswith("#") and "\t" in line
+                ]
+            )
+        )
+    peptides = [
+        peptide for peptide in peptides if peptide.isalpha() and peptide.isupper()
+    ]
+    per_allele_time, per_allele = score(False)
+    all_alleles_time, all_alleles = score(True)
+    print(len(peptides), "peptides,", len(alleles), "alleles")
+    print("One run per allele: {:.2f}s".format(per_allele_time))
+    print("One run for all alleles: {:.2f}s".format(all_alleles_time))
+    print("Identical scores:", per_allele == all_alleles)
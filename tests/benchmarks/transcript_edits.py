@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+transcript_edits.py
+
+Times the enumeration hot loop of Transcript and measures its traced
+memory: random sets of SNVs, insertions, and deletions are applied to
+random multi-exon transcripts held in memory, and neopeptides and
+annotated sequences are found for each before resetting to the reference.
+Both the overall peak and the mean memory allocated transiently while
+enumerating one edit set are reported.
+
+Run from anywhere: python tests/benchmarks/transcript_edits.py [repo root]
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import random
+import sys
+import time
+import tracemalloc
+import warnings
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0,
+    sys.argv[1]
+    if len(sys.argv) > 1
+    else os.path.dirname(os.path.dirname(benchmark_dir)),
+)
+
+from neoepiscope.transcript import Transcript
+
+
+class SequenceReference(object):
+    """Reference index holding sequences in memory"""
+
+    def __init__(self, seqs):
+        self.seqs = seqs
+
+    def get_stretches(self, ref_id, intervals):
+        return [
+            self.seqs[ref_id][offset : offset + count] for offset, count in intervals
+        ]
+
+    def get_stretch(self, ref_id, offset, count):
+        return self.seqs[ref_id][offset : offset + count]
+
+
+def make_work(seed, transcripts=40, edit_sets=30):
+    """ Makes random transcripts and sets of edits to them
+
+        seed: random seed
+        transcripts: number of transcripts
+        edit_sets: number of sets of edits per transcript
+
+        Return value: list of tuples (CDS lines, list of edit sets)
+    """
+    rng = random.Random(seed)
+    work = []
+    for _ in range(transcripts):
+        cds, start = [], rng.randint(100, 200)
+        strand = rng.choice("+-")
+        for _ in range(rng.randint(1, 6)):
+            end = start + rng.randint(30, 300)
+            cds.append(["1", "blah", "exon", str(start), str(end), ".", strand])
+            start = end + rng.randint(50, 500)
+        if strand == "+":
+            codon_start = int(cds[0][3])
+        else:
+            codon_start = int(cds[-1][4]) - 2
+        cds.append(
+            [
+                "1",
+                "blah",
+                "start_codon",
+                str(codon_start),
+                str(codon_start + 2),
+                ".",
+                strand,
+            ]
+        )
+        exons = [(int(line[3]), int(line[4])) for line in cds[:-1]]
+        edit_groups = []
+        for _ in range(edit_sets):
+            edits = {}
+            for _ in range(rng.randint(2, 8)):
+                exon_start, exon_end = rng.choice(exons)
+                position = rng.randint(exon_start, exon_end)
+                mutation_type = rng.choice("VVID")
+                seq = {
+                    "V": rng.choice("ACGT"),
+                    "I": rng.choice(["A", "GG", "TTT"]),
+                    "D": rng.choice([1, 2, 3]),
+                }[mutation_type]
+                edits[position] = (seq, position, mutation_type, rng.choice("SG"))
+            edit_groups.append(list(edits.values()))
+        work.append((cds, edit_groups))
+    return work
+
+
+def run(reference, work, transients=None):
+    """ Applies each set of edits and enumerates neopeptides
+
+        reference: SequenceReference object
+        work: list from make_work()
+        transients: list to which the peak traced memory above that in use
+            at the start of each edit set is added, or None; tracemalloc
+            must be tracing if not None
+
+        Return value: number of edit sets enumerated
+    """
+    count = 0
+    for i, (cds, edit_groups) in enumerate(work):
+        transcript = Transcript(reference, cds, str(i))
+        for edits in edit_groups:
+            if transients is not None:
+                in_use = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            try:
+                for seq, position, mutation_type, mutation_class in edits:
+                    transcript.edit(
+                        seq,
+                        position,
+                        mutation_type=mutation_type,
+                        mutation_class=mutation_class,
+                    )
+                transcript.neopeptides(include_germline=2, include_somatic=1)
+                transcript.annotated_seq(include_germline=1, include_somatic=2)
+                count += 1
+            except Exception:
+                # Random edits can overlap in ways Transcript rejects
+                pass
+            if transients is not None:
+                transients.append(tracemalloc.get_traced_memory()[1] - in_use)
+            transcript.reset(reference=True)
+    return count
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    rng = random.Random(0)
+    reference = SequenceReference(
+        {"1": "".join([rng.choice("ACGT") for _ in range(20000)])}
+    )
+    work = make_work(0)
+    run(reference, work)
+    # Best of five runs
+    elapsed = None
+    for _ in range(5):
+        start = time.time()
+        count = run(reference, work)
+        run_time = time.time() - start
+        if elapsed is None or run_time < elapsed:
+            elapsed = run_time
+    tracemalloc.start()
+    run(reference, work)
+    peak = tracemalloc.get_traced_memory()[1]
+    transients = []
+    run(reference, work, transients)
+    tracemalloc.stop()
+    print("{} edit sets in {:.2f}s".format(count, elapsed))
+    print("Peak traced memory: {:.0f} KiB".format(peak / 1024))
+    print(
+        "Mean transient memory per edit set: {:.1f} KiB".format(
+            sum(transients) / len(transients) / 1024
+        )
+    )
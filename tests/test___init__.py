@@ -38,6 +38,11 @@ from neoepiscope import *
 import unittest
 import filecmp
 import os
+import random
+import struct
+import threading
+import time
+import warnings
 
 neoepiscope_dir = os.path.dirname(
     os.path.dirname((os.path.abspath(getsourcefile(lambda: 0))))
@@ -556,6 +561,39 @@ class TestHaplotypeProcessing(unittest.TestCase):
             ],
         )
 
+class TestHaplotypeCliques(unittest.TestCase):
+    """Tests finding maximal cliques of compatible phased variants"""
+
+    def setUp(self):
+        """Sets up haplotype with three pairs of overlapping substitutions
+        and a homozygous variant"""
+        self.ht = []
+        for i in range(3):
+            for alt in ["A", "T"]:
+                self.ht.append(
+                    ["11", 1000 + 10 * i, "G", alt, "0", "1", "0/1:.:2", "V"]
+                )
+        self.ht.append(["11", 2000, "C", 2, "1", "1", "1/1:.:2*", "D"])
+
+    def test_cliques(self):
+        """Fails if cliques are wrong or not in a fixed order"""
+        cliques = transcript.get_haplotype_cliques(self.ht)
+        self.assertEqual(len(cliques), 8)
+        for clique in cliques:
+            self.assertEqual(len(clique), 4)
+            self.assertEqual(clique[-1], tuple(self.ht[-1]))
+        self.assertEqual(cliques[0], [tuple(self.ht[i]) for i in [0, 2, 4, 6]])
+        self.assertEqual(cliques, transcript.get_haplotype_cliques(self.ht))
+
+    def test_max_cliques(self):
+        """Fails if clique count is not capped with a warning"""
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            cliques = transcript.get_haplotype_cliques(self.ht, max_cliques=3)
+        self.assertEqual(len(cliques), 3)
+        self.assertEqual(len(w), 1)
+
+
 class TestExpression(unittest.TestCase):
     """Tests variant-level expression"""
 
@@ -715,5 +753,1158 @@ class TestOutput(unittest.TestCase):
         os.remove(self.out_file)
 
 
+class TestGTFAttributes(unittest.TestCase):
+    """Tests extraction of GTF attributes against greedy regex parsing"""
+
+    def setUp(self):
+        """Sets up attribute fields, including malformed ones"""
+        self.fields = [
+            'gene_id "ENSG00000223972.5"; transcript_id "ENST00000456328.2"; '
+            'gene_type "transcribed_unprocessed_pseudogene"; gene_name '
+            '"DDX11L1"; transcript_type "protein_coding"; level 2; tag "basic";',
+            'gene_id "ENSG1.1"; transcript_id "ENST1.1_PAR_Y"; gene_name "HLA-A";',
+            'transcript_id "rna-XM_1.1"; transcript_type "lncRNA";',
+            'transcript_id "ENST1.1"; transcript_id "bad id"; gene_name "a b";',
+            'transcript_id "bad"; transcript_id "ENST2.1"; gene_id "ENSG2";',
+            'xtranscript_id "ENST3.1"; transcript_biotype "protein_coding";',
+            'transcript_id "ENST4.1" ; gene_id "ENSG4.1";gene_name "";',
+            'transcript_id "ENST5"x"; transcript_type "protein_coding"',
+            "",
+        ]
+        self.patterns = {
+            "transcript_id": r".*transcript_id \"([A-Z0-9._]+)\"[;].*",
+            "transcript_type": r".*transcript_type \"([A-Za-z_]+)\"[;].*",
+            "gene_id": r".*gene_id \"([A-Z0-9._]+)\"[;].*",
+            "gene_name": r".*gene_name \"([A-Za-z0-9._-]+)\"[;].*",
+        }
+
+    def test_attributes(self):
+        """Fails if an attribute differs from greedy regex parsing"""
+        for field in self.fields:
+            for key, pattern in self.patterns.items():
+                self.assertEqual(
+                    gtf_attribute(field, key), re.sub(pattern, r"\1", field)
+                )
+
+
+class TestAnnotationIndex(unittest.TestCase):
+    """Tests round trip of GTF data through the binary annotation index"""
+
+    def setUp(self):
+        """Sets up gtf file and writes index for tests"""
+        self.base_dir = os.path.join(neoepiscope_dir, "tests")
+        self.gtf = os.path.join(self.base_dir, "Chr14.gtf")
+        self.cds, self.tx = gtf_to_cds(self.gtf, "NA", pickle_it=False)
+        self.tree = cds_to_tree(self.cds, "NA", pickle_it=False)
+        self.lengths = cds_to_feature_length(
+            self.cds, self.tx, "NA", pickle_it=False
+        )
+        self.index = write_annotation_index(
+            self.cds, self.tx, self.lengths, self.base_dir
+        )
+
+    def test_round_trip(self):
+        """Fails if index contents differ from dictionaries"""
+        intervals, cds, info, lengths = load_annotation(self.base_dir)
+        self.assertEqual(dict(cds), dict(self.cds))
+        self.assertEqual(dict(info), dict(self.tx))
+        self.assertEqual(dict(lengths), self.lengths)
+        self.assertEqual(sorted(intervals), sorted(self.tree))
+        self.assertRaises(KeyError, lambda: cds["ENST_MISSING"])
+        for chrom in self.tree:
+            begin, end = self.tree[chrom].begin(), self.tree[chrom].end()
+            for pos in range(begin - 2, end + 2, 7):
+                self.assertEqual(
+                    sorted(intervals[chrom].overlap(pos, pos + 3)),
+                    sorted(self.tree[chrom].overlap(pos, pos + 3)),
+                )
+
+    def test_lazy_shards(self):
+        """Fails if contig shards are opened before they are needed"""
+        index = AnnotationIndex(self.index)
+        self.assertEqual(index.opened_contigs(), [])
+        self.assertTrue("chr14" in index.interval_dict)
+        self.assertEqual(len(index.cds_dict), 1)
+        self.assertEqual(index.opened_contigs(), [])
+        index.cds_dict["ENST00000409832.3"]
+        self.assertEqual(index.opened_contigs(), ["chr14"])
+
+    def test_threads(self):
+        """Fails if parsing or indexing in parallel changes the output"""
+        cds, tx = gtf_to_cds(self.gtf, "NA", pickle_it=False, threads=2)
+        self.assertEqual(list(cds.items()), list(self.cds.items()))
+        self.assertEqual(list(tx.items()), list(self.tx.items()))
+        with open(self.index, "rb") as index_stream:
+            serial = index_stream.read()
+        write_annotation_index(cds, tx, self.lengths, self.base_dir, threads=2)
+        with open(self.index, "rb") as index_stream:
+            self.assertEqual(index_stream.read(), serial)
+
+    def tearDown(self):
+        """Removes test files"""
+        os.remove(self.index)
+        os.remove(os.path.join(self.base_dir, "annotation.0.idx"))
+
+
+class TestIntervalIndex(unittest.TestCase):
+    """Tests sorted-array interval lookups against an IntervalTree"""
+
+    def setUp(self):
+        """Sets up random labeled intervals, including duplicates"""
+        rng = random.Random(0)
+        self.intervals = []
+        for _ in range(300):
+            start = rng.randint(0, 5000)
+            stop = start + rng.choice([0, 1, 3, 40, 400, 2000])
+            self.intervals.append((start, stop, "tx{}".format(rng.randint(0, 30))))
+        self.intervals.extend(self.intervals[:20])
+        self.tree = IntervalTree()
+        for start, stop, transcript in self.intervals:
+            if stop > start:
+                self.tree[start:stop] = transcript
+        self.index = IntervalIndex.from_intervals(self.intervals)
+        self.queries = [(pos, pos + rng.choice([1, 2, 50])) for pos in range(-5, 7500, 13)]
+
+    def test_overlap(self):
+        """Fails if overlapping intervals or transcripts are incorrect"""
+        self.assertEqual(len(self.index), len(self.tree))
+        self.assertEqual(sorted(self.index), sorted(self.tree))
+        for start, stop in self.queries:
+            expected = sorted(self.tree.overlap(start, stop))
+            self.assertEqual(sorted(self.index.overlap(start, stop)), expected)
+            self.assertEqual(
+                sorted(self.index.overlapping_transcripts(start, stop)),
+                sorted(set([interval.data for interval in expected])),
+            )
+        self.assertEqual(self.index.overlap(10, 10), [])
+
+    def test_batch(self):
+        """Fails if batched lookups differ from single lookups"""
+        batch = self.index.overlapping_transcripts_batch(
+            [start for start, _ in self.queries], [stop for _, stop in self.queries]
+        )
+        for (start, stop), transcripts in zip(self.queries, batch):
+            self.assertEqual(
+                transcripts, self.index.overlapping_transcripts(start, stop)
+            )
+
+
+class TestReference(unittest.TestCase):
+    """Tests retrieval of reference sequence from FASTA and .2bit files"""
+
+    def setUp(self):
+        """Writes small FASTA and .2bit files to use for tests"""
+        self.base_dir = os.path.join(neoepiscope_dir, "tests")
+        self.fasta = os.path.join(self.base_dir, "test.reference.fa")
+        self.twobit = os.path.join(self.base_dir, "test.reference.2bit")
+        self.seqs = [("chr1", "ACGTNNacgtRYAACC"), ("chr2", "TTGCA")]
+        offset = 0
+        with open(self.fasta, "w") as fasta_stream, open(
+            self.fasta + ".fai", "w"
+        ) as fai_stream:
+            for name, seq in self.seqs:
+                header = ">" + name + "\n"
+                lines = [seq[i : i + 6] + "\n" for i in range(0, len(seq), 6)]
+                fasta_stream.write(header + "".join(lines))
+                print(
+                    name, len(seq), offset + len(header), 6, 7,
+                    sep="\t", file=fai_stream
+                )
+                offset += len(header) + sum([len(line) for line in lines])
+        # Minimal .2bit file with no soft-masked blocks
+        records = []
+        for name, seq in self.seqs:
+            upper = seq.upper()
+            ns = [i for i in range(len(upper)) if upper[i] not in "ACGT"]
+            packed = bytearray()
+            for i in range(0, len(upper), 4):
+                byte = 0
+                for j in range(4):
+                    base = upper[i + j] if i + j < len(upper) else "T"
+                    byte = (byte << 2) | max("TCAG".find(base), 0)
+                packed.append(byte)
+            records.append((name, upper, ns, bytes(packed)))
+        with open(self.twobit, "wb") as twobit_stream:
+            header = struct.pack("<IIII", 0x1A412743, 0, len(records), 0)
+            index_size = sum([1 + len(name) + 4 for name, _, _, _ in records])
+            bodies = []
+            for name, upper, ns, packed in records:
+                # Each ambiguous base is its own N block
+                body = struct.pack("<II", len(upper), len(ns))
+                body += b"".join([struct.pack("<I", n) for n in ns])
+                body += b"".join([struct.pack("<I", 1) for n in ns])
+                body += struct.pack("<II", 0, 0) + packed
+                bodies.append(body)
+            offset = len(header) + index_size
+            twobit_stream.write(header)
+            for (name, _, _, _), body in zip(records, bodies):
+                twobit_stream.write(
+                    struct.pack("<B", len(name)) + name.encode("ascii")
+                    + struct.pack("<I", offset)
+                )
+                offset += len(body)
+            for body in bodies:
+                twobit_stream.write(body)
+
+    def test_stretches(self):
+        """Fails if FASTA or .2bit references return incorrect sequence"""
+        for path in [self.fasta, self.twobit]:
+            reference = open_reference(path)
+            self.assertEqual(reference.length, {"chr1": 16, "chr2": 5})
+            self.assertEqual(
+                reference.get_stretch("chr1", 0, 16), "ACGTNNACGTNNAACC"
+            )
+            self.assertEqual(reference.get_stretch("chr1", 4, 5), "NNACG")
+            self.assertEqual(reference.get_stretch("chr2", 3, 4), "CANN")
+            self.assertEqual(
+                reference.get_stretches("chr1", [(10, 4), (2, 3)]),
+                ["NNAA", "GTN"],
+            )
+
+    def tearDown(self):
+        """Removes test files"""
+        for test_file in [self.fasta, self.fasta + ".fai", self.twobit]:
+            os.remove(test_file)
+
+
+class TestBindingCache(unittest.TestCase):
+    """Tests storage, lookup, and eviction of cached binding scores"""
+
+    def setUp(self):
+        """Sets up path to cache database"""
+        self.cache_file = os.path.join(
+            neoepiscope_dir, "tests", "test.binding_cache.sqlite"
+        )
+
+    def test_lookup(self):
+        """Fails if cached scores are not returned as stored"""
+        cache = BindingCache(self.cache_file)
+        cache.store(
+            "netMHCpan4",
+            ["affinity", "rank"],
+            "HLA-A*02:01",
+            [("SIINFEKL", "25.3", "0.1"), ("SIINFEKLL", "NA", "NA")],
+        )
+        cache.close()
+        cache = BindingCache(self.cache_file)
+        self.assertEqual(
+            cache.lookup(
+                "netMHCpan4",
+                ["affinity", "rank"],
+                "HLA-A*02:01",
+                ["SIINFEKL", "SIINFEKLL", "AAAAAAAA"],
+            ),
+            {"SIINFEKL": ("25.3", "0.1"), "SIINFEKLL": ("NA", "NA")},
+        )
+        # Scores are specific to tool, scoring methods, and allele
+        self.assertEqual(
+            cache.lookup("netMHCpan4", ["affinity"], "HLA-A*02:01", ["SIINFEKL"]),
+            {},
+        )
+        self.assertEqual(
+            cache.lookup(
+                "netMHCpan4", ["affinity", "rank"], "HLA-B*07:02", ["SIINFEKL"]
+            ),
+            {},
+        )
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache.close()
+
+    def test_eviction(self):
+        """Fails if least recently used scores are not evicted first"""
+        cache = BindingCache(self.cache_file, max_entries=2)
+        for peptide in ["AAAAAAAA", "CCCCCCCC", "DDDDDDDD"]:
+            cache.store("mhcflurry1", ["affinity"], "HLA-A*02:01", [(peptide, "1")])
+            time.sleep(0.01)
+        cache.lookup("mhcflurry1", ["affinity"], "HLA-A*02:01", ["AAAAAAAA"])
+        self.assertEqual(cache.evict(), 1)
+        self.assertEqual(
+            sorted(
+                cache.lookup(
+                    "mhcflurry1",
+                    ["affinity"],
+                    "HLA-A*02:01",
+                    ["AAAAAAAA", "CCCCCCCC", "DDDDDDDD"],
+                )
+            ),
+            ["AAAAAAAA", "DDDDDDDD"],
+        )
+        cache.close()
+
+    def tearDown(self):
+        """Removes test files"""
+        os.remove(self.cache_file)
+
+
+class TestAlleleRegistry(unittest.TestCase):
+    """Tests resolution of alleles supported by binding prediction tools"""
+
+    def test_unsupported_alleles(self):
+        """Fails if supported and unsupported alleles are not told apart"""
+        self.assertEqual(
+            unsupported_alleles(
+                {
+                    "mhcflurry1": ["mhcflurry-predict", ["affinity"]],
+                    "mhcnuggets2": ["NA", ["affinity"]],
+                    "netMHCpan4_1": ["netMHCpan", ["affinity"]],
+                },
+                ["HLA-A*02:01", "HLA-DRB1*01:01", "H2-Qa1", "HLA-Q*99:99"],
+            ),
+            {
+                "mhcflurry1": ["HLA-DRB1*01:01", "H2-Qa1", "HLA-Q*99:99"],
+                "mhcnuggets2": ["H2-Qa1", "HLA-Q*99:99"],
+                "netMHCpan4_1": ["HLA-DRB1*01:01", "HLA-Q*99:99"],
+            },
+        )
+
+
+class TestBindingDispatch(unittest.TestCase):
+    """Tests that peptides and alleles a tool cannot score are not sent to it"""
+
+    def test_unscorable(self):
+        """Fails if unscorable peptides and alleles do not get NA scores
+        without running tool"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            neoepitopes = gather_binding_scores(
+                {"AAAAAAAA": [("meta",)], "CCCCCCCCC": [("meta",)]},
+                {
+                    "netMHCIIpan3": [
+                        os.path.join(neoepiscope_dir, "tests", "no.such.tool"),
+                        ["affinity", "rank"],
+                    ]
+                },
+                ["HLA-A*02:01"],
+                [8, 9],
+            )
+        self.assertEqual(
+            neoepitopes,
+            {
+                "AAAAAAAA": [("meta", "NA", "NA")],
+                "CCCCCCCCC": [("meta", "NA", "NA")],
+            },
+        )
+
+    def test_unscorable_not_looked_up(self):
+        """Fails if unscorable peptides and alleles count as cache misses"""
+        from neoepiscope import binding_scores
+
+        self.addCleanup(
+            setattr, binding_scores, "_predictors", binding_scores._predictors
+        )
+        binding_scores._predictors = binding_scores._predictors.copy()
+        cache_file = os.path.join(neoepiscope_dir, "tests", "test.unscorable.sqlite")
+        self.addCleanup(os.remove, cache_file)
+        runs = []
+
+        def score(peptides, alleles, tool_data, size_list):
+            runs.append(list(peptides))
+            return [[(peptide, "1") for peptide in peptides] for allele in alleles]
+
+        register_predictor(
+            Predictor(
+                "stubpredictor2",
+                "stubpredictor",
+                ["2"],
+                ["affinity"],
+                score,
+                lambda: "NA",
+                allele_tables=["mhcflurry"],
+                lengths=(None, 9),
+            )
+        )
+        results, stats = [], []
+        for _ in range(2):
+            cache = BindingCache(cache_file)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                results.append(
+                    gather_binding_scores(
+                        {
+                            "AAAAAAAA": [("meta",)],
+                            "CCCCCCCCC": [("meta",)],
+                            "EEEEEEEEEE": [("meta",)],
+                        },
+                        {"stubpredictor2": ["NA", ["affinity"]]},
+                        ["HLA-A*02:01", "HLA-DRB1*01:01"],
+                        [8, 10],
+                        cache=cache,
+                    )
+                )
+            stats.append((cache.hits, cache.misses))
+            cache.close()
+        self.assertEqual(runs, [["AAAAAAAA", "CCCCCCCCC"]])
+        self.assertEqual(stats, [(0, 2), (2, 0)])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(
+            results[1],
+            {
+                "AAAAAAAA": [("meta", "1", "NA")],
+                "CCCCCCCCC": [("meta", "1", "NA")],
+                "EEEEEEEEEE": [("meta", "NA", "NA")],
+            },
+        )
+
+
+class TestPredictorRegistry(unittest.TestCase):
+    """Tests registering a binding prediction tool"""
+
+    def test_registered_predictor(self):
+        """Fails if a registered tool is not batched and chunked as declared"""
+        from neoepiscope import binding_scores
+
+        self.addCleanup(
+            setattr, binding_scores, "_predictors", binding_scores._predictors
+        )
+        binding_scores._predictors = binding_scores._predictors.copy()
+        runs = []
+
+        def score(peptides, alleles, tool_data, size_list):
+            runs.append((list(peptides), list(alleles)))
+            return [
+                [(peptide, str(len(peptide))) for peptide in peptides]
+                for allele in alleles
+            ]
+
+        register_predictor(
+            Predictor(
+                "stubpredictor1",
+                "stubpredictor",
+                ["1"],
+                ["affinity"],
+                score,
+                lambda: "NA",
+                lengths=(None, 9),
+                max_batch=2,
+                in_process=True,
+            )
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            neoepitopes = gather_binding_scores(
+                {
+                    "AAAAAAAA": [("meta",)],
+                    "CCCCCCCCC": [("meta",)],
+                    "DDDDDDDD": [("meta",)],
+                    "EEEEEEEEEE": [("meta",)],
+                },
+                {"stubpredictor1": ["NA", ["affinity"]]},
+                ["HLA-A*02:01", "HLA-B*07:02"],
+                [8, 10],
+            )
+        self.assertEqual(len(runs), 2)
+        for peptides, alleles in runs:
+            self.assertLessEqual(len(peptides), 2)
+            self.assertEqual(alleles, ["HLA-A*02:01", "HLA-B*07:02"])
+        self.assertEqual(
+            neoepitopes,
+            {
+                "AAAAAAAA": [("meta", "8", "8")],
+                "CCCCCCCCC": [("meta", "9", "9")],
+                "DDDDDDDD": [("meta", "8", "8")],
+                "EEEEEEEEEE": [("meta", "NA", "NA")],
+            },
+        )
+
+
+class TestChunkedScoring(unittest.TestCase):
+    """Tests running a binding prediction tool in chunks with retries"""
+
+    def setUp(self):
+        """Registers a stub tool that fails on chosen peptides"""
+        from neoepiscope import binding_scores
+
+        self.addCleanup(
+            setattr, binding_scores, "_predictors", binding_scores._predictors
+        )
+        binding_scores._predictors = binding_scores._predictors.copy()
+        self.cache_file = os.path.join(neoepiscope_dir, "tests", "test.chunks.sqlite")
+        # Numbers of runs left to fail for each peptide
+        self.failures = {}
+        self.runs = []
+
+        def score(peptides, alleles, tool_data, size_list):
+            self.runs.append(list(peptides))
+            for peptide in peptides:
+                if self.failures.get(peptide):
+                    self.failures[peptide] -= 1
+                    # As _read_xls_scores() reports truncated output
+                    raise RuntimeError("Missing peptides in binding predictions")
+            return [
+                [(peptide, str(len(peptide)), allele[4]) for peptide in peptides]
+                for allele in alleles
+            ]
+
+        register_predictor(
+            Predictor(
+                "stubpredictor3",
+                "stubpredictor",
+                ["3"],
+                ["affinity", "rank"],
+                score,
+                lambda: "NA",
+            )
+        )
+
+    def gather(self, **kwargs):
+        """Scores stub peptides for two alleles"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return gather_binding_scores(
+                {
+                    "AAAAAAAA": [("meta",)],
+                    "CCCCCCCCC": [("meta",)],
+                    "DDDDDDDD": [("meta",)],
+                },
+                {"stubpredictor3": ["NA", ["affinity", "rank"]]},
+                ["HLA-A*02:01", "HLA-B*07:02"],
+                [8, 9],
+                **kwargs
+            )
+
+    def test_chunks(self):
+        """Fails if chunked scores differ from scores of a single run"""
+        whole = self.gather()
+        self.assertEqual(len(self.runs), 2)
+        self.runs = []
+        self.assertEqual(self.gather(chunk_size=1), whole)
+        self.assertEqual(len(self.runs), 6)
+        self.assertEqual(
+            whole,
+            {
+                "AAAAAAAA": [("meta", "8", "A", "8", "B")],
+                "CCCCCCCCC": [("meta", "9", "A", "9", "B")],
+                "DDDDDDDD": [("meta", "8", "A", "8", "B")],
+            },
+        )
+
+    def test_retry(self):
+        """Fails if a tool run leaving truncated output is not rerun"""
+        whole = self.gather()
+        self.runs = []
+        self.failures["CCCCCCCCC"] = 1
+        self.assertEqual(self.gather(chunk_size=2, retries=1), whole)
+        self.assertEqual(
+            self.runs,
+            [["AAAAAAAA", "CCCCCCCCC"]] * 2
+            + [["DDDDDDDD"], ["AAAAAAAA", "CCCCCCCCC"], ["DDDDDDDD"]],
+        )
+
+    def test_failed_chunk(self):
+        """Fails if a chunk failing without retries is not raised, or if
+        chunks that succeeded are not cached"""
+        self.addCleanup(os.remove, self.cache_file)
+        self.failures["CCCCCCCCC"] = 2
+        cache = BindingCache(self.cache_file)
+        with self.assertRaises(RuntimeError):
+            self.gather(chunk_size=1, retries=0, cache=cache)
+        self.assertEqual(
+            cache.lookup(
+                "stubpredictor3",
+                ["affinity", "rank"],
+                "HLA-A*02:01",
+                ["AAAAAAAA", "CCCCCCCCC", "DDDDDDDD"],
+            ),
+            {"AAAAAAAA": ("8", "A"), "DDDDDDDD": ("8", "A")},
+        )
+        # A rerun predicts only the chunk that failed
+        self.runs = []
+        self.assertEqual(
+            self.gather(chunk_size=1, retries=1, cache=cache)["CCCCCCCCC"],
+            [("meta", "9", "A", "9", "B")],
+        )
+        self.assertEqual(self.runs, [["CCCCCCCCC"], ["CCCCCCCCC"]])
+        cache.close()
+
+
+class TestConcurrentScoring(unittest.TestCase):
+    """Tests running binding prediction tools in a thread pool"""
+
+    def test_threads(self):
+        """Fails if scores from concurrent runs differ from serial ones"""
+        from neoepiscope import binding_scores
+
+        self.addCleanup(
+            setattr, binding_scores, "_predictors", binding_scores._predictors
+        )
+        binding_scores._predictors = binding_scores._predictors.copy()
+        threads = set()
+
+        def score(peptides, alleles, tool_data, size_list):
+            threads.add(threading.current_thread().name)
+            # Finish chunks out of order
+            time.sleep(0.001 * (len(peptides[0]) % 3))
+            return [
+                [
+                    (peptide, str(len(peptide)), allele[4] + tool_data[0])
+                    for peptide in peptides
+                ]
+                for allele in alleles
+            ]
+
+        for number, multi_allele in [("4", True), ("5", False)]:
+            register_predictor(
+                Predictor(
+                    "stubpredictor" + number,
+                    "stubpredictor",
+                    [number],
+                    ["affinity", "rank"],
+                    score,
+                    lambda: "NA",
+                    max_batch=2,
+                    multi_allele=multi_allele,
+                )
+            )
+        neoepitopes = {
+            "".join([amino_acid] * length): [("meta",)]
+            for amino_acid in "ACDEF"
+            for length in [8, 9, 10]
+        }
+        results = []
+        for thread_count in [1, 4]:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                results.append(
+                    gather_binding_scores(
+                        {
+                            peptide: list(meta_data)
+                            for peptide, meta_data in neoepitopes.items()
+                        },
+                        {
+                            "stubpredictor4": ["4", ["affinity", "rank"]],
+                            "stubpredictor5": ["5", ["affinity", "rank"]],
+                        },
+                        ["HLA-A*02:01", "HLA-B*07:02", "HLA-C*07:01"],
+                        [8, 9, 10],
+                        threads=thread_count,
+                    )
+                )
+        self.assertGreater(len(threads), 1)
+        self.assertEqual(results[0], results[1])
+        # Columns follow alleles, then tools
+        self.assertEqual(
+            results[1]["CCCCCCCCC"],
+            [
+                (
+                    "meta",
+                    "9",
+                    "A4",
+                    "9",
+                    "A5",
+                    "9",
+                    "B4",
+                    "9",
+                    "B5",
+                    "9",
+                    "C4",
+                    "9",
+                    "C5",
+                )
+            ],
+        )
+
+
+class TestMHCflurryScoring(unittest.TestCase):
+    """Tests scoring peptides with MHCflurry's predictor in this process"""
+
+    @staticmethod
+    def prediction(peptide, allele):
+        """Returns stub affinity, low, high, and rank for a peptide"""
+        if peptide == "FFFFFFFFF":
+            return [float("nan")] * 4
+        affinity = len(peptide) * 10.0 + int(allele[-1])
+        return [affinity, affinity - 1.5, affinity + 1.5, len(peptide) / 4.0]
+
+    def setUp(self):
+        """Swaps in a stub predictor"""
+        from neoepiscope import binding_scores
+
+        test = self
+        self.queries = []
+
+        class StubPredictor(object):
+            def predict_to_dataframe(self, peptides, alleles, **kwargs):
+                test.queries.append((list(peptides), list(alleles)))
+                values = [
+                    test.prediction(peptide, allele)
+                    for peptide, allele in zip(peptides, alleles)
+                ]
+                return dict(
+                    zip(
+                        [
+                            "prediction",
+                            "prediction_low",
+                            "prediction_high",
+                            "prediction_percentile",
+                        ],
+                        [list(column) for column in zip(*values)],
+                    )
+                )
+
+        self.binding_scores = binding_scores
+        self.predictor = binding_scores._mhcflurry_affinity_predictor
+        binding_scores._mhcflurry_affinity_predictor = StubPredictor()
+        self.scores = ["affinity", "high", "low", "rank"]
+
+    def tearDown(self):
+        """Restores predictor"""
+        self.binding_scores._mhcflurry_affinity_predictor = self.predictor
+
+    def test_in_process_scores(self):
+        """Fails if scores are not split among alleles in column order"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            affinities = self.binding_scores.get_affinities_mhcflurry(
+                [
+                    ["AAAAAAAA", "CCCCCCCCC", "DDDDDDD"],
+                    ["EEEEEEEE"],
+                    ["FFFFFFFFF", "AAAAAAAA"],
+                ],
+                ["HLA-A*02:01", "HLA-Q*99:99", "HLA-B*07:02"],
+                self.scores,
+            )
+        self.assertEqual(
+            self.queries,
+            [
+                (
+                    ["AAAAAAAA", "CCCCCCCCC", "FFFFFFFFF", "AAAAAAAA"],
+                    ["HLA-A*02:01", "HLA-A*02:01", "HLA-B*07:02", "HLA-B*07:02"],
+                )
+            ],
+        )
+        self.assertEqual(
+            affinities,
+            [
+                [
+                    ("AAAAAAAA", "81.0", "82.5", "79.5", "2.0"),
+                    ("CCCCCCCCC", "91.0", "92.5", "89.5", "2.25"),
+                    ("DDDDDDD", "NA", "NA", "NA", "NA"),
+                ],
+                [("EEEEEEEE", "NA", "NA", "NA", "NA")],
+                [
+                    ("FFFFFFFFF", "NA", "NA", "NA", "NA"),
+                    ("AAAAAAAA", "82.0", "83.5", "80.5", "2.0"),
+                ],
+            ],
+        )
+
+    def test_matches_command_line(self):
+        """Fails if scores differ from those parsed from mhcflurry-predict"""
+        binding_scores = self.binding_scores
+        test = self
+
+        class StubSubprocess(object):
+            @staticmethod
+            def check_call(command):
+                with open(command[-1]) as peptide_stream:
+                    queries = [
+                        line.strip().split(",")
+                        for line in peptide_stream.readlines()[1:]
+                        if line.strip()
+                    ]
+                with open(command[command.index("--out") + 1], "w") as out_stream:
+                    out_stream.write(
+                        "allele,peptide,mhcflurry_prediction,"
+                        "mhcflurry_prediction_low,mhcflurry_prediction_high,"
+                        "mhcflurry_prediction_percentile\n"
+                    )
+                    for allele, peptide in queries:
+                        out_stream.write(
+                            ",".join(
+                                [allele, peptide]
+                                + [
+                                    str(value)
+                                    for value in test.prediction(peptide, allele)
+                                ]
+                            )
+                            + "\n"
+                        )
+
+        peptides = ["AAAAAAAA", "CCCCCCCCC", "DDDDDDD"]
+        subprocess = binding_scores.subprocess
+        binding_scores.subprocess = StubSubprocess()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                parsed = binding_scores.get_affinity_mhcflurry(
+                    peptides, "HLA-A*02:01", self.scores, "1"
+                )
+                in_process = binding_scores.get_affinities_mhcflurry(
+                    [peptides], ["HLA-A*02:01"], self.scores
+                )[0]
+        finally:
+            binding_scores.subprocess = subprocess
+        self.assertEqual(in_process, parsed)
+
+
+class TestMHCnuggetsScoring(unittest.TestCase):
+    """Tests scoring peptides with MHCnuggets' models in this process"""
+
+    def setUp(self):
+        """Swaps in stub mhcnuggets and keras modules"""
+        import tempfile
+        import types
+        from neoepiscope import binding_scores
+
+        self.binding_scores = binding_scores
+        self.home = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.home, "saves", "production"))
+        open(
+            os.path.join(
+                self.home, "saves", "production", "HLA-A02:01_BA_to_HLAp.h5"
+            ),
+            "w",
+        ).close()
+        self.built, self.loaded, self.closest = [], [], []
+        # Probabilities by peptide; get_predictions() gives 0 for negatives
+        self.probas = {"AAAAAAAA": [0.3], "DDDDDDDD": 0}
+        test = self
+
+        class StubModel(object):
+            def __init__(self, input_size):
+                test.built.append(input_size)
+
+            def load_weights(self, weights):
+                test.loaded.append(weights)
+
+            def compile(self, loss, optimizer):
+                pass
+
+        def closest_allele(mhc, pickle_path):
+            test.closest.append(pickle_path)
+            return mhc
+
+        def get_predictions(**kwargs):
+            predictions = [test.probas[x] for x in kwargs["test_peptides"]]
+            return predictions, [0 for x in predictions]
+
+        def predict(**kwargs):
+            raise RuntimeError("predict() should not be called")
+
+        attributes = {
+            "keras": {},
+            "keras.optimizers": {"Adam": lambda lr: None},
+            "mhcnuggets": {},
+            "mhcnuggets.src": {},
+            "mhcnuggets.src.predict": {
+                "MHCNUGGETS_HOME": self.home,
+                "predict": predict,
+            },
+            "mhcnuggets.src.models": {
+                "get_predictions": get_predictions,
+                "mhcnuggets_lstm": StubModel,
+            },
+            "mhcnuggets.src.dataset": {
+                "mask_peptides": lambda peptides, max_len: (peptides, peptides),
+                "tensorize_keras": lambda peptides, embed_type: peptides,
+                "map_proba_to_ic50": lambda proba, max_ic50: max_ic50 ** (1 - proba),
+            },
+            "mhcnuggets.src.aa_embeddings": {
+                "NUM_AAS": 21,
+                "MHCI_MASK_LEN": 8,
+                "MHCII_MASK_LEN": 30,
+            },
+            "mhcnuggets.src.find_closest_mhcI": {"closest_allele": closest_allele},
+            "mhcnuggets.src.find_closest_mhcII": {"closest_allele": closest_allele},
+        }
+        self.modules = {}
+        for name in attributes:
+            self.modules[name] = sys.modules.get(name)
+            module = types.ModuleType(name)
+            for attribute in attributes[name]:
+                setattr(module, attribute, attributes[name][attribute])
+            sys.modules[name] = module
+        self.models = binding_scores._mhcnuggets_models.copy()
+        binding_scores._mhcnuggets_models.clear()
+
+    def tearDown(self):
+        """Restores modules and loaded models"""
+        import shutil
+
+        for name in self.modules:
+            if self.modules[name] is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = self.modules[name]
+        self.binding_scores._mhcnuggets_models.clear()
+        self.binding_scores._mhcnuggets_models.update(self.models)
+        shutil.rmtree(self.home)
+
+    def test_scores(self):
+        """Fails if weights, rounding, or NA scores differ from predict()'s"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            affinities = self.binding_scores.get_affinities_mhcnuggets(
+                [["AAAAAAAA", "CCCCCCCCC"], ["DDDDDDDD"], ["AAAAAAAA"]],
+                ["HLA-A*02:01", "HLA-Q*99:99", "HLA-B*07:02"],
+                "2",
+            )
+        self.assertEqual(
+            affinities,
+            [
+                [("AAAAAAAA", "1946.61"), ("CCCCCCCCC", "NA")],
+                [("DDDDDDDD", "NA")],
+                [("AAAAAAAA", "1946.61")],
+            ],
+        )
+        self.assertEqual(
+            self.loaded,
+            [
+                os.path.join(
+                    self.home, "saves/production/", "HLA-A02:01_BA_to_HLAp.h5"
+                ),
+                os.path.join(self.home, "saves/production/", "HLA-B07:02_BA.h5"),
+            ],
+        )
+        self.assertEqual(
+            set(self.closest),
+            set(
+                [
+                    os.path.join(
+                        self.home, "data", "production", "examples_per_allele.pkl"
+                    )
+                ]
+            ),
+        )
+        # A prediction replaced with 0 is not an array
+        self.assertEqual(
+            self.binding_scores.get_affinity_mhcnuggets(
+                ["DDDDDDDD"], "HLA-A*02:01", "2"
+            ),
+            [("DDDDDDDD", "50000.0")],
+        )
+
+    def test_fallback(self):
+        """Fails if predict() is not run when mhcnuggets' internals are
+        missing"""
+        calls = []
+
+        def predict(class_, peptides_path, mhc, output):
+            calls.append((class_, mhc))
+            with open(peptides_path) as peptide_stream:
+                peptides = peptide_stream.read().split()
+            with open(output, "w") as out_stream:
+                out_stream.write("peptide,ic50\n")
+                for peptide in peptides:
+                    out_stream.write(peptide + ",12.5\n")
+
+        del sys.modules["mhcnuggets.src.models"].get_predictions
+        sys.modules["mhcnuggets.src.predict"].predict = predict
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            affinities = self.binding_scores.get_affinities_mhcnuggets(
+                [["AAAAAAAA", "CCCCCCCCC"], ["AAAAAAAA"]],
+                ["HLA-A*02:01", "HLA-Q*99:99"],
+                "2",
+            )
+        self.assertEqual(calls, [("I", "HLA-A02:01")])
+        self.assertEqual(
+            affinities,
+            [[("AAAAAAAA", "12.5"), ("CCCCCCCCC", "12.5")], [("AAAAAAAA", "NA")]],
+        )
+
+    def test_model_eviction(self):
+        """Fails if least recently used models are not evicted"""
+        alleles = [
+            "HLA-A*02:01",
+            "HLA-B*07:02",
+            "HLA-B*44:05",
+            "HLA-B*44:01",
+            "HLA-B*12:01",
+            "HLA-B*27:20",
+            "HLA-C*03:03",
+            "HLA-A*11:02",
+            "HLA-A*11:01",
+            "HLA-A*69:01",
+            "HLA-B*27:06",
+            "HLA-B*27:05",
+            "HLA-B*27:04",
+            "HLA-B*27:03",
+            "HLA-B*27:02",
+            "HLA-B*27:01",
+            "HLA-B*15:17",
+        ]
+        self.assertEqual(len(alleles), 17)
+        for allele in alleles + [alleles[-1], alleles[0], alleles[1]]:
+            self.binding_scores.get_affinity_mhcnuggets(["AAAAAAAA"], allele, "2")
+        # Scoring the 17th allele evicts the 1st; scoring the 1st again
+        #   evicts the 2nd
+        self.assertEqual(len(self.built), 19)
+        self.assertEqual(len(self.binding_scores._mhcnuggets_models), 16)
+        self.assertEqual(
+            list(self.binding_scores._mhcnuggets_models)[-3:],
+            [("HLA-B15:17", "I"), ("HLA-A02:01", "I"), ("HLA-B07:02", "I")],
+        )
+
+
+class TestMultiAlleleOutput(unittest.TestCase):
+    """Tests splitting -xls output of one run for several alleles"""
+
+    def setUp(self):
+        """Creates temporary directory for stub tools"""
+        import tempfile
+
+        self.tool_dir = tempfile.mkdtemp()
+        self.peptides = ["AAAAAAAAA", "CCCCCCCCC"]
+
+    def tearDown(self):
+        """Removes stub tools"""
+        import shutil
+
+        shutil.rmtree(self.tool_dir)
+
+    def stub_tool(self, tool_alleles, block, trailer):
+        """Writes a tool that gives -xls output for two alleles
+
+        tool_alleles: tool's names for alleles, in the order passed to it
+        block: column headers for each allele's block of columns
+        trailer: column headers after the last block
+
+        Return value: path to tool
+        """
+        xls_file = os.path.join(self.tool_dir, "output.xls")
+        with open(xls_file, "w") as xls_stream:
+            print(
+                "\t\t\t"
+                + "".join([allele + "\t" * len(block) for allele in tool_alleles])
+                + "\t" * (len(trailer) - 1),
+                file=xls_stream,
+            )
+            print(
+                "\t".join(
+                    ["Pos", "Peptide", "ID"] + block * len(tool_alleles) + trailer
+                ),
+                file=xls_stream,
+            )
+            for i, peptide in enumerate(self.peptides):
+                row = [str(i), peptide, "PEPLIST"]
+                for j in range(1, len(tool_alleles) + 1):
+                    # Allele j gives peptide i affinity j0i.0 and rank j.i
+                    scores = {
+                        "nM": "{}0{}.0".format(j, i),
+                        "Rank": "{}.{}".format(j, i),
+                    }
+                    row += [scores.get(column, "0.5") for column in block]
+                print("\t".join(row + ["0"] * len(trailer)), file=xls_stream)
+        tool = os.path.join(self.tool_dir, "tool")
+        with open(tool, "w") as tool_stream:
+            print("#!" + sys.executable, file=tool_stream)
+            print("import shutil, sys", file=tool_stream)
+            print(
+                "shutil.copy({!r}, sys.argv[sys.argv.index('-xlsfile') + 1])".format(
+                    xls_file
+                ),
+                file=tool_stream,
+            )
+        os.chmod(tool, 0o755)
+        return tool
+
+    def scores(self, j):
+        """Returns scores the stub tool gives the jth allele passed to it"""
+        return [
+            (peptide, "{}0{}.0".format(j, i), "{}.{}".format(j, i))
+            for i, peptide in enumerate(self.peptides)
+        ]
+
+    def check_tool(
+        self, get_affinities, version, alleles, tool_alleles, block, trailer
+    ):
+        """Fails if scores are not assigned to alleles the tool gave them"""
+        from neoepiscope import binding_scores
+
+        tool = self.stub_tool(tool_alleles, block, trailer)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            affinities = getattr(binding_scores, get_affinities)(
+                self.peptides,
+                [alleles[1], "HLA-Q*99:99", alleles[0]],
+                tool,
+                version,
+                ["affinity", "rank"],
+            )
+        self.assertEqual(
+            affinities,
+            [
+                self.scores(2),
+                [(peptide, "NA", "NA") for peptide in self.peptides],
+                self.scores(1),
+            ],
+        )
+
+    def test_netMHCpan3(self):
+        """Fails if netMHCpan 3 output is not split by allele"""
+        self.check_tool(
+            "get_affinities_netMHCpan",
+            "3",
+            ["HLA-A*02:01", "HLA-B*07:02"],
+            ["HLA-A02:01", "HLA-B07:02"],
+            ["core", "1-log50k", "nM", "Rank"],
+            ["Ave", "NB"],
+        )
+
+    def test_netMHCpan4(self):
+        """Fails if netMHCpan 4 output is not split by allele"""
+        self.check_tool(
+            "get_affinities_netMHCpan",
+            "4",
+            ["HLA-A*02:01", "HLA-B*07:02"],
+            ["HLA-A02:01", "HLA-B07:02"],
+            ["core", "icore", "1-log50k", "nM", "Rank"],
+            ["Ave", "NB"],
+        )
+
+    def test_netMHC4(self):
+        """Fails if netMHC 4 output is not split by allele"""
+        self.check_tool(
+            "get_affinities_netMHC",
+            "4",
+            ["HLA-A*02:01", "HLA-B*07:02"],
+            ["HLA-A0201", "HLA-B0702"],
+            ["nM", "Rank"],
+            ["H_Avg_Ranks", "N_binders"],
+        )
+
+    def test_netMHCIIpan3(self):
+        """Fails if netMHCIIpan 3 output is not split by allele"""
+        self.check_tool(
+            "get_affinities_netMHCIIpan",
+            "3",
+            ["HLA-DRB1*01:01", "HLA-DRB1*03:01"],
+            ["DRB1_0101", "DRB1_0301"],
+            ["Core", "nM", "Rank"],
+            ["Ave", "NB"],
+        )
+
+    def test_netMHCIIpan4(self):
+        """Fails if netMHCIIpan 4 output is not split by allele"""
+        self.check_tool(
+            "get_affinities_netMHCIIpan",
+            "4",
+            ["HLA-DRB1*01:01", "HLA-DRB1*03:01"],
+            ["DRB1_0101", "DRB1_0301"],
+            ["Core", "Inverted", "Score", "Rank_EL", "nM", "Rank"],
+            ["Ave", "NB"],
+        )
+
+    def test_missing_allele_columns(self):
+        """Fails if output with too few allele blocks is accepted"""
+        from neoepiscope import binding_scores
+
+        tool = self.stub_tool(
+            ["HLA-A02:01"], ["core", "icore", "1-log50k", "nM", "Rank"], ["Ave", "NB"]
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with self.assertRaises(RuntimeError) as context:
+                binding_scores.get_affinities_netMHCpan(
+                    self.peptides,
+                    ["HLA-A*02:01", "HLA-B*07:02"],
+                    tool,
+                    "4",
+                    ["affinity", "rank"],
+                )
+        self.assertIn("Cannot find columns", str(context.exception))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -175,6 +175,27 @@ class TestTranscript(unittest.TestCase):
         self.assertEqual(self.transcript.deletion_intervals, [])
         self.assertEqual(self.transcript.transcript_id, "ENST00000335295.4_1")
 
+    def test_prefetch(self):
+        """Fails if exon sequences are not cached by prefetching"""
+        prefetched_transcript = Transcript(
+            self.reference_index,
+            [
+                [str(chrom).replace("chr", ""), "N/A", seq_type, str(start), str(end), ".", strand]
+                for (chrom, seq_type, start, end, strand, tx_type) in self.cds[
+                    "ENST00000335295.4_1"
+                ]
+            ],
+            "ENST00000335295.4_1",
+            prefetch=True,
+        )
+        misses = self.reference_index.stretch_cache_misses
+        hits = self.reference_index.stretch_cache_hits
+        self.assertEqual(
+            prefetched_transcript.annotated_seq(), self.transcript.annotated_seq()
+        )
+        self.assertEqual(self.reference_index.stretch_cache_misses, misses)
+        self.assertEqual(self.reference_index.stretch_cache_hits, hits + 6)
+
     # Reading frame tests
     def test_rev_reading_frame(self):
         """Fails if incorrect reading frame is called in rev transcript"""
@@ -362,6 +383,22 @@ class TestTranscript(unittest.TestCase):
         )
         self.assertNotEqual(self.transcript.edits, {})
 
+    def test_edit_after_reset_to_save_point(self):
+        """Fails if edits after resetting to save point change save point"""
+        self.transcript.edit("A", 5248299)
+        self.transcript.save()
+        saved_seq = self.transcript.annotated_seq()
+        self.transcript.reset()
+        self.transcript.edit("G", 5248299, mutation_class="G")
+        self.transcript.edit(3, 5246694, mutation_type="D")
+        self.assertEqual(
+            self.transcript.last_edits[5248298],
+            [("A", "V", "S", ("11", 5248299, "T", "A", "V", None))],
+        )
+        self.assertEqual(self.transcript.last_deletion_intervals, [])
+        self.transcript.reset()
+        self.assertEqual(self.transcript.annotated_seq(), saved_seq)
+
     def test_SNV_seq(self):
         """Fails if SNV is edited incorrectly"""
         self.transcript.edit("A", 5248299)
@@ -1122,5 +1159,207 @@ class TestTranscript(unittest.TestCase):
         )
 
 
+class SequenceReference(object):
+    """Reference index holding sequences in memory"""
+
+    def __init__(self, seqs):
+        self.seqs = seqs
+
+    def get_stretches(self, ref_id, intervals):
+        return [
+            self.seqs[ref_id][offset : offset + count] for offset, count in intervals
+        ]
+
+
+class TestCliqueEditOrder(unittest.TestCase):
+    """Tests that edits from a clique of overlapping variants are made in the
+    same order whatever the order of the haplotype"""
+
+    def setUp(self):
+        """Sets up reference, transcript, and haplotype"""
+        self.reference = SequenceReference(
+            {
+                "1": "GGATCACAGTATGAGGTACTCCACAAGAGCTGCTCTAAGAAGAAAATGGAAAATCTATAT"
+                "CAGGTGGAGGCAGCCAATAGAGTGTGGTGGTAACTGAGTCCG"
+            }
+        )
+        self.cds = [
+            ["1", "blah", "exon", "1", "102", ".", "+"],
+            ["1", "blah", "start_codon", "11", "13", ".", "+"],
+        ]
+        # Somatic and germline calls of the same deletion, and insertions
+        self.haplotype = [
+            ["1", 41, "", "G", "1", "1", "0/1:.:35:34:0:0.1%:19,15,0,0:.:2*", "I"],
+            ["1", 28, "AG", 2, "1", "1", "0/1:.:35:34:0:0.1%:19,15,0,0:.:2*", "D"],
+            ["1", 29, "", "G", "0", "1", "0/1:.:35:34:0:0.1%:19,15,0,0:.:2", "I"],
+            ["1", 28, "AG", 2, "0", "1", "0/1:.:35:34:0:0.1%:19,15,0,0:.:2", "D"],
+        ]
+
+    def test_insertion_and_deletions(self):
+        """Fails if neopeptides depend on the order of the haplotype"""
+        from neoepiscope.transcript import _edit_transcript, get_haplotype_cliques
+
+        for haplotype in [self.haplotype, self.haplotype[::-1]]:
+            cliques = get_haplotype_cliques(haplotype)
+            self.assertEqual(
+                [
+                    [(variant[1], variant[7]) for variant in clique]
+                    for clique in cliques
+                ],
+                [[(28, "D"), (28, "D"), (29, "I"), (41, "I")]],
+            )
+            transcript = Transcript(self.reference, self.cds, "T1")
+            _edit_transcript(transcript, cliques[0], None)
+            peptides = transcript.neopeptides(min_size=8, max_size=8)
+            self.assertEqual(
+                dict([(peptide, sorted(peptides[peptide])) for peptide in peptides]),
+                {
+                    "MRYSTRLL": [
+                        ("1", 28, "AG", "", "D", None, "NA", "NA"),
+                        ("1", 29, "", "G", "I", None, "NA", "NA"),
+                    ]
+                },
+            )
+
+    def test_repeated_edits(self):
+        """Fails if the same edits, made in the same order, are enumerated
+        twice"""
+        from neoepiscope.transcript import _transcript_neopeptides
+
+        memo = set()
+        neoepitopes, proteins, edit_sets, repeats = _transcript_neopeptides(
+            (
+                "T1",
+                [
+                    ("1", "exon", 1, 102, "+", "protein_coding"),
+                    ("1", "start_codon", 11, 13, "+", "protein_coding"),
+                ],
+                [self.haplotype, self.haplotype[::-1]],
+                False,
+            ),
+            self.reference,
+            {
+                "vaf_pos": None,
+                "size_list": [8],
+                "include_germline": 2,
+                "include_somatic": 1,
+                "only_novel_upstream": False,
+                "only_downstream": False,
+                "only_reference": False,
+                "protein_fasta": False,
+                "max_cliques": None,
+            },
+            memo,
+        )
+        self.assertEqual((edit_sets, repeats, len(memo)), (2, 1, 1))
+        self.assertEqual(
+            dict(
+                [(peptide, sorted(neoepitopes[peptide])) for peptide in neoepitopes]
+            ),
+            {
+                "MRYSTRLL": [
+                    ("1", 28, "AG", "", "D", None, "NA", "NA", "T1"),
+                    ("1", 29, "", "G", "I", None, "NA", "NA", "T1"),
+                ]
+            },
+        )
+
+
+class TestPeptidesFromTranscripts(unittest.TestCase):
+    """Tests spreading transcripts across worker processes"""
+
+    def test_threads(self):
+        """Fails if peptides found in worker processes differ from those found
+        serially"""
+        reference = SequenceReference(
+            {
+                "1": "GGATCACAGTATGAGGTACTCCACAAGAGCTGCTCTAAGAAGAAAATGGAAAATCTATAT"
+                "CAGGTGGAGGCAGCCAATAGAGTGTGGTGGTAACTGAGTCCG"
+            }
+        )
+        haplotype = [
+            ["1", 28, "AG", 2, "0", "1", "0/1:.:35:34:0:0.1%:19,15,0,0:.:2", "D"],
+            ["1", 41, "", "G", "0", "1", "0/1:.:35:34:0:0.1%:19,15,0,0:.:2", "I"],
+        ]
+        cds_dict = {
+            "T1": [
+                ("1", "exon", 1, 102, "+", "protein_coding"),
+                ("1", "start_codon", 11, 13, "+", "protein_coding"),
+            ],
+            "T2": [
+                ("1", "exon", 1, 60, "+", "protein_coding"),
+                ("1", "exon", 71, 102, "+", "protein_coding"),
+                ("1", "start_codon", 11, 13, "+", "protein_coding"),
+            ],
+            "T3": [
+                ("1", "exon", 30, 102, "+", "protein_coding"),
+                ("1", "start_codon", 46, 48, "+", "protein_coding"),
+            ],
+        }
+        snvs = [
+            ["1", 20, "T", "A", "0", "1", "0/1:.:35:34:0:15.7%:19,15,0,0:.:2", "V"],
+            ["1", 80, "G", "T", "0", "1", "0/1:.:35:34:0:15.7%:19,15,0,0:.:2", "V"],
+        ]
+        results = []
+        for threads in [1, 2]:
+            stats = {}
+            neoepitopes, fasta = get_peptides_from_transcripts(
+                {
+                    "T1": [list(haplotype), list(snvs)],
+                    "T2": [list(snvs)],
+                    "T3": [list(haplotype[1:])],
+                },
+                {"T3": [list(snvs[1])]},
+                (5, "FREQ"),
+                cds_dict,
+                False,
+                False,
+                False,
+                reference,
+                [8, 9],
+                False,
+                False,
+                False,
+                False,
+                False,
+                True,
+                2,
+                1,
+                protein_fasta=True,
+                threads=threads,
+                stats=stats,
+            )
+            results.append(
+                (
+                    dict(
+                        [
+                            (peptide, sorted(neoepitopes[peptide]))
+                            for peptide in neoepitopes
+                        ]
+                    ),
+                    dict(fasta),
+                    stats,
+                )
+            )
+        self.assertTrue(results[0][0])
+        self.assertEqual(sorted(results[0][1]), ["T1", "T2", "T3"])
+        self.assertEqual(results[0], results[1])
+
+
+class TestSeqToPeptide(unittest.TestCase):
+    """Tests translation of nucleotide sequences"""
+
+    def test_translation(self):
+        """Fails if short and long sequences translate differently"""
+        from neoepiscope.transcript import seq_to_peptide
+
+        for repeats in [1, 40]:
+            peptide = seq_to_peptide("ATGGCNCTNAANNCAATG" * repeats + "TAAGGG")
+            self.assertEqual(peptide, "MAL??M" * repeats + "X")
+        self.assertEqual(seq_to_peptide("GGATGTTTTAGTTT", require_ATG=True), "MFX")
+        self.assertEqual(seq_to_peptide("CCCAAACAT", reverse_strand=True), "MFG")
+        self.assertEqual(seq_to_peptide("GGG", require_ATG=True), "")
+
+
 if __name__ == "__main__":
     unittest.main()